@@ -0,0 +1,327 @@
+# CPU benchmark for each restoration stage {scratch mask, inpainting, Real-ESRGAN, GFPGAN}
+#
+# Runs every stage on synthetic images of several sizes and prints per-stage
+# latency, throughput and peak RSS as JSON. With --random-weights no .pth files
+# are needed, so it runs offline; timings match the real models because the
+# architectures are identical.
+#
+#   python benchmark.py --sizes 128,256 --random-weights --output bench.json
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import numpy as np
+import cv2
+import torch
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+FRONTEND_DIR = os.path.join(REPO_DIR, 'frontend')
+sys.path.insert(0, FRONTEND_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from mask import scratch_mask
+import lama
+
+LAMA_REPO = '/app/model_repo/lama'
+STAGES = ['mask', 'mask_multiscale', 'inpaint_opencv', 'inpaint_opencv_roi', 'inpaint_lama', 'esrgan', 'gfpgan']
+# Stages that can run on an exported graph instead of the eager model (see --backends)
+BACKEND_STAGES = ('esrgan', 'gfpgan')
+BACKENDS = ('eager', 'torchscript', 'onnx')
+
+def synthetic_image(size, seed=0):
+    """Deterministic old-photo-like BGR image: smooth gradients, shapes, grain and scratches"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    img = np.stack([120 + 80 * x, 100 + 60 * y, 90 + 50 * (x * y)], axis=-1)
+    for _ in range(8):
+        center = tuple(int(v) for v in rng.integers(0, size, 2))
+        radius = int(rng.integers(size // 20 + 1, size // 5 + 2))
+        color = tuple(int(v) for v in rng.integers(0, 255, 3))
+        cv2.circle(img, center, radius, color, -1)
+    img += rng.normal(0, 12, img.shape)
+    img = np.clip(img, 0, 255).astype(np.uint8)
+    for _ in range(5):
+        p1 = tuple(int(v) for v in rng.integers(0, size, 2))
+        p2 = tuple(int(v) for v in rng.integers(0, size, 2))
+        cv2.line(img, p1, p2, (250, 250, 250), 1)
+    return img
+
+def _proc_status(field):
+    with open('/proc/self/status') as f:
+        return int(re.search(rf'{field}:\s+(\d+) kB', f.read()).group(1)) * 1024
+
+def reset_peak_rss():
+    """Reset the kernel's peak-RSS counter; False where that isn't supported"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss():
+    try:
+        return _proc_status('VmHWM')
+    except (OSError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def measure(fn, repeat, warmup=1):
+    """Run fn warmup + repeat times; return latency stats and peak RSS of the timed runs"""
+    for _ in range(warmup):
+        fn()
+    resettable = reset_peak_rss()
+    baseline = peak_rss()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        'latency_mean_s': round(float(np.mean(times)), 5),
+        'latency_min_s': round(float(np.min(times)), 5),
+        'latency_max_s': round(float(np.max(times)), 5),
+        'peak_rss_mb': round(peak_rss() / 1024 ** 2, 1),
+        'rss_growth_mb': round((peak_rss() - baseline) / 1024 ** 2, 1),
+        'peak_rss_scope': 'stage' if resettable else 'process',
+    }
+
+def load_state_dict(path, key):
+    state = torch.load(path, map_location='cpu')
+    return state[key] if key in state else state['params']
+
+# --- Models -----------------------------------------------------------------
+
+def build_esrgan(args):
+    import restoration_worker
+    from basicsr.archs.rrdbnet_arch import RRDBNet
+    model = RRDBNet(**restoration_worker.RRDBNET_ARGS)
+    if not args.random_weights:
+        model.load_state_dict(load_state_dict(os.path.join(args.models_dir, 'RealESRGAN_x4plus.pth'), 'params_ema'))
+    return model.eval()
+
+def build_gfpgan(args):
+    from gfpgan.archs.gfpganv1_clean_arch import GFPGANv1Clean
+    model = GFPGANv1Clean(out_size=512, num_style_feat=512, channel_multiplier=2, decoder_load_path=None,
+                          fix_decoder=False, num_mlp=8, input_is_latent=True, different_w=True,
+                          narrow=1, sft_half=True)
+    if not args.random_weights:
+        model.load_state_dict(load_state_dict(os.path.join(args.models_dir, 'GFPGANv1.4.pth'), 'params_ema'))
+    return model.eval()
+
+def build_lama(args):
+    """Big-LaMa generator; random weights need the lama repo for the architecture"""
+    sys.path.append(LAMA_REPO)
+    if args.random_weights:
+        from saicinpainting.training.modules.ffc import FFCResNetGenerator
+        return FFCResNetGenerator(
+            input_nc=4, output_nc=3, ngf=64, n_downsampling=3, n_blocks=18, add_out_act='sigmoid',
+            init_conv_kwargs={'ratio_gin': 0, 'ratio_gout': 0, 'enable_lfu': False},
+            downsample_conv_kwargs={'ratio_gin': 0, 'ratio_gout': 0, 'enable_lfu': False},
+            resnet_conv_kwargs={'ratio_gin': 0.75, 'ratio_gout': 0.75, 'enable_lfu': False}
+        ).eval()
+    from saicinpainting.training.trainers import load_checkpoint
+    model = load_checkpoint(os.path.join(args.models_dir, 'big-lama.pt'), strict=False, map_location='cpu')
+    return model.generator.eval()
+
+def export_for_backend(stage, model, backend, export_dir):
+    """The eager model of an esrgan/gfpgan stage as a graph for `backend`, exported into export_dir"""
+    import export_models
+    import inference_backends
+    if backend == 'eager':
+        return model
+    cpu = torch.device('cpu')
+    path = os.path.join(export_dir, stage + inference_backends.EXTENSIONS[backend])
+    if stage == 'esrgan':
+        export_models.export_graph(model, export_models.esrgan_example(), backend, path,
+                                   export_models.esrgan_dynamic_axes())
+        return inference_backends.open_graph(backend, path, cpu)
+    export_models.export_graph(inference_backends.FaceGenerator(model).eval(), export_models.gfpgan_example(),
+                               backend, path)
+    return inference_backends.FaceGraph(inference_backends.open_graph(backend, path, cpu))
+
+# --- Stages -----------------------------------------------------------------
+# Each stage returns a zero-argument callable that runs it once on `img`.
+
+def stage_mask(img, args, models):
+    return lambda: scratch_mask(img)
+
+def stage_mask_multiscale(img, args, models):
+    return lambda: scratch_mask(img, levels=args.mask_levels)
+
+def stage_inpaint_opencv(img, args, models):
+    mask = scratch_mask(img)
+    return lambda: (cv2.inpaint(img, mask, 3, cv2.INPAINT_TELEA), cv2.inpaint(img, mask, 3, cv2.INPAINT_NS))
+
+def stage_inpaint_opencv_roi(img, args, models):
+    # Only the damaged tiles, both methods, as lama.py does with --method telea/ns
+    mask = scratch_mask(img)
+    return lambda: (lama.inpaint_image(img, mask, 'telea'), lama.inpaint_image(img, mask, 'ns'))
+
+def stage_inpaint_lama(img, args, models):
+    model = models['lama']
+    mask = (scratch_mask(img) > 0).astype(np.float32)
+    h, w = img.shape[:2]
+    pad_h, pad_w = (8 - h % 8) % 8, (8 - w % 8) % 8
+    image_t = torch.from_numpy(img[:, :, ::-1].transpose(2, 0, 1).copy()).float().div(255).unsqueeze(0)
+    mask_t = torch.from_numpy(mask)[None, None]
+    image_t = torch.nn.functional.pad(image_t, (0, pad_w, 0, pad_h), mode='reflect')
+    mask_t = torch.nn.functional.pad(mask_t, (0, pad_w, 0, pad_h), mode='reflect')
+
+    def run():
+        with torch.no_grad():
+            return model(torch.cat([image_t * (1 - mask_t), mask_t], dim=1))
+    return run
+
+def stage_esrgan(img, args, models):
+    from tiled_upscale import upscale_image
+    from tile_batcher import DirectRunner, TileBatcher
+    model = models['esrgan']
+    lanes = max(args.tile_lanes, 1)
+    if args.batch_size > 1 or lanes > 1:
+        runner = TileBatcher(model, torch.device('cpu'), args.batch_size, args.batch_wait_ms / 1000.0, lanes)
+    else:
+        runner = DirectRunner(model, torch.device('cpu'))
+    rgb = img[:, :, ::-1].copy()
+    window = max(16, 2 * args.batch_size * lanes)
+
+    def run():
+        # Lanes split the threads between them, as in the worker
+        torch.set_num_threads(max(args.threads // lanes, 1))
+        try:
+            return upscale_image(rgb, runner, scale=4, tile=args.tile, tile_pad=args.tile_pad, window=window)
+        finally:
+            torch.set_num_threads(args.threads)
+    return run
+
+def stage_gfpgan(img, args, models):
+    # One aligned 512x512 face crop per run; detection needs downloaded facexlib weights
+    model = models['gfpgan']
+    face = cv2.resize(img, (512, 512), interpolation=cv2.INTER_LINEAR)
+    face_t = torch.from_numpy(face[:, :, ::-1].transpose(2, 0, 1).copy()).float().div(255)
+    face_t = ((face_t - 0.5) / 0.5).unsqueeze(0)
+
+    def run():
+        with torch.no_grad():
+            return model(face_t, return_rgb=False, weight=0.5)[0]
+    return run
+
+STAGE_FUNCS = {
+    'mask': stage_mask,
+    'mask_multiscale': stage_mask_multiscale,
+    'inpaint_opencv': stage_inpaint_opencv,
+    'inpaint_opencv_roi': stage_inpaint_opencv_roi,
+    'inpaint_lama': stage_inpaint_lama,
+    'esrgan': stage_esrgan,
+    'gfpgan': stage_gfpgan,
+}
+
+STAGE_MODELS = {'inpaint_lama': ('lama', build_lama), 'esrgan': ('esrgan', build_esrgan), 'gfpgan': ('gfpgan', build_gfpgan)}
+
+def run_benchmarks(args):
+    torch.set_num_threads(args.threads)
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'opencv': cv2.__version__,
+            'cpu_count': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(),
+            'random_weights': args.random_weights,
+        },
+        'config': {k: v for k, v in vars(args).items() if k not in ('output',)},
+        'results': [],
+    }
+
+    models = {}
+    export_dir = tempfile.mkdtemp(prefix='bench-export-')
+    for stage in args.stages:
+        if stage in STAGE_MODELS:
+            name, builder = STAGE_MODELS[stage]
+            start = time.perf_counter()
+            try:
+                models[name] = builder(args)
+            except Exception as e:
+                print(f"[Bench] Skipping {stage}: {e}", file=sys.stderr)
+                report['results'].append({'stage': stage, 'skipped': str(e)})
+                continue
+            report['results'].append({'stage': stage, 'model_load_s': round(time.perf_counter() - start, 4)})
+
+        for backend in (args.backends if stage in BACKEND_STAGES else [None]):
+            stage_models = models
+            if backend is not None:
+                name = STAGE_MODELS[stage][0]
+                start = time.perf_counter()
+                try:
+                    stage_models = dict(models, **{name: export_for_backend(stage, models[name], backend, export_dir)})
+                except Exception as e:
+                    print(f"[Bench] Skipping {stage} on {backend}: {e}", file=sys.stderr)
+                    report['results'].append({'stage': stage, 'backend': backend, 'skipped': str(e)})
+                    continue
+                if backend != 'eager':
+                    report['results'].append({'stage': stage, 'backend': backend,
+                                              'export_s': round(time.perf_counter() - start, 4)})
+
+            for size in args.sizes:
+                img = synthetic_image(size, seed=size)
+                print(f"[Bench] {stage} @ {size}x{size}" + (f" ({backend})" if backend else ''), file=sys.stderr)
+                result = measure(STAGE_FUNCS[stage](img, args, stage_models), args.repeat, args.warmup)
+                megapixels = size * size / 1e6
+                result.update({
+                    'stage': stage,
+                    'size': size,
+                    'megapixels_per_s': round(megapixels / result['latency_mean_s'], 4),
+                    'images_per_s': round(1 / result['latency_mean_s'], 4),
+                })
+                if backend:
+                    result['backend'] = backend
+                report['results'].append(result)
+    shutil.rmtree(export_dir, ignore_errors=True)
+    return report
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark each restoration stage on CPU')
+    parser.add_argument('--sizes', default='128,256,512', type=lambda v: [int(x) for x in v.split(',')],
+                        help='comma-separated square input sizes in pixels')
+    parser.add_argument('--stages', default=','.join(STAGES), type=lambda v: v.split(','),
+                        help=f"comma-separated subset of: {', '.join(STAGES)}")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--random-weights', action='store_true', help='random-init models; no .pth files needed')
+    parser.add_argument('--models-dir', default='/app/models')
+    parser.add_argument('--mask-levels', type=lambda v: v if v == 'auto' else int(v), default=1,
+                        help="pyramid levels for mask_multiscale (a number or 'auto')")
+    parser.add_argument('--tile', type=int, default=200, help='Real-ESRGAN tile size (0 = whole image)')
+    parser.add_argument('--tile-pad', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=1, help='Real-ESRGAN tiles per forward pass')
+    parser.add_argument('--batch-wait-ms', type=float, default=10)
+    parser.add_argument('--tile-lanes', type=int, default=1,
+                        help='Real-ESRGAN forward passes run at once, each on threads/lanes torch threads')
+    parser.add_argument('--backends', default='eager', type=lambda v: v.split(','),
+                        help=f"comma-separated backends for {' and '.join(BACKEND_STAGES)}: {', '.join(BACKENDS)}")
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+    unknown = set(args.backends) - set(BACKENDS)
+    if unknown:
+        parser.error(f"unknown backends: {', '.join(sorted(unknown))}")
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = json.dumps(run_benchmarks(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+        print(f"Benchmark report saved to {args.output}", file=sys.stderr)
+    else:
+        print(report)
@@ -0,0 +1,142 @@
+import os
+import uuid
+import zlib
+import struct
+import numpy as np
+import cv2
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# zlib level for streamed PNGs when neither the job nor OUTPUT_PNG_COMPRESSION sets one;
+# higher is smaller but slower
+PNG_COMPRESS_LEVEL = int(os.environ.get('STREAM_PNG_COMPRESS_LEVEL', '3'))
+# Compressed bytes buffered before an IDAT chunk is written
+IDAT_CHUNK_SIZE = 1024 * 1024
+
+def _temp_path(path, suffix=''):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".tmp-{uuid.uuid4().hex}-{name}{suffix}")
+
+class PNGBandWriter:
+    """Writes an RGB PNG a band of rows at a time, with constant memory.
+
+    Rows are 'Up'-filtered and fed through one zlib stream, which is flushed
+    to the file in IDAT chunks as it fills. The file appears at `path` only
+    when close() succeeds.
+    """
+
+    def __init__(self, path, width, height, level=None):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self._tmp_path = _temp_path(path)
+        self._file = open(self._tmp_path, 'wb')
+        self._compressor = zlib.compressobj(PNG_COMPRESS_LEVEL if level is None else level)
+        self._pending = []
+        self._pending_size = 0
+        self._last_row = np.zeros(width * 3, dtype=np.uint8)
+        self._file.write(PNG_SIGNATURE)
+        # 8-bit truecolour, no interlacing
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self._file.write(struct.pack('>I', len(data)))
+        self._file.write(kind)
+        self._file.write(data)
+        self._file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind)) & 0xffffffff))
+
+    def _compressed(self, data):
+        if data:
+            self._pending.append(data)
+            self._pending_size += len(data)
+        if self._pending_size >= IDAT_CHUNK_SIZE:
+            self._flush_idat()
+
+    def _flush_idat(self):
+        if self._pending:
+            self._chunk(b'IDAT', b''.join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def write(self, rows):
+        """Append HxWx3 uint8 RGB rows"""
+        rows = rows.reshape(rows.shape[0], self.width * 3)
+        previous = np.vstack([self._last_row[None], rows[:-1]])
+        filtered = np.empty((rows.shape[0], self.width * 3 + 1), dtype=np.uint8)
+        filtered[:, 0] = 2  # Up filter: difference to the row above, wrapping mod 256
+        np.subtract(rows, previous, out=filtered[:, 1:])
+        self._compressed(self._compressor.compress(filtered.tobytes()))
+        self._last_row = rows[-1].copy()
+        self.rows_written += rows.shape[0]
+
+    def close(self):
+        if self.rows_written != self.height:
+            raise ValueError(f"PNG has {self.rows_written} of {self.height} rows")
+        self._compressed(self._compressor.flush())
+        self._flush_idat()
+        self._chunk(b'IEND', b'')
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self._tmp_path)
+        except FileNotFoundError:
+            pass
+
+class MemmapBandWriter:
+    """Collects rows in a memory-mapped file on disk, then encodes them with OpenCV.
+
+    For formats that can't be streamed with the standard library. The pages
+    of the map are file-backed, so the kernel can drop them under memory
+    pressure instead of the whole output having to stay resident.
+    """
+
+    def __init__(self, path, width, height, channel_order='bgr', params=(), dtype=np.uint8):
+        self.path = path
+        self.channel_order = channel_order
+        self.params = list(params)
+        self.rows_written = 0
+        self._map_path = _temp_path(path, '.npy')
+        self._map = np.lib.format.open_memmap(self._map_path, mode='w+', dtype=dtype, shape=(height, width, 3))
+
+    def write(self, rows):
+        """Append HxWx3 rows (of the writer's dtype) in `channel_order`"""
+        self._map[self.rows_written:self.rows_written + rows.shape[0]] = rows
+        self.rows_written += rows.shape[0]
+
+    def close(self):
+        if self.rows_written != self._map.shape[0]:
+            raise ValueError(f"Image has {self.rows_written} of {self._map.shape[0]} rows")
+        self._map.flush()
+        image = self._map if self.channel_order == 'bgr' else self._map[:, :, ::-1]
+        tmp_path = _temp_path(self.path)
+        try:
+            if not cv2.imwrite(tmp_path, image, self.params):
+                raise Exception(f"Could not write image to: {self.path}")
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            self.abort()
+
+    def abort(self):
+        self._map = None
+        try:
+            os.remove(self._map_path)
+        except FileNotFoundError:
+            pass
+
+def open_band_writer(path, width, height, params=(), dtype=np.uint8, png_level=None):
+    """Streaming PNG writer for 8-bit .png outputs, memory-mapped writer otherwise.
+
+    `params` are the cv2.imwrite flags for the memory-mapped writer and
+    `png_level` the zlib level for the PNG one (STREAM_PNG_COMPRESS_LEVEL if None).
+    Returns (writer, channel_order) where channel_order is what write() expects.
+    """
+    if os.path.splitext(path)[1].lower() == '.png' and dtype == np.uint8:
+        return PNGBandWriter(path, width, height, png_level), 'rgb'
+    return MemmapBandWriter(path, width, height, 'bgr', params, dtype), 'bgr'
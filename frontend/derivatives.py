@@ -0,0 +1,101 @@
+import os
+import uuid
+import threading
+from PIL import Image, features
+from result_cache import ResultCache, cache_key
+
+# Resized copies of uploads and results for the pages that show them, made on
+# first request and kept in an LRU cache next to the result cache
+DERIVATIVES = os.environ.get('DERIVATIVES', '1') != '0'
+DERIVATIVE_DIR = os.environ.get('DERIVATIVE_DIR', '/app/outputs/derivatives')
+DERIVATIVE_MAX_BYTES = int(os.environ.get('DERIVATIVE_MAX_BYTES', str(1024 ** 3)))
+
+# Long side in pixels of each size a page may ask for; only these are made, so
+# the cache can't be filled with arbitrary widths
+SIZES = {
+    'thumb': int(os.environ.get('THUMBNAIL_SIZE', '320')),
+    'display': int(os.environ.get('DISPLAY_SIZE', '1600')),
+}
+FORMATS = {'webp': ('.webp', 'image/webp'), 'jpeg': ('.jpg', 'image/jpeg')}
+QUALITY = int(os.environ.get('DERIVATIVE_QUALITY', '82'))
+
+cache = ResultCache(DERIVATIVE_DIR, DERIVATIVE_MAX_BYTES)
+
+# Render lock of each derivative being made, with how many requests hold or wait on it
+_locks = {}
+_locks_lock = threading.Lock()
+
+def webp_supported():
+    return features.check('webp')
+
+def choose_format(requested, accept):
+    """'webp' or 'jpeg': the requested one if valid, else WebP when the client accepts it"""
+    if requested in FORMATS and (requested != 'webp' or webp_supported()):
+        return requested
+    if 'image/webp' in (accept or '') and webp_supported():
+        return 'webp'
+    return 'jpeg'
+
+def derivative_key(source_path, size, fmt):
+    """Cache key of one derivative; changes whenever the source file is replaced"""
+    stat = os.stat(source_path)
+    return cache_key(path=os.path.abspath(source_path), size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                     long_side=SIZES[size], format=fmt, quality=QUALITY)
+
+def render(source_path, dest, long_side, fmt):
+    """Write source_path shrunk to fit long_side x long_side (never enlarged) as fmt at dest"""
+    with Image.open(source_path) as img:
+        # JPEG sources decode straight at a reduced scale when that's enough
+        img.draft('RGB', (long_side, long_side))
+        img.thumbnail((long_side, long_side), Image.LANCZOS)
+        if fmt == 'jpeg':
+            if img.mode in ('RGBA', 'LA', 'P'):
+                img = img.convert('RGBA')
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                background.paste(img, mask=img.getchannel('A'))
+                img = background
+            else:
+                img = img.convert('RGB')
+            img.save(dest, 'JPEG', quality=QUALITY, optimize=True, progressive=True)
+        else:
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'transparency' in img.info or img.mode in ('LA', 'P') else 'RGB')
+            img.save(dest, 'WEBP', quality=QUALITY, method=4)
+
+def get(source_path, size, fmt):
+    """Path of the `size` derivative of source_path in fmt, rendering it on first use.
+
+    Concurrent requests for the same derivative wait for one render instead of
+    each making their own.
+    """
+    key = derivative_key(source_path, size, fmt)
+    ext = FORMATS[fmt][0]
+    path = cache.get(key, ext)
+    if path:
+        return path
+    with _locks_lock:
+        entry = _locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            path = cache.get(key, ext)
+            if path is None:
+                # Rendered outside the cache root so a concurrent eviction can't remove it half-written
+                tmp_dir = DERIVATIVE_DIR.rstrip('/') + '.tmp'
+                os.makedirs(tmp_dir, exist_ok=True)
+                tmp_path = os.path.join(tmp_dir, f"{uuid.uuid4().hex}{ext}")
+                try:
+                    render(source_path, tmp_path, SIZES[size], fmt)
+                    cache.put(key, ext, tmp_path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                print(f"[Derivatives] {size} {fmt} of {os.path.basename(source_path)}")
+                path = cache.get(key, ext)
+    finally:
+        # Dropped only by the last request using it, so later ones can't get a second lock for the key
+        with _locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _locks[key]
+    return path
@@ -1,7 +1,315 @@
 import os
 import time
-import subprocess
 import glob
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import restoration_worker
+import output_format
+import face_precheck
+import metrics
+from job_events import DirectoryWatcher, read_request_file
+
+# Safety net: rescan even without a change notification every few seconds
+RESCAN_INTERVAL = 5
+
+# Jobs handled at the same time by each worker; concurrent Real-ESRGAN jobs share its tile batcher
+CONCURRENT_JOBS = int(os.environ.get('WORKER_CONCURRENT_JOBS', '2'))
+
+# Worker processes, each pinned to its own share of the CPUs; 1 runs jobs in this process
+WORKER_PROCESSES = int(os.environ.get('WORKER_PROCESSES', '1'))
+
+def job_started(kind, process_file):
+    """Record how long a request waited for a worker; returns when it was queued"""
+    try:
+        queued_at = os.path.getmtime(process_file)
+    except OSError:
+        queued_at = time.time()
+    metrics.QUEUE_WAIT.observe(max(time.time() - queued_at, 0), kind=kind)
+    return queued_at
+
+def job_finished(kind, queued_at, result):
+    metrics.JOB_SECONDS.observe(max(time.time() - queued_at, 0), kind=kind)
+    metrics.JOBS.inc(kind=kind, result=result)
+
+def handle_esrgan_request(process_file):
+    """Run Real-ESRGAN for one .process_esrgan request; returns (result, output paths)"""
+    # Extract filename
+    base_process_file = os.path.basename(process_file)
+    input_filename = base_process_file.replace('.process_esrgan', '')
+    options = read_request_file(process_file)
+    encoding = restoration_worker.fit_encoding(os.path.join(restoration_worker.UPLOAD_FOLDER, input_filename),
+                                               options.get('output') or {}, 4)
+    # Command-line clients name their output; the web app's follow from the input
+    output_filename = os.path.basename(options.get('output_filename') or
+                                       output_format.output_filename(f"esrgan_{input_filename}", encoding))
+
+    print(f"[ESRGAN] Processing Real-ESRGAN for: {input_filename}")
+    output_path = os.path.join(restoration_worker.OUTPUT_FOLDER, output_filename)
+    restoration_worker.track_request(process_file, [output_path])
+
+    # Run Real-ESRGAN processing with the resident model
+    start = time.time()
+    result = restoration_worker.process_realesrgan(input_filename, output_filename, encoding)
+    print(f"[ESRGAN] Processed {output_filename} in {time.time() - start:.2f}s")
+    return result, [output_path]
+
+def handle_gfpgan_request(process_file):
+    """Run GFPGAN for one .process_gfpgan request; returns (result, output paths)"""
+    # Extract filename
+    base_process_file = os.path.basename(process_file)
+    input_filename = base_process_file.replace('.process_gfpgan', '')
+
+    print(f"[GFPGAN] Found process file: {process_file}")
+    print(f"[GFPGAN] Input filename: {input_filename}")
+
+    # Generate output filename
+    options = read_request_file(process_file)
+    encoding = restoration_worker.fit_encoding(os.path.join(restoration_worker.OUTPUT_FOLDER, input_filename),
+                                               options.get('output') or {}, 1)
+    if input_filename.startswith('esrgan_'):
+        base_name = input_filename.replace('esrgan_', '')
+        output_filename = f"final_enhanced_{base_name}"
+    else:
+        output_filename = f"final_enhanced_{input_filename}"
+    output_filename = os.path.basename(options.get('output_filename') or
+                                       output_format.output_filename(output_filename, encoding))
+
+    print(f"[GFPGAN] Processing GFPGAN for: {input_filename} -> {output_filename}")
+
+    # Verify input file exists
+    input_path = f'/app/outputs/frontend/{input_filename}'
+    if not os.path.exists(input_path):
+        print(f"[GFPGAN] ERROR: Input file not found: {input_path}")
+        # List files in directory for debugging
+        print(f"[GFPGAN] Files in /app/outputs/frontend/:")
+        for f in os.listdir('/app/outputs/frontend'):
+            print(f"  - {f}")
+        return 'error', []
+
+    print(f"[GFPGAN] Input file exists: {input_path}")
+    output_path = os.path.join(restoration_worker.OUTPUT_FOLDER, output_filename)
+    restoration_worker.track_request(process_file, [output_path])
+
+    # Run GFPGAN processing with the resident model
+    start = time.time()
+    result = restoration_worker.process_gfpgan(input_filename, output_filename, encoding)
+    print(f"[GFPGAN] Processed {output_filename} in {time.time() - start:.2f}s")
+    return result, [output_path]
+
+def handle_pipeline_request(process_file):
+    """Run Real-ESRGAN and GFPGAN in one pass for a .process_pipeline request; returns (result, output paths)"""
+    base_process_file = os.path.basename(process_file)
+    input_filename = base_process_file.replace('.process_pipeline', '')
+    options = read_request_file(process_file)
+    encoding = restoration_worker.fit_encoding(os.path.join(restoration_worker.UPLOAD_FOLDER, input_filename),
+                                               options.get('output') or {}, 4)
+    esrgan_filename = output_format.output_filename(f"esrgan_{input_filename}", encoding)
+    final_filename = output_format.output_filename(f"final_enhanced_{input_filename}", encoding)
+
+    print(f"[PIPELINE] Processing Real-ESRGAN + GFPGAN for: {input_filename} -> {final_filename}")
+    output_paths = [os.path.join(restoration_worker.OUTPUT_FOLDER, name) for name in (esrgan_filename, final_filename)]
+    restoration_worker.track_request(process_file, output_paths)
+
+    start = time.time()
+    result = restoration_worker.process_pipeline(
+        input_filename, esrgan_filename, final_filename,
+        write_intermediate=options.get('write_intermediate', True),
+        encoding=encoding
+    )
+    print(f"[PIPELINE] Processed {final_filename} in {time.time() - start:.2f}s")
+    # The face pre-check was only needed within this job
+    face_precheck.remove_sidecar(output_paths[0])
+    return result, output_paths
+
+HANDLERS = {
+    'esrgan': handle_esrgan_request,
+    'gfpgan': handle_gfpgan_request,
+    'pipeline': handle_pipeline_request,
+}
+
+def run_request(kind, process_file, on_complete=None):
+    """Run one request and signal its completion once its outputs are on disk.
+
+    Results are encoded in the background, so the handler returns while they
+    are still being written. Removing the request file is what tells the
+    frontend the output is ready, so it, the job's metrics and on_complete()
+    all wait for those writes; a failed write is recorded as an error.
+    """
+    tag = kind.upper()
+    queued_at = job_started(kind, process_file)
+
+    def finish(result, outputs=()):
+        restoration_worker.untrack_request(process_file)
+        restoration_worker.discard_previews(outputs)
+        # Remove the process file to signal completion
+        try:
+            os.remove(process_file)
+            print(f"[{tag}] Removed process file: {process_file}")
+        except FileNotFoundError:
+            # The frontend timed out and withdrew the job (its outputs were left alone)
+            print(f"[{tag}] {os.path.basename(process_file)} was withdrawn before it finished")
+            if result != 'error':
+                result = 'abandoned'
+        except OSError as e:
+            print(f"[{tag}] Could not remove process file {process_file}: {e}")
+        job_finished(kind, queued_at, result)
+        if on_complete is not None:
+            on_complete()
+
+    if not os.path.exists(process_file):
+        # Withdrawn while it waited for a worker
+        finish('abandoned')
+        return
+    try:
+        result, outputs = HANDLERS[kind](process_file)
+    except Exception as e:
+        print(f"[{tag}] Error processing {process_file}: {e}")
+        import traceback
+        traceback.print_exc()
+        finish('error')
+        return
+
+    def written(error):
+        if error is not None:
+            print(f"[{tag}] Could not write the output of {os.path.basename(process_file)}: {error}")
+        finish('error' if error is not None else result, outputs)
+
+    restoration_worker.when_written(outputs, written)
+
+def partition_cores(n_workers):
+    """Split the CPUs this process may use into n disjoint, contiguous sets"""
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    n_workers = max(1, min(n_workers, len(cores)))
+    size, extra = divmod(len(cores), n_workers)
+    core_sets = []
+    start = 0
+    for i in range(n_workers):
+        end = start + size + (1 if i < extra else 0)
+        core_sets.append(cores[start:end])
+        start = end
+    return core_sets
+
+def worker_main(worker_id, cores, n_workers, job_queue, event_queue):
+    """Worker process: pin to its cores, load the models once and serve jobs from the shared queue"""
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    restoration_worker.configure_worker(num_threads=len(cores), memory_share=1.0 / n_workers)
+    print(f"[Worker {worker_id}] pid {os.getpid()} on cores {cores[0]}-{cores[-1]} ({len(cores)} threads)")
+    metrics.start_publisher(worker_id)
+    restoration_worker.warm_up()
+
+    def serve():
+        while True:
+            kind, process_file = job_queue.get()
+            event_queue.put(('started', worker_id, process_file))
+
+            # Sent once the job's outputs are written, which may be after the next job has started
+            def complete(process_file=process_file):
+                event_queue.put(('done', worker_id, process_file))
+
+            try:
+                run_request(kind, process_file, complete)
+            except Exception as e:
+                print(f"[Worker {worker_id}] Error running {process_file}: {e}")
+                complete()
+
+    threads = [threading.Thread(target=serve, name=f'job-{i}', daemon=True) for i in range(CONCURRENT_JOBS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+class ThreadWorkerPool:
+    """Runs jobs on threads of this process, sharing one copy of the models"""
+
+    def __init__(self, on_done):
+        self.on_done = on_done
+        self.executor = ThreadPoolExecutor(max_workers=CONCURRENT_JOBS, thread_name_prefix='job')
+        metrics.start_publisher('main')
+        restoration_worker.warm_up()
+
+    def submit(self, kind, process_file):
+        def run():
+            try:
+                run_request(kind, process_file, lambda: self.on_done(process_file))
+            except Exception as e:
+                print(f"[Worker] Error running {process_file}: {e}")
+                self.on_done(process_file)
+
+        self.executor.submit(run)
+
+    def check(self):
+        pass
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+class ProcessWorkerPool:
+    """N worker processes on disjoint core sets, all pulling from one job queue.
+
+    Each worker sets torch's intra-op thread count to the size of its core set,
+    so the workers together use every core once instead of oversubscribing.
+    A worker that dies is replaced, and the jobs it held are released so the
+    next scan hands them out again.
+    """
+
+    def __init__(self, n_workers, on_done):
+        self.on_done = on_done
+        self.context = multiprocessing.get_context('spawn')
+        self.job_queue = self.context.Queue()
+        self.event_queue = self.context.Queue()
+        self.core_sets = partition_cores(n_workers)
+        self.processes = {}
+        self.assigned = {}
+        self.lock = threading.Lock()
+        for worker_id in range(len(self.core_sets)):
+            self._spawn(worker_id)
+        threading.Thread(target=self._collect_events, name='worker-events', daemon=True).start()
+
+    def _spawn(self, worker_id):
+        process = self.context.Process(
+            target=worker_main,
+            args=(worker_id, self.core_sets[worker_id], len(self.core_sets), self.job_queue, self.event_queue),
+            name=f'worker-{worker_id}',
+            daemon=True
+        )
+        process.start()
+        self.processes[worker_id] = process
+
+    def _collect_events(self):
+        while True:
+            event, worker_id, process_file = self.event_queue.get()
+            with self.lock:
+                if event == 'started':
+                    self.assigned[process_file] = worker_id
+                    continue
+                self.assigned.pop(process_file, None)
+            self.on_done(process_file)
+
+    def submit(self, kind, process_file):
+        self.job_queue.put((kind, process_file))
+
+    def check(self):
+        """Replace dead workers and release the jobs they were holding"""
+        for worker_id, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            print(f"[Worker {worker_id}] exited with code {process.exitcode}, restarting")
+            with self.lock:
+                lost = [f for f, owner in self.assigned.items() if owner == worker_id]
+                for process_file in lost:
+                    del self.assigned[process_file]
+            for process_file in lost:
+                self.on_done(process_file)
+            self._spawn(worker_id)
+
+    def shutdown(self):
+        for process in self.processes.values():
+            process.terminate()
 
 def watch_and_process():
     """Watch for processing requests and handle them"""
@@ -9,117 +317,58 @@ def watch_and_process():
     print("Watching directories:")
     print(f"  - Inputs: /app/inputs")
     print(f"  - Outputs: /app/outputs/frontend")
-    
+
+    watcher = DirectoryWatcher(['/app/inputs', '/app/outputs/frontend'])
+    print(f"Job notifications: {watcher.mode}")
+    print(f"Worker processes: {WORKER_PROCESSES}, concurrent jobs per worker: {CONCURRENT_JOBS}")
+
+    # Request files stay on disk until their job finishes; don't submit them twice
+    in_flight = set()
+    in_flight_lock = threading.Lock()
+
+    def release(process_file):
+        with in_flight_lock:
+            in_flight.discard(process_file)
+
+    if WORKER_PROCESSES > 1:
+        pool = ProcessWorkerPool(WORKER_PROCESSES, release)
+    else:
+        pool = ThreadWorkerPool(release)
+
+    def dispatch(kind, process_file):
+        with in_flight_lock:
+            if process_file in in_flight:
+                return False
+            in_flight.add(process_file)
+        pool.submit(kind, process_file)
+        return True
+
     while True:
         try:
+            pool.check()
+
             # Check for Real-ESRGAN only processing requests
-            esrgan_files = glob.glob('/app/inputs/*.process_esrgan')
-            for process_file in esrgan_files:
-                try:
-                    # Extract filename
-                    base_process_file = os.path.basename(process_file)
-                    input_filename = base_process_file.replace('.process_esrgan', '')
-                    output_filename = f"esrgan_{input_filename}"
-                    
-                    print(f"[ESRGAN] Processing Real-ESRGAN for: {input_filename}")
-                    
-                    # Run Real-ESRGAN processing
-                    result = subprocess.run([
-                        'python', '/app/frontend/process_realesrgan_only.py', 
-                        input_filename, 
-                        output_filename
-                    ], capture_output=True, text=True, timeout=600)
-                    
-                    if result.returncode == 0:
-                        print(f"[ESRGAN] Real-ESRGAN processing successful: {output_filename}")
-                        print(f"[ESRGAN] STDOUT:\n{result.stdout}")
-                    else:
-                        print(f"[ESRGAN] Real-ESRGAN processing failed: {result.stderr}")
-                        print(f"[ESRGAN] STDOUT:\n{result.stdout}")
-                    
-                    # Remove the process file to signal completion
-                    os.remove(process_file)
-                    print(f"[ESRGAN] Removed process file: {process_file}")
-                    
-                except Exception as e:
-                    print(f"[ESRGAN] Error processing {process_file}: {e}")
-                    # Remove process file even if processing failed
-                    try:
-                        os.remove(process_file)
-                    except:
-                        pass
+            for process_file in glob.glob('/app/inputs/*.process_esrgan'):
+                dispatch('esrgan', process_file)
+
+            # Check for fused Real-ESRGAN + GFPGAN requests
+            for process_file in glob.glob('/app/inputs/*.process_pipeline'):
+                dispatch('pipeline', process_file)
 
             # Check for GFPGAN processing requests - FIXED PATH
             gfpgan_files = glob.glob('/app/outputs/frontend/*.process_gfpgan')
-            
-            if gfpgan_files:
-                print(f"[GFPGAN] Found {len(gfpgan_files)} GFPGAN processing requests")
-            
-            for process_file in gfpgan_files:
-                try:
-                    # Extract filename
-                    base_process_file = os.path.basename(process_file)
-                    input_filename = base_process_file.replace('.process_gfpgan', '')
-                    
-                    print(f"[GFPGAN] Found process file: {process_file}")
-                    print(f"[GFPGAN] Input filename: {input_filename}")
-                    
-                    # Generate output filename
-                    if input_filename.startswith('esrgan_'):
-                        base_name = input_filename.replace('esrgan_', '')
-                        output_filename = f"final_enhanced_{base_name}"
-                    else:
-                        output_filename = f"final_enhanced_{input_filename}"
-                    
-                    print(f"[GFPGAN] Processing GFPGAN for: {input_filename} -> {output_filename}")
-                    
-                    # Verify input file exists
-                    input_path = f'/app/outputs/frontend/{input_filename}'
-                    if not os.path.exists(input_path):
-                        print(f"[GFPGAN] ERROR: Input file not found: {input_path}")
-                        # List files in directory for debugging
-                        print(f"[GFPGAN] Files in /app/outputs/frontend/:")
-                        for f in os.listdir('/app/outputs/frontend'):
-                            print(f"  - {f}")
-                        os.remove(process_file)
-                        continue
-                    
-                    print(f"[GFPGAN] Input file exists: {input_path}")
-                    
-                    # Run GFPGAN processing
-                    result = subprocess.run([
-                        'python', '/app/frontend/process_gfpgan_only.py', 
-                        input_filename, 
-                        output_filename
-                    ], capture_output=True, text=True, timeout=300)
-                    
-                    if result.returncode == 0:
-                        print(f"[GFPGAN] GFPGAN processing successful: {output_filename}")
-                        print(f"[GFPGAN] STDOUT:\n{result.stdout}")
-                    else:
-                        print(f"[GFPGAN] GFPGAN processing failed!")
-                        print(f"[GFPGAN] STDERR:\n{result.stderr}")
-                        print(f"[GFPGAN] STDOUT:\n{result.stdout}")
-                    
-                    # Remove the process file to signal completion
-                    os.remove(process_file)
-                    print(f"[GFPGAN] Removed process file: {process_file}")
-                    
-                except Exception as e:
-                    print(f"[GFPGAN] Error processing {process_file}: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    # Remove process file even if processing failed
-                    try:
-                        os.remove(process_file)
-                    except:
-                        pass
-            
-            # Sleep before checking again
-            time.sleep(2)
-            
+            queued = sum(dispatch('gfpgan', f) for f in gfpgan_files)
+
+            if queued:
+                print(f"[GFPGAN] Found {queued} new GFPGAN processing requests")
+
+            # Sleep until a request file shows up (or the rescan interval passes)
+            watcher.wait(RESCAN_INTERVAL)
+
         except KeyboardInterrupt:
             print("Processing watcher stopped")
+            watcher.close()
+            pool.shutdown()
             break
         except Exception as e:
             print(f"Unexpected error: {e}")
@@ -132,13 +381,15 @@ if __name__ == "__main__":
     os.makedirs('/app/inputs', exist_ok=True)
     os.makedirs('/app/outputs', exist_ok=True)
     os.makedirs('/app/outputs/frontend', exist_ok=True)
-    
+
     print("=" * 60)
     print("Image Processing Watcher Started")
     print("=" * 60)
     print("Monitoring:")
     print("  1. /app/inputs/*.process_esrgan -> Real-ESRGAN processing")
     print("  2. /app/outputs/frontend/*.process_gfpgan -> GFPGAN processing")
+    print("  3. /app/inputs/*.process_pipeline -> Real-ESRGAN + GFPGAN in one pass")
     print("=" * 60)
-    
-    watch_and_process()
\ No newline at end of file
+
+    # Models are loaded once per worker; every job is served from memory
+    watch_and_process()
@@ -0,0 +1,151 @@
+# Export Real-ESRGAN and GFPGAN to TorchScript and ONNX for the exported-graph backends
+#
+# Writes <export dir>/<model>.ts and <model>.onnx next to a .json with the
+# source checksum and the largest difference from eager PyTorch on a test
+# input. The worker picks them up with INFERENCE_BACKEND=torchscript|onnx:
+#
+#   python /app/frontend/export_models.py --backends torchscript,onnx
+
+import os
+import sys
+import json
+import inspect
+import argparse
+import numpy as np
+import torch
+import inference_backends
+from inference_backends import FaceGenerator, export_path, metadata_path, open_graph
+from result_cache import model_checksum
+
+EXPORT_BACKENDS = ('torchscript', 'onnx')
+ONNX_OPSET = 17
+
+# Traced at this tile size; height, width and batch stay dynamic for Real-ESRGAN
+ESRGAN_EXAMPLE_SIZE = 64
+# GFPGAN works on aligned 512x512 crops, one per call (see FaceGraph)
+GFPGAN_EXAMPLE_SIZE = 512
+
+def float32_graph(path):
+    """Rewrite everything typed float64 in an exported ONNX file to float32.
+
+    The TorchScript-based exporter types `new_empty(...).normal_()` (StyleGAN2's
+    noise injection in GFPGAN) as float64, which leaves Conv and Add nodes with
+    mixed input types that ONNX Runtime refuses to load.
+    """
+    import onnx
+    from onnx import numpy_helper, TensorProto
+    model = onnx.load(path)
+    changed = False
+    for node in model.graph.node:
+        for attr in node.attribute:
+            if node.op_type == 'Cast' and attr.name == 'to' and attr.i == TensorProto.DOUBLE:
+                attr.i = TensorProto.FLOAT
+                changed = True
+            elif attr.type == onnx.AttributeProto.TENSOR and attr.t.data_type == TensorProto.DOUBLE:
+                value = numpy_helper.to_array(attr.t).astype(np.float32)
+                attr.t.CopyFrom(numpy_helper.from_array(value, attr.t.name))
+                changed = True
+    for value in list(model.graph.value_info) + list(model.graph.output):
+        if value.type.tensor_type.elem_type == TensorProto.DOUBLE:
+            value.type.tensor_type.elem_type = TensorProto.FLOAT
+            changed = True
+    for initializer in model.graph.initializer:
+        if initializer.data_type == TensorProto.DOUBLE:
+            value = numpy_helper.to_array(initializer).astype(np.float32)
+            initializer.CopyFrom(numpy_helper.from_array(value, initializer.name))
+            changed = True
+    if changed:
+        onnx.save(model, path)
+
+def export_graph(model, example, backend, path, dynamic_axes=None):
+    """Trace `model` on `example` and save it as a TorchScript or ONNX file at path"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with torch.no_grad():
+        if backend == 'torchscript':
+            # check_trace would re-run the model and trip over GFPGAN's random noise
+            traced = torch.jit.freeze(torch.jit.trace(model, example, check_trace=False))
+            torch.jit.save(traced, tmp_path)
+        elif backend == 'onnx':
+            # Newer torch defaults to the dynamo exporter, which needs onnxscript
+            legacy = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+            torch.onnx.export(model, (example,), tmp_path, input_names=['input'], output_names=['output'],
+                              dynamic_axes=dynamic_axes, opset_version=ONNX_OPSET, **legacy)
+            float32_graph(tmp_path)
+        else:
+            raise ValueError(f"Unknown backend: {backend}")
+    os.replace(tmp_path, path)
+    return path
+
+def max_abs_diff(model, graph, example):
+    """Largest difference between eager and exported outputs (same seed for both)"""
+    with torch.no_grad():
+        torch.manual_seed(0)
+        expected = model(example)
+        torch.manual_seed(0)
+        actual = graph(example)
+    return float((expected - actual.to(expected.device)).abs().max())
+
+def export_model(model, example, backend, path, source_model_path=None, dynamic_axes=None):
+    """Export, reload and check one model; writes the .json metadata and returns it"""
+    export_graph(model, example, backend, path, dynamic_axes)
+    graph = open_graph(backend, path, example.device)
+    metadata = {
+        'backend': backend,
+        'source_checksum': model_checksum(source_model_path) if source_model_path else None,
+        'input_shape': list(example.shape),
+        'max_abs_diff': max_abs_diff(model, graph, example),
+        'torch': torch.__version__,
+    }
+    with open(metadata_path(path), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
+
+def esrgan_example():
+    return torch.rand(1, 3, ESRGAN_EXAMPLE_SIZE, ESRGAN_EXAMPLE_SIZE)
+
+def esrgan_dynamic_axes():
+    return {'input': {0: 'batch', 2: 'height', 3: 'width'}, 'output': {0: 'batch', 2: 'height', 3: 'width'}}
+
+def gfpgan_example():
+    return torch.rand(1, 3, GFPGAN_EXAMPLE_SIZE, GFPGAN_EXAMPLE_SIZE) * 2 - 1
+
+def main(argv=None):
+    import restoration_worker
+
+    parser = argparse.ArgumentParser(description='Export Real-ESRGAN and GFPGAN graphs for the worker')
+    parser.add_argument('--backends', default=','.join(EXPORT_BACKENDS), type=lambda v: v.split(','),
+                        help=f"comma-separated subset of: {', '.join(EXPORT_BACKENDS)}")
+    parser.add_argument('--models', default='esrgan,gfpgan', type=lambda v: v.split(','),
+                        help='comma-separated subset of: esrgan, gfpgan')
+    parser.add_argument('--output-dir', default=inference_backends.EXPORT_DIR)
+    args = parser.parse_args(argv)
+    unknown = set(args.backends) - set(EXPORT_BACKENDS)
+    if unknown:
+        parser.error(f"unknown backends: {', '.join(sorted(unknown))}")
+
+    # Export on CPU from the same eager modules the worker would run
+    device = torch.device('cpu')
+    exports = []
+    if 'esrgan' in args.models:
+        exports.append((restoration_worker.build_esrgan_model(device), esrgan_example(),
+                        restoration_worker.REALESRGAN_MODEL_PATH, esrgan_dynamic_axes()))
+    if 'gfpgan' in args.models:
+        restorer = restoration_worker.build_face_restorer(device)
+        exports.append((FaceGenerator(restorer.gfpgan).eval(), gfpgan_example(),
+                        restoration_worker.GFPGAN_MODEL_PATH, None))
+
+    failed = 0
+    for model, example, model_path, dynamic_axes in exports:
+        for backend in args.backends:
+            path = export_path(model_path, backend, args.output_dir)
+            try:
+                metadata = export_model(model, example, backend, path, model_path, dynamic_axes)
+                print(f"[Export] {path} (max abs diff vs eager {metadata['max_abs_diff']:.2e})")
+            except Exception as e:
+                print(f"[Export] Failed {os.path.basename(path)}: {e}")
+                failed += 1
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+import os
+import json
+import cv2
+
+# Set to 0 to always run GFPGAN's own detector over the whole image
+FACE_PRECHECK = os.environ.get('FACE_PRECHECK', '1') != '0'
+
+# Detection runs on a copy no larger than this on its long side
+DETECT_MAX_SIDE = 1024
+# Conservative settings: a missed face skips restoration, a false one only costs time
+MIN_NEIGHBORS = 3
+MIN_FACE_SIZE = 16
+# Context kept around each detected face, as a multiple of its size on every side;
+# GFPGAN's aligned crop reaches about this far past the face box
+REGION_MARGIN = 1.0
+# Above this share of the image, running on the whole image is simpler and no slower
+MAX_REGION_SHARE = 0.5
+
+SIDECAR_SUFFIX = '.faces.json'
+
+_cascades = None
+
+def get_cascades():
+    global _cascades
+    if _cascades is None:
+        if not hasattr(cv2, 'CascadeClassifier'):
+            raise RuntimeError("this OpenCV build has no Haar cascade support")
+        _cascades = [cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, name))
+                     for name in ('haarcascade_frontalface_default.xml', 'haarcascade_profileface.xml')]
+    return _cascades
+
+def detect_faces(img, channel_order='bgr'):
+    """Face boxes (x, y, w, h) in img's pixel coordinates, from Haar cascades on a reduced copy"""
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY if channel_order == 'rgb' else cv2.COLOR_BGR2GRAY)
+    height, width = img.shape[:2]
+    factor = min(1.0, DETECT_MAX_SIDE / max(height, width))
+    if factor < 1.0:
+        img = cv2.resize(img, (round(width * factor), round(height * factor)), interpolation=cv2.INTER_AREA)
+    img = cv2.equalizeHist(img)
+
+    faces = []
+    for cascade in get_cascades():
+        # Profile cascade only knows left-facing profiles; mirror for the other side
+        for flipped in (False, True):
+            source = cv2.flip(img, 1) if flipped else img
+            found = cascade.detectMultiScale(source, scaleFactor=1.1, minNeighbors=MIN_NEIGHBORS,
+                                             minSize=(MIN_FACE_SIZE, MIN_FACE_SIZE))
+            for x, y, w, h in found:
+                if flipped:
+                    x = source.shape[1] - x - w
+                faces.append([int(x / factor), int(y / factor), int(w / factor), int(h / factor)])
+    return faces
+
+def sidecar_path(image_path):
+    return image_path + SIDECAR_SUFFIX
+
+def write_sidecar(image_path, faces, size):
+    """Store the pre-check result next to image_path; size is the (width, height) the boxes refer to"""
+    precheck = {'detector': 'haar', 'width': size[0], 'height': size[1], 'faces': faces}
+    path = sidecar_path(image_path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(precheck, f)
+    os.replace(tmp_path, path)
+    return precheck
+
+def remove_sidecar(image_path):
+    """Delete the pre-check result stored for image_path, if any"""
+    try:
+        os.remove(sidecar_path(image_path))
+    except FileNotFoundError:
+        pass
+
+def read_sidecar(image_path):
+    """Pre-check result stored for image_path, or None if there is none"""
+    try:
+        with open(sidecar_path(image_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def face_regions(precheck, width, height):
+    """Regions (x0, y0, x1, y1) of a width x height image worth running GFPGAN on.
+
+    Scales the pre-check boxes to this image, adds margin and merges
+    overlapping regions. Returns [] when there are no faces and None when the
+    regions cover so much of the image that it should be processed whole.
+    """
+    if not precheck['faces']:
+        return []
+    sx, sy = width / precheck['width'], height / precheck['height']
+    regions = []
+    for x, y, w, h in precheck['faces']:
+        mx, my = w * REGION_MARGIN, h * REGION_MARGIN
+        regions.append([max(int((x - mx) * sx), 0), max(int((y - my) * sy), 0),
+                        min(int((x + w + mx) * sx), width), min(int((y + h + my) * sy), height)])
+
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(regions)):
+            for j in range(i + 1, len(regions)):
+                a, b = regions[i], regions[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    regions[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del regions[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in regions)
+    if area > MAX_REGION_SHARE * width * height:
+        return None
+    return regions
@@ -0,0 +1,139 @@
+import os
+import cv2
+import numpy as np
+import torch
+from basicsr.utils import img2tensor, tensor2img
+from facexlib.utils.face_restoration_helper import get_center_face
+from torchvision.transforms.functional import normalize
+import tile_tuning
+
+# Faces are detected on a copy shrunk by this factor and the landmarks scaled
+# back up; 0.25 undoes Real-ESRGAN's 4x, 1 detects at full resolution
+FACE_DETECT_SCALE = float(os.environ.get('FACE_DETECT_SCALE', '0.25'))
+# ...but the detection copy is never shrunk below this on its short side
+FACE_DETECT_MIN_SIDE = 512
+
+# Same threshold GFPGANer.enhance uses, in full-resolution pixels
+EYE_DIST_THRESHOLD = 5
+# RetinaFace confidence facexlib's get_face_landmarks_5 uses
+DETECT_CONFIDENCE = 0.97
+
+# Aligned face crops restored per GFPGAN forward pass: 'auto' sizes batches
+# from free memory, a number fixes it (1 restores faces one at a time)
+GFPGAN_BATCH_SIZE = os.environ.get('GFPGAN_BATCH_SIZE', 'auto')
+GFPGAN_MAX_BATCH = 8
+# Peak memory of one 512x512 crop in a GFPGANv1Clean forward pass (~600 MiB measured on CPU)
+BYTES_PER_FACE = 768 * 1024 ** 2
+
+def make_proxy(img, scale=FACE_DETECT_SCALE, low_res=None):
+    """Smaller copy of img to detect faces on, or None to detect on img itself.
+
+    low_res is the same picture at a lower resolution that is already at hand
+    (the upload Real-ESRGAN started from); it is used as is when it has at
+    least the proxy's resolution.
+    """
+    height, width = img.shape[:2]
+    scale = max(scale, min(1.0, FACE_DETECT_MIN_SIDE / min(height, width)))
+    if scale >= 1.0:
+        return None
+    if low_res is not None and low_res.shape[0] >= round(height * scale):
+        return low_res
+    size = (max(round(width * scale), 1), max(round(height * scale), 1))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+def detect_landmarks(face_helper, proxy, only_center_face=False):
+    """Fill face_helper's landmarks for its input image from detections on `proxy`.
+
+    proxy is the same picture at a lower resolution (a downscaled copy, or the
+    upload Real-ESRGAN started from); boxes and landmarks are scaled to the
+    input image before the eye-distance filter, alignment and paste-back, so
+    the rest of GFPGAN runs exactly as if detection had been done full size.
+    """
+    height, width = face_helper.input_img.shape[:2]
+    sx, sy = width / proxy.shape[1], height / proxy.shape[0]
+    with torch.no_grad():
+        bboxes = face_helper.face_det.detect_faces(proxy, DETECT_CONFIDENCE)
+    for bbox in bboxes:
+        bbox = np.array(bbox, dtype=np.float32)
+        bbox[[0, 2, 5, 7, 9, 11, 13]] *= sx
+        bbox[[1, 3, 6, 8, 10, 12, 14]] *= sy
+        eye_dist = np.linalg.norm([bbox[5] - bbox[7], bbox[6] - bbox[8]])
+        if eye_dist < EYE_DIST_THRESHOLD:
+            continue
+        face_helper.all_landmarks_5.append(np.array([[bbox[i], bbox[i + 1]] for i in range(5, 15, 2)]))
+        face_helper.det_faces.append(bbox[0:5])
+    if only_center_face and face_helper.det_faces:
+        face_helper.det_faces, center_idx = get_center_face(face_helper.det_faces, height, width)
+        face_helper.all_landmarks_5 = [face_helper.all_landmarks_5[center_idx]]
+    return len(face_helper.all_landmarks_5)
+
+def face_batch_size(count, device):
+    """Crops per forward pass for `count` faces, from GFPGAN_BATCH_SIZE or free memory"""
+    if GFPGAN_BATCH_SIZE != 'auto':
+        return max(1, min(int(GFPGAN_BATCH_SIZE), count))
+    if device.type == 'cuda':
+        free = torch.cuda.mem_get_info(device)[0]
+    else:
+        free = tile_tuning.available_memory()
+    return max(1, min(int(free * tile_tuning.MEMORY_FRACTION // BYTES_PER_FACE), GFPGAN_MAX_BATCH, count))
+
+def _crop_tensor(cropped_face):
+    cropped_face_t = img2tensor(cropped_face / 255., bgr2rgb=True, float32=True)
+    normalize(cropped_face_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+    return cropped_face_t
+
+def restore_crops(restorer, crops, weight):
+    """Run GFPGAN on aligned 512x512 BGR face crops, several per forward pass.
+
+    Crops are stacked into batches of face_batch_size(); a batch that runs out
+    of memory is split in half and retried. Each restored face is converted and
+    returned in crop order, so paste-back is unchanged. A crop that fails on
+    its own is kept as is, like GFPGANer does.
+    """
+    restored = []
+    batch_size = face_batch_size(len(crops), restorer.device)
+    start = 0
+    while start < len(crops):
+        batch = crops[start:start + batch_size]
+        faces_t = torch.stack([_crop_tensor(face) for face in batch]).to(restorer.device)
+        try:
+            with torch.no_grad():
+                output = restorer.gfpgan(faces_t, return_rgb=False, weight=weight)[0]
+            outputs = [tensor2img(face, rgb2bgr=True, min_max=(-1, 1)) for face in output]
+        except RuntimeError as error:
+            if len(batch) > 1:
+                if tile_tuning.is_out_of_memory(error):
+                    batch_size = max(len(batch) // 2, 1)
+                    print(f"[Faces] Out of memory with {len(batch)} faces per pass, retrying with {batch_size}")
+                else:
+                    batch_size = 1
+                continue
+            print(f"\tFailed inference for GFPGAN: {error}.")
+            outputs = list(batch)
+        restored.extend(face.astype('uint8') for face in outputs)
+        start += len(batch)
+    return restored
+
+def enhance(restorer, img, weight=0.5, only_center_face=False, low_res=None):
+    """GFPGANer.enhance(img, paste_back=True) with detection on a low-resolution proxy.
+
+    The proxy is `low_res` or a copy of img shrunk by FACE_DETECT_SCALE (see
+    make_proxy); small images are detected full size as before. Returns
+    (cropped_faces, restored_faces, restored_img) like GFPGANer.
+    """
+    face_helper = restorer.face_helper
+    face_helper.clean_all()
+    face_helper.read_image(img)
+    proxy = make_proxy(face_helper.input_img, low_res=low_res)
+    if proxy is None:
+        face_helper.get_face_landmarks_5(only_center_face=only_center_face, eye_dist_threshold=EYE_DIST_THRESHOLD)
+    else:
+        detect_landmarks(face_helper, proxy, only_center_face)
+    face_helper.align_warp_face()
+
+    for restored_face in restore_crops(restorer, face_helper.cropped_faces, weight):
+        face_helper.add_restored_face(restored_face)
+
+    face_helper.get_inverse_affine(None)
+    restored_img = face_helper.paste_faces_to_input_image(upsample_img=None)
+    return face_helper.cropped_faces, face_helper.restored_faces, restored_img
@@ -1,9 +1,16 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory, send_file, abort
 import os
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
 from PIL import Image
-import subprocess
-import time
+import json
+import uuid
+import shutil
+from jobs import JobManager, DONE
+from result_cache import file_digest
+import output_format
+import metrics
+import derivatives
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key'
@@ -14,95 +21,144 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-def process_with_realesrgan_only(input_filename):
-    """Process image using only RealESRGAN model"""
-    try:
-        # Create a .process_esrgan file to signal the esrgan container for Real-ESRGAN only
-        process_file = os.path.join(UPLOAD_FOLDER, f"{input_filename}.process_esrgan")
-        with open(process_file, 'w') as f:
-            f.write("process_esrgan_only")
-        
-        output_filename = f"esrgan_{input_filename}"
-        output_path = os.path.join(OUTPUT_FOLDER, output_filename)
-        
-        # Wait for processing to complete (check if output exists and .process file is gone)
-        max_wait = 600  # 10 minutes timeout (reduced from 15)
-        wait_time = 0
-        
-        while wait_time < max_wait:
-            if os.path.exists(output_path) and not os.path.exists(process_file):
-                print("Real-ESRGAN processing completed successfully")
-                return output_filename
-            time.sleep(2)
-            wait_time += 2
-        
-        print("Real-ESRGAN processing timed out")
-        # Clean up process file if it still exists
-        if os.path.exists(process_file):
-            os.remove(process_file)
-        return None
-            
-    except Exception as e:
-        print(f"Error: {e}")
+# Longest a single /jobs/<id>/wait request may block before returning the current status
+MAX_LONG_POLL = 60
+
+# Cache-Control max-age for images and downloads; with the default of 0 browsers
+# revalidate every time and get a 304 from the ETag/Last-Modified check
+STATIC_MAX_AGE = int(os.environ.get('STATIC_MAX_AGE', '0'))
+
+jobs = JobManager([UPLOAD_FOLDER, OUTPUT_FOLDER])
+
+def preview_path_for(output_path):
+    """Where the worker saves its quick low-resolution Real-ESRGAN preview of output_path"""
+    return f"{output_path}.preview.jpg"
+
+def sidecar_path_for(output_path):
+    """Where the worker stores the face pre-check of a Real-ESRGAN result"""
+    return f"{output_path}.faces.json"
+
+def process_with_realesrgan_only(input_filename, original_size_mb, encoding=None):
+    """Queue a Real-ESRGAN only job and return it without waiting"""
+    input_path = os.path.join(UPLOAD_FOLDER, input_filename)
+    output_filename = output_format.output_filename(f"esrgan_{input_filename}", encoding)
+    output_path = os.path.join(OUTPUT_FOLDER, output_filename)
+    process_file = os.path.join(UPLOAD_FOLDER, f"{input_filename}.process_esrgan")
+
+    def fallback():
+        # Fallback to copying if processing fails (converted if another format was asked for)
+        print("Real-ESRGAN processing failed, using fallback")
+        if output_format.format_of(input_path) == output_format.format_of(output_path):
+            shutil.copy(input_path, output_path)
+        else:
+            with Image.open(input_path) as img:
+                img.convert('RGB').save(output_path)
+
+    job = jobs.submit(
+        'esrgan', process_file, output_path,
+        timeout=600,  # 10 minutes timeout
+        fallback=fallback,
+        preview_path=preview_path_for(output_path),
+        # Kept for the results page and a later GFPGAN job
+        scratch=[sidecar_path_for(output_path)],
+        # The .process_esrgan file signals the esrgan container for Real-ESRGAN only
+        request={'mode': 'process_esrgan_only', 'output': encoding or {}},
+        original_filename=input_filename,
+        original_size_mb=original_size_mb
+    )
+    print(f"Queued Real-ESRGAN job {job.id} for {input_filename}")
+    return job
+
+def process_with_pipeline(input_filename, original_size_mb, encoding=None):
+    """Queue Real-ESRGAN and GFPGAN as one fused job and return it without waiting"""
+    esrgan_filename = output_format.output_filename(f"esrgan_{input_filename}", encoding)
+    final_filename = output_format.output_filename(f"final_enhanced_{input_filename}", encoding)
+    process_file = os.path.join(UPLOAD_FOLDER, f"{input_filename}.process_pipeline")
+
+    job = jobs.submit(
+        'pipeline', process_file, os.path.join(OUTPUT_FOLDER, final_filename),
+        timeout=900,  # 15 minutes timeout for both stages
+        preview_path=preview_path_for(os.path.join(OUTPUT_FOLDER, esrgan_filename)),
+        # The worker removes it when the job ends; this catches jobs it never finished
+        scratch=[sidecar_path_for(os.path.join(OUTPUT_FOLDER, esrgan_filename))],
+        # The intermediate Real-ESRGAN result is still written for the comparison page
+        request={'mode': 'process_pipeline', 'write_intermediate': True, 'output': encoding or {}},
+        original_filename=input_filename,
+        original_size_mb=original_size_mb,
+        esrgan_filename=esrgan_filename
+    )
+    print(f"Queued Real-ESRGAN + GFPGAN job {job.id} for {input_filename}")
+    return job
+
+def process_with_gfpgan(input_filename, encoding=None):
+    """Queue a GFPGAN job for an already Real-ESRGAN enhanced image, or None if the input is missing"""
+    # Verify input file exists first
+    input_path = os.path.join(OUTPUT_FOLDER, input_filename)
+    if not os.path.exists(input_path):
+        print(f"[GFPGAN] ERROR: Input file does not exist: {input_path}")
+        print(f"[GFPGAN] Files in output folder:")
+        for f in os.listdir(OUTPUT_FOLDER):
+            print(f"  - {f}")
         return None
 
-def process_with_gfpgan(input_filename):
-    """Process already Real-ESRGAN enhanced image with GFPGAN"""
+    # Output will be the final enhanced version
+    base_name = input_filename.replace("esrgan_", "")
+    output_filename = output_format.output_filename(f"final_enhanced_{base_name}", encoding)
+    output_path = os.path.join(OUTPUT_FOLDER, output_filename)
+    process_file = os.path.join(OUTPUT_FOLDER, f"{input_filename}.process_gfpgan")
+    # Results in another format than the upload carry an extra extension (photo.jpg.webp)
+    original_filename = output_format.source_name(base_name)
+    if not os.path.exists(os.path.join(UPLOAD_FOLDER, original_filename)):
+        original_filename = base_name
+
+    job = jobs.submit(
+        'gfpgan', process_file, output_path,
+        timeout=600,  # 10 minutes timeout
+        # The .process_gfpgan file signals GFPGAN processing
+        request={'mode': 'process_gfpgan', 'output': encoding or {}},
+        original_filename=original_filename,
+        esrgan_filename=input_filename
+    )
+    print(f"[GFPGAN] Created process file: {process_file} (job {job.id})")
+    return job
+
+def job_response(job, status_code=200):
+    """JSON status for a job, including the URLs a client needs next"""
+    data = job.to_dict()
+    data['status_url'] = url_for('job_status', job_id=job.id)
+    data['wait_url'] = url_for('job_wait', job_id=job.id)
+    data['page_url'] = url_for('job_result', job_id=job.id)
+    if job.preview_ready and not job.finished:
+        data['preview_url'] = url_for('serve_output', filename=os.path.basename(job.preview_path))
+    if job.status == DONE:
+        data['result_url'] = url_for('serve_output', filename=job.output_filename)
+        data['display_url'] = display_url('serve_output', job.output_filename)
+        data['download_url'] = url_for('download_file', filename=job.output_filename)
+    return jsonify(data), status_code
+
+def encoding_options(data):
+    """Output encoding a request asked for (output_format, jpeg_quality, png_compression); raises ValueError"""
     try:
-        # Verify input file exists first
-        input_path = os.path.join(OUTPUT_FOLDER, input_filename)
-        if not os.path.exists(input_path):
-            print(f"[GFPGAN] ERROR: Input file does not exist: {input_path}")
-            print(f"[GFPGAN] Files in output folder:")
-            for f in os.listdir(OUTPUT_FOLDER):
-                print(f"  - {f}")
-            return None
-        
-        # Create a .process_gfpgan file to signal GFPGAN processing
-        process_file = os.path.join(OUTPUT_FOLDER, f"{input_filename}.process_gfpgan")
-        with open(process_file, 'w') as f:
-            f.write("process_gfpgan")
-        
-        print(f"[GFPGAN] Created process file: {process_file}")
-        
-        # Output will be the final enhanced version
-        base_name = input_filename.replace("esrgan_", "")
-        output_filename = f"final_enhanced_{base_name}"
-        output_path = os.path.join(OUTPUT_FOLDER, output_filename)
-        
-        print(f"[GFPGAN] Waiting for output: {output_path}")
-        
-        # Wait for GFPGAN processing to complete
-        max_wait = 600  # 10 minutes timeout (increased from 5)
-        wait_time = 0
-        
-        while wait_time < max_wait:
-            # Check if processing is complete
-            if os.path.exists(output_path) and not os.path.exists(process_file):
-                print("[GFPGAN] GFPGAN processing completed successfully")
-                return output_filename
-            
-            # Log progress every 10 seconds
-            if wait_time % 10 == 0:
-                print(f"[GFPGAN] Waiting... ({wait_time}s / {max_wait}s)")
-                print(f"[GFPGAN] Process file exists: {os.path.exists(process_file)}")
-                print(f"[GFPGAN] Output file exists: {os.path.exists(output_path)}")
-            
-            time.sleep(2)
-            wait_time += 2
-        
-        print("[GFPGAN] GFPGAN processing timed out")
-        # Clean up process file if it still exists
-        if os.path.exists(process_file):
-            os.remove(process_file)
-            print("[GFPGAN] Cleaned up process file")
-        return None
-            
-    except Exception as e:
-        print(f"[GFPGAN] Error: {e}")
-        import traceback
-        traceback.print_exc()
-        return None
+        return output_format.parse(data.get('output_format'), data.get('jpeg_quality'), data.get('png_compression'))
+    except (TypeError, ValueError) as e:
+        raise ValueError(str(e))
+
+def fit_encoding(encoding, image_path, scale):
+    """encoding for the result of scaling image_path by `scale` (PNG where WebP can't hold it)"""
+    with Image.open(image_path) as img:
+        width, height = img.size
+    fitted = output_format.fit(encoding, width * scale, height * scale)
+    if fitted != encoding:
+        print(f"A {width * scale}x{height * scale} result is too large for WebP, saving it as PNG")
+    return fitted
+
+def store_upload(file, filename):
+    """Save an upload under a content-prefixed name so different files never overwrite each other"""
+    tmp_path = os.path.join(UPLOAD_FOLDER, f".upload-{uuid.uuid4().hex}")
+    file.save(tmp_path)
+    stored_filename = f"{file_digest(tmp_path)[:12]}_{filename}"
+    os.replace(tmp_path, os.path.join(UPLOAD_FOLDER, stored_filename))
+    return stored_filename
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -311,6 +367,17 @@ def index():
                 border-radius: 4px;
             }
 
+            .job-preview {
+                display: none;
+                max-width: 600px;
+                max-height: 600px;
+            }
+
+            .job-preview-note {
+                color: #999;
+                font-size: 0.9em;
+            }
+
             .feature-grid {
                 display: grid;
                 grid-template-columns: repeat(auto-fit, minmax(200px, 1fr));
@@ -411,6 +478,20 @@ def index():
                     <div class="preview-section" id="previewSection">
                         <h3 style="margin-bottom: 20px; color: #555;">Preview</h3>
                         <img id="imagePreview" class="image-preview" src="" alt="Preview">
+                        <label class="face-option" style="display: block; margin-bottom: 15px; color: #cccccc;">
+                            <input type="checkbox" name="face_enhance" value="1">
+                            Also apply face enhancement (GFPGAN) in the same run
+                        </label>
+                        <label class="face-option" style="display: block; margin-bottom: 15px; color: #cccccc;">
+                            Save result as
+                            <select name="output_format">
+                                <option value="">same format as the upload</option>
+                                <option value="png">PNG (lossless)</option>
+                                <option value="webp">WebP (lossless, smaller)</option>
+                                <option value="jpeg">JPEG (high quality, smallest)</option>
+                                <option value="tiff">16-bit TIFF (archival)</option>
+                            </select>
+                        </label>
                         <div>
                             <button type="submit" class="process-btn" id="processBtn">
                                 🔍 Start with Super Resolution
@@ -429,6 +510,8 @@ def index():
                     <div class="progress-bar">
                         <div class="progress-fill" id="progressFill"></div>
                     </div>
+                    <img id="jobPreview" class="image-preview job-preview" src="" alt="Preview">
+                    <p id="jobPreviewNote" class="job-preview-note"></p>
                 </div>
 
                 <div class="feature-grid">
@@ -510,10 +593,11 @@ def index():
             uploadForm.addEventListener('submit', function(e) {
                 e.preventDefault();
                 
-                // Show loading
+                // Show loading, with the photo itself until the enhanced preview arrives
                 document.querySelector('.upload-section').style.display = 'none';
                 previewSection.style.display = 'none';
                 loadingSection.style.display = 'block';
+                showJobPreview(imagePreview.src, 'Your photo - a quick enhanced preview will appear here shortly');
                 
                 // Simulate progress
                 let progress = 0;
@@ -524,29 +608,59 @@ def index():
                     progressFill.style.width = progress + '%';
                 }, 500);
 
-                // Submit form
+                // Submit form; the server answers with a job ID right away
                 const formData = new FormData(this);
                 fetch('/upload', {
                     method: 'POST',
                     body: formData
-                }).then(response => {
+                }).then(response => response.json().then(job => {
+                    if (!response.ok) {
+                        throw new Error(job.error || 'Server returned ' + response.status);
+                    }
+                    return waitForJob(job);
+                })).then(job => {
                     clearInterval(progressInterval);
                     progressFill.style.width = '100%';
-                    return response.text();
-                }).then(html => {
-                    document.body.innerHTML = html;
+                    window.location.href = job.page_url;
                 }).catch(error => {
+                    clearInterval(progressInterval);
                     console.error('Error:', error);
                     alert('Upload failed. Please try again.');
                     resetForm();
                 });
             });
 
+            // Long-poll the job until it is done or failed; the first polls also
+            // return early when the worker's quick preview is ready
+            let previewShown = false;
+            function waitForJob(job) {
+                if (job.preview_url && !previewShown) {
+                    previewShown = true;
+                    showJobPreview(job.preview_url, 'Quick preview - the full resolution result will replace it when ready');
+                }
+                if (job.status === 'done') return Promise.resolve(job);
+                if (job.status === 'failed') return Promise.reject(new Error(job.error));
+                return fetch(job.wait_url + '?timeout=30' + (previewShown ? '' : '&preview=1'))
+                    .then(response => response.json())
+                    .then(waitForJob);
+            }
+
+            function showJobPreview(src, note) {
+                const jobPreview = document.getElementById('jobPreview');
+                if (!src) return;
+                jobPreview.src = src;
+                jobPreview.style.display = 'block';
+                document.getElementById('jobPreviewNote').textContent = note;
+            }
+
             function resetForm() {
                 fileInput.value = '';
                 previewSection.style.display = 'none';
                 fileInfo.style.display = 'none';
                 loadingSection.style.display = 'none';
+                document.getElementById('jobPreview').style.display = 'none';
+                document.getElementById('jobPreviewNote').textContent = '';
+                previewShown = false;
                 document.querySelector('.upload-section').style.display = 'block';
             }
         </script>
@@ -557,43 +671,89 @@ def index():
 @app.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
-        return redirect(url_for('index'))
+        return jsonify({'error': 'No file provided'}), 400
     
     file = request.files['file']
     if file.filename == '':
-        return redirect(url_for('index'))
+        return jsonify({'error': 'No file selected'}), 400
     
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
+        try:
+            encoding = encoding_options(request.form)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        filename = store_upload(file, secure_filename(file.filename))
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
-        # Process with Real-ESRGAN only first
-        print(f"Processing {filename} with Real-ESRGAN (Stage 1)...")
-        esrgan_output_filename = process_with_realesrgan_only(filename)
-        
-        if esrgan_output_filename is None:
-            print("Real-ESRGAN processing failed, using fallback")
-            # Fallback to copying if processing fails
-            import shutil
-            esrgan_output_filename = f"esrgan_{filename}"
-            output_path = os.path.join(OUTPUT_FOLDER, esrgan_output_filename)
-            shutil.copy(filepath, output_path)
-        else:
-            print(f"Real-ESRGAN processing completed: {esrgan_output_filename}")
+        try:
+            # Real-ESRGAN upscales 4x
+            encoding = fit_encoding(encoding, filepath, 4)
+        except OSError:
+            return jsonify({'error': 'Could not read the image'}), 400
         
         # Get file info
         original_size = os.path.getsize(filepath)
         original_size_mb = round(original_size / (1024 * 1024), 2)
         
-        # Show results with option for GFPGAN
-        return show_esrgan_results(filename, esrgan_output_filename, original_size_mb)
+        # Queue the job and return immediately
+        if request.form.get('face_enhance'):
+            print(f"Processing {filename} with Real-ESRGAN + GFPGAN in one pass...")
+            job = process_with_pipeline(filename, original_size_mb, encoding)
+        else:
+            print(f"Processing {filename} with Real-ESRGAN (Stage 1)...")
+            job = process_with_realesrgan_only(filename, original_size_mb, encoding)
+        return job_response(job, 202)
     
-    return redirect(url_for('index'))
+    return jsonify({'error': 'Unsupported file type'}), 400
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Current status of a job"""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return job_response(job)
+
+@app.route('/jobs/<job_id>/wait')
+def job_wait(job_id):
+    """Long-poll: return as soon as the job finishes (or, with ?preview=1, has a preview), or after ?timeout= seconds"""
+    timeout = min(request.args.get('timeout', 30, type=float), MAX_LONG_POLL)
+    job = jobs.wait(job_id, max(timeout, 0), until_preview=request.args.get('preview') == '1')
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return job_response(job)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """Results page for a finished job"""
+    job = jobs.get(job_id)
+    if job is None:
+        flash('Job not found. Please try processing your image again.', 'error')
+        return redirect(url_for('index'))
+    if job.status != DONE:
+        return job_response(job, 202 if not job.finished else 500)
+    
+    if job.kind == 'esrgan':
+        return show_esrgan_results(job.meta['original_filename'], job.output_filename, job.meta['original_size_mb'])
+    return show_final_results(job.meta['original_filename'], job.meta['esrgan_filename'], job.output_filename)
+
+def faces_found(esrgan_filename):
+    """Faces the worker's pre-check found in the original upload, or None if it didn't run"""
+    try:
+        with open(sidecar_path_for(os.path.join(OUTPUT_FOLDER, esrgan_filename))) as f:
+            return len(json.load(f)['faces'])
+    except (OSError, ValueError, KeyError):
+        return None
 
 def show_esrgan_results(original_filename, esrgan_filename, original_size_mb):
     """Show Real-ESRGAN results with option to apply GFPGAN"""
-    
+    faces = faces_found(esrgan_filename)
+    if faces == 0:
+        face_note = "No faces were detected in this photo, so face enhancement would leave it unchanged."
+    elif faces:
+        face_note = f"{faces} face{'s' if faces != 1 else ''} detected in this photo."
+    else:
+        face_note = ""
+
     return f'''<!DOCTYPE html>
 <html lang="en">
 <head>
@@ -704,14 +864,14 @@ def show_esrgan_results(original_filename, esrgan_filename, original_size_mb):
                 <div class="image-section">
                     <h3>📷 Original Photo</h3>
                     <div class="image-container">
-                        <img src="/static/inputs/{original_filename}" class="comparison-image" alt="Original">
+                        <img src="{display_url('serve_input', original_filename)}" class="comparison-image" alt="Original">
                         <div class="image-overlay">Original</div>
                     </div>
                 </div>
                 <div class="image-section">
                     <h3>🔍 Super Resolution (4x)</h3>
                     <div class="image-container">
-                        <img src="/static/outputs/{esrgan_filename}" class="comparison-image" alt="Enhanced">
+                        <img src="{display_url('serve_output', esrgan_filename)}" class="comparison-image" alt="Enhanced">
                         <div class="image-overlay">Real-ESRGAN</div>
                     </div>
                 </div>
@@ -722,7 +882,7 @@ def show_esrgan_results(original_filename, esrgan_filename, original_size_mb):
                 <div class="option-description">
                     Your image has been enhanced with super resolution! For photos with faces, you can apply GFPGAN 
                     for additional face restoration and enhancement. This will take a few more minutes but can significantly 
-                    improve portrait photos.
+                    improve portrait photos. {face_note}
                 </div>
                 
                 <form id="gfpganForm" method="POST" action="/apply_gfpgan">
@@ -804,20 +964,20 @@ def show_esrgan_results(original_filename, esrgan_filename, original_size_mb):
                 method: 'POST',
                 body: formData
             }})
-            .then(response => {{
+            .then(response => response.json().then(job => {{
                 console.log('[Frontend] Response status:', response.status);
                 if (!response.ok) {{
-                    throw new Error('Server returned ' + response.status);
+                    throw new Error(job.error || 'Server returned ' + response.status);
                 }}
-                return response.text();
-            }})
-            .then(html => {{
+                return waitForJob(job);
+            }}))
+            .then(job => {{
                 clearInterval(interval);
                 progressBar.style.width = '100%';
                 progressText.textContent = 'Complete!';
-                console.log('[Frontend] Success - updating page');
+                console.log('[Frontend] Success - loading results for job', job.job_id);
                 setTimeout(() => {{
-                    document.body.innerHTML = html;
+                    window.location.href = job.page_url;
                 }}, 500);
             }})
             .catch(err => {{
@@ -834,6 +994,15 @@ def show_esrgan_results(original_filename, esrgan_filename, original_size_mb):
             return false;
         }};
         
+        // Long-poll the job until it is done or failed
+        function waitForJob(job) {{
+            if (job.status === 'done') return Promise.resolve(job);
+            if (job.status === 'failed') return Promise.reject(new Error(job.error));
+            return fetch(job.wait_url + '?timeout=30')
+                .then(response => response.json())
+                .then(waitForJob);
+        }}
+        
         console.log('[Frontend] GFPGAN page loaded and ready');
     </script>
 </body>
@@ -841,32 +1010,39 @@ def show_esrgan_results(original_filename, esrgan_filename, original_size_mb):
 
 @app.route('/apply_gfpgan', methods=['POST'])
 def apply_gfpgan():
-    """Apply GFPGAN to the already processed Real-ESRGAN image"""
+    """Queue GFPGAN for the already processed Real-ESRGAN image"""
     # Handle both JSON and form data
     if request.is_json:
         data = request.get_json()
-        esrgan_filename = data.get('esrgan_filename')
     else:
-        esrgan_filename = request.form.get('esrgan_filename')
+        data = request.form
+    esrgan_filename = data.get('esrgan_filename')
     
     if not esrgan_filename:
         print("[Flask] ERROR: No filename provided")
         return jsonify({'error': 'No filename provided'}), 400
     
+    esrgan_filename = secure_filename(esrgan_filename)
+    try:
+        # Without a format the result keeps the Real-ESRGAN image's
+        encoding = encoding_options(data) if data.get('output_format') else {}
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    esrgan_path = os.path.join(OUTPUT_FOLDER, esrgan_filename)
+    if encoding and os.path.exists(esrgan_path):
+        try:
+            # GFPGAN keeps the size
+            encoding = fit_encoding(encoding, esrgan_path, 1)
+        except OSError:
+            pass
     print(f"[Flask] Applying GFPGAN to {esrgan_filename}...")
-    final_output_filename = process_with_gfpgan(esrgan_filename)
+    job = process_with_gfpgan(esrgan_filename, encoding)
     
-    if final_output_filename is None:
-        print("[Flask] GFPGAN processing failed")
-        return jsonify({'error': 'GFPGAN processing timed out or failed. The background processor may not be running.'}), 500
+    if job is None:
+        print("[Flask] GFPGAN input missing")
+        return jsonify({'error': 'Super resolution result not found. Please process your image again.'}), 404
     
-    print(f"[Flask] GFPGAN processing completed: {final_output_filename}")
-    
-    # Extract original filename for display
-    original_filename = esrgan_filename.replace("esrgan_", "")
-    
-    # Show final results
-    return show_final_results(original_filename, esrgan_filename, final_output_filename)
+    return job_response(job, 202)
 
 def show_final_results(original_filename, esrgan_filename, final_filename):
     """Show final results with all three versions"""
@@ -1101,14 +1277,14 @@ def show_final_results(original_filename, esrgan_filename, final_filename):
                     <div class="image-section">
                         <h3>📷 Original Photo</h3>
                         <div class="image-container">
-                            <img src="/static/inputs/{original_filename}" class="comparison-image" alt="Original">
+                            <img src="{display_url('serve_input', original_filename)}" class="comparison-image" alt="Original">
                             <div class="image-overlay">Original</div>
                         </div>
                     </div>
                     <div class="image-section">
                         <h3>🔍 Super Resolution</h3>
                         <div class="image-container">
-                            <img src="/static/outputs/{esrgan_filename}" class="comparison-image" alt="Real-ESRGAN Enhanced">
+                            <img src="{display_url('serve_output', esrgan_filename)}" class="comparison-image" alt="Real-ESRGAN Enhanced">
                             <div class="image-overlay">Real-ESRGAN</div>
                         </div>
                         <div class="enhancement-badge">4x Upscaled</div>
@@ -1116,7 +1292,7 @@ def show_final_results(original_filename, esrgan_filename, final_filename):
                     <div class="image-section">
                         <h3>✨ Final Enhanced</h3>
                         <div class="image-container final-result">
-                            <img src="/static/outputs/{final_filename}" class="comparison-image" alt="Final Enhanced">
+                            <img src="{display_url('serve_output', final_filename)}" class="comparison-image" alt="Final Enhanced">
                             <div class="image-overlay">AI Enhanced</div>
                         </div>
                         <div class="enhancement-badge">+ Face Enhancement</div>
@@ -1161,19 +1337,69 @@ def download_file(filename):
             OUTPUT_FOLDER, 
             filename, 
             as_attachment=True,
-            download_name=f"enhanced_{filename}"
+            download_name=f"enhanced_{filename}",
+            conditional=True,
+            max_age=STATIC_MAX_AGE
         )
     except FileNotFoundError:
         flash('File not found. Please try processing your image again.', 'error')
         return redirect(url_for('index'))
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text format: this app's job metrics plus every live worker's stage timings"""
+    snapshots = [{'worker': 'frontend', 'metrics': metrics.REGISTRY.snapshot()}] + metrics.load_snapshots()
+    return app.response_class(metrics.render(snapshots), mimetype='text/plain; version=0.0.4')
+
+def send_image(folder, filename):
+    """An image from folder, or with ?size=thumb|display a cached resized WebP/JPEG copy of it.
+
+    Responses carry ETag and Last-Modified and honour If-None-Match,
+    If-Modified-Since and Range. The format follows ?format=webp|jpeg, else
+    the Accept header.
+    """
+    size = request.args.get('size')
+    if derivatives.DERIVATIVES and size in derivatives.SIZES:
+        source_path = safe_join(folder, filename)
+        if source_path is None or not os.path.isfile(source_path):
+            abort(404)
+        requested = request.args.get('format')
+        fmt = derivatives.choose_format(requested, request.headers.get('Accept'))
+        # A copy evicted between the lookup and opening it is rendered once more
+        for attempt in range(2):
+            try:
+                path = derivatives.get(source_path, size, fmt)
+            except Exception as e:
+                print(f"[Derivatives] Could not resize {filename}, serving the original: {e}")
+                break
+            if not path:
+                break
+            try:
+                # Cache hits touch the file for LRU eviction, so validate on the source, not the copy
+                response = send_file(path, mimetype=derivatives.FORMATS[fmt][1], conditional=True,
+                                     etag=os.path.splitext(os.path.basename(path))[0],
+                                     last_modified=os.path.getmtime(source_path), max_age=STATIC_MAX_AGE)
+            except FileNotFoundError:
+                print(f"[Derivatives] {size} copy of {filename} was evicted before it was sent")
+                continue
+            if requested not in derivatives.FORMATS:
+                response.vary.add('Accept')
+            return response
+    return send_from_directory(folder, filename, conditional=True, max_age=STATIC_MAX_AGE)
+
+def display_url(endpoint, filename):
+    """URL of the display-size copy of an image, for pages that show it scaled down anyway"""
+    if derivatives.DERIVATIVES:
+        return url_for(endpoint, filename=filename, size='display')
+    return url_for(endpoint, filename=filename)
+
 @app.route('/static/inputs/<filename>')
 def serve_input(filename):
-    return send_from_directory(UPLOAD_FOLDER, filename)
+    return send_image(UPLOAD_FOLDER, filename)
 
 @app.route('/static/outputs/<filename>')
 def serve_output(filename):
-    return send_from_directory(OUTPUT_FOLDER, filename)
+    return send_image(OUTPUT_FOLDER, filename)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,35 @@
+import cv2
+import numpy as np
+
+def psnr(reference, candidate, peak=255.0):
+    """Peak signal-to-noise ratio in dB between two uint8 images (inf if identical)"""
+    mse = np.mean((reference.astype(np.float64) - candidate.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float('inf')
+    return float(10 * np.log10(peak * peak / mse))
+
+def ssim(reference, candidate, peak=255.0):
+    """Mean structural similarity (Wang et al. 2004: 11x11 Gaussian window, sigma 1.5), averaged over channels"""
+    c1, c2 = (0.01 * peak) ** 2, (0.03 * peak) ** 2
+    a = reference.astype(np.float64)
+    b = candidate.astype(np.float64)
+    if a.ndim == 2:
+        a, b = a[:, :, None], b[:, :, None]
+
+    scores = []
+    for channel in range(a.shape[2]):
+        x, y = a[:, :, channel], b[:, :, channel]
+        blur = lambda img: cv2.GaussianBlur(img, (11, 11), 1.5)
+        mu_x, mu_y = blur(x), blur(y)
+        var_x = blur(x * x) - mu_x * mu_x
+        var_y = blur(y * y) - mu_y * mu_y
+        cov = blur(x * y) - mu_x * mu_y
+        ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (var_x + var_y + c2))
+        scores.append(ssim_map.mean())
+    return float(np.mean(scores))
+
+def compare(reference, candidate):
+    """{'psnr': dB, 'ssim': 0..1} of candidate against reference"""
+    if reference.shape != candidate.shape:
+        raise ValueError(f"Shapes differ: {reference.shape} vs {candidate.shape}")
+    return {'psnr': psnr(reference, candidate), 'ssim': ssim(reference, candidate)}
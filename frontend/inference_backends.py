@@ -0,0 +1,97 @@
+import os
+import json
+import torch
+from result_cache import model_checksum
+
+# 'eager' runs the PyTorch modules as built; 'torchscript' and 'onnx' run the
+# graphs written by export_models.py (ONNX Runtime is CPU only)
+BACKENDS = ('eager', 'torchscript', 'onnx')
+INFERENCE_BACKEND = os.environ.get('INFERENCE_BACKEND', 'eager')
+EXPORT_DIR = os.environ.get('EXPORT_DIR', '/app/models/exported')
+
+EXTENSIONS = {'torchscript': '.ts', 'onnx': '.onnx'}
+
+def export_path(model_path, backend, export_dir=EXPORT_DIR):
+    """Where the exported graph of a .pth lives, e.g. exported/GFPGANv1.4.onnx"""
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(export_dir, stem + EXTENSIONS[backend])
+
+def metadata_path(path):
+    return path + '.json'
+
+class FaceGenerator(torch.nn.Module):
+    """GFPGAN generator as GFPGANer calls it (restored face only), in a form that can be traced"""
+
+    def __init__(self, gfpgan):
+        super().__init__()
+        self.gfpgan = gfpgan
+
+    def forward(self, x):
+        return self.gfpgan(x, return_rgb=False)[0]
+
+class OnnxModel:
+    """ONNX Runtime session that is called like the module it was exported from"""
+
+    def __init__(self, path):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x):
+        output = self.session.run(None, {self.input_name: x.detach().cpu().numpy()})[0]
+        return torch.from_numpy(output)
+
+    def eval(self):
+        return self
+
+class FaceGraph:
+    """Exported GFPGAN generator behind GFPGANv1Clean's call signature.
+
+    The modulated convolutions bake the batch size into their group count when
+    traced, so the graphs are exported for one face and a batch of crops is
+    run a crop at a time. `weight` is accepted and ignored, as GFPGANv1Clean does.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __call__(self, x, return_rgb=False, weight=None, **kwargs):
+        return torch.cat([self.graph(face[None]) for face in x]), []
+
+def open_graph(backend, path, device):
+    """Load an exported graph file for `device`"""
+    if backend == 'onnx':
+        if device.type != 'cpu':
+            raise RuntimeError(f"the onnx backend runs on CPU only, not {device}")
+        return OnnxModel(path)
+    model = torch.jit.load(path, map_location=device)
+    model.eval()
+    return model
+
+def load_graph(backend, model_path, device, export_dir=EXPORT_DIR):
+    """The exported graph of model_path for `backend`, or None to fall back to eager.
+
+    A graph is only used if its metadata says it was exported from the .pth
+    that is there now.
+    """
+    path = export_path(model_path, backend, export_dir)
+    name = os.path.basename(path)
+    try:
+        with open(metadata_path(path)) as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        print(f"[Backends] No {backend} export of {os.path.basename(model_path)}; run export_models.py")
+        return None
+    if metadata.get('source_checksum') != model_checksum(model_path):
+        print(f"[Backends] {name} was exported from different weights; re-run export_models.py")
+        return None
+    try:
+        graph = open_graph(backend, path, device)
+    except Exception as e:
+        print(f"[Backends] Could not load {name}: {e}")
+        return None
+    print(f"[Backends] Using {name} (max abs diff vs eager {metadata.get('max_abs_diff', 0):.2e})")
+    return graph
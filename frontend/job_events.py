@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import select
+import ctypes
+import ctypes.util
+
+# inotify event bits (see <sys/inotify.h>)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+# Polling fallback interval, used where inotify is unavailable (non-Linux hosts,
+# network filesystems, Docker Desktop file sharing)
+POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '0.25'))
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+class DirectoryWatcher:
+    """Block until something in a set of directories changes.
+
+    Uses inotify when the kernel supports it and falls back to polling the
+    directory listings every POLL_INTERVAL seconds otherwise. wait() only says
+    that something changed; callers re-scan the directories themselves.
+    """
+
+    def __init__(self, directories, force_polling=False):
+        self.directories = list(directories)
+        self.fd = None
+        self._snapshot = None
+        if not force_polling and os.environ.get('JOB_EVENTS_POLLING') != '1':
+            self._start_inotify()
+        if self.fd is None:
+            self._snapshot = self._take_snapshot()
+
+    @property
+    def mode(self):
+        return 'inotify' if self.fd is not None else 'polling'
+
+    def _start_inotify(self):
+        libc = _load_libc()
+        if libc is None:
+            return
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return
+        for directory in self.directories:
+            if libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK) < 0:
+                print(f"[Events] inotify unavailable for {directory} "
+                      f"({os.strerror(ctypes.get_errno())}), falling back to polling")
+                os.close(fd)
+                return
+        self.fd = fd
+
+    def _take_snapshot(self):
+        snapshot = {}
+        for directory in self.directories:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                pass
+        return snapshot
+
+    def _drain(self):
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def wait(self, timeout=None):
+        """Wait up to `timeout` seconds for a change; return True if one was seen"""
+        if self.fd is not None:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if readable:
+                self._drain()
+                return True
+            return False
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot = self._take_snapshot()
+            if snapshot != self._snapshot:
+                self._snapshot = snapshot
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                time.sleep(min(POLL_INTERVAL, remaining))
+            else:
+                time.sleep(POLL_INTERVAL)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def write_request_file(path, content):
+    """Write a job request atomically so watchers never see a half-written file"""
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, f".{name}.tmp")
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def read_request_file(path):
+    """Options stored in a job request; empty for legacy plain-text requests"""
+    try:
+        with open(path) as f:
+            options = json.load(f)
+        return options if isinstance(options, dict) else {}
+    except (OSError, ValueError):
+        return {}
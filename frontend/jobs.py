@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import uuid
+import threading
+from job_events import DirectoryWatcher, write_request_file
+import metrics
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+# How long finished jobs stay queryable before they are forgotten
+JOB_RETENTION = 3600
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"[Jobs] Could not remove {path}: {e}")
+
+class Job:
+    """One submitted restoration stage, tracked until its output appears"""
+
+    def __init__(self, kind, process_file, output_path, timeout, fallback=None, preview_path=None, scratch=(),
+                 **meta):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.process_file = process_file
+        self.output_path = output_path
+        self.output_filename = os.path.basename(output_path)
+        self.timeout = timeout
+        self.fallback = fallback
+        self.meta = meta
+        # Quick low-resolution result the worker may write before the real output
+        self.preview_path = preview_path
+        self.preview_ready = False
+        # Files the worker leaves for later requests (the face pre-check), removed when the job is forgotten
+        self.scratch = list(scratch)
+        self.status = PENDING
+        self.error = None
+        self.used_fallback = False
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status != PENDING
+
+    def to_dict(self):
+        finished_at = self.finished_at or time.time()
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'output_filename': self.output_filename if self.status == DONE else None,
+            'preview_filename': os.path.basename(self.preview_path) if self.preview_ready and not self.finished else None,
+            'fallback': self.used_fallback,
+            'error': self.error,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+            'elapsed': round(finished_at - self.created_at, 3),
+        }
+
+class JobManager:
+    """Tracks submitted jobs with a single monitor thread.
+
+    Pending jobs don't hold a request thread: one background thread sleeps on
+    a DirectoryWatcher and resolves every job whose output has appeared and
+    whose request file the worker has removed. Request handlers only block in
+    wait(), which is bounded by the caller's timeout.
+    """
+
+    def __init__(self, directories, rescan_interval=5.0):
+        self.directories = directories
+        self.rescan_interval = rescan_interval
+        self._jobs = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._monitor, name='job-monitor', daemon=True)
+                self._thread.start()
+
+    def submit(self, kind, process_file, output_path, timeout=600, fallback=None, preview_path=None, scratch=(),
+               request=None, **meta):
+        """Register a job and write its request file (`request` plus the job id) for the worker.
+
+        Both happen under the monitor's lock, after any earlier output at
+        output_path is removed (a re-upload of the same image has the same
+        names, and a timed-out job leaves its fallback there), so the monitor
+        can't resolve the new job with a stale result.
+        """
+        self.start()
+        job = Job(kind, process_file, output_path, timeout, fallback, preview_path, scratch, **meta)
+        with self._cond:
+            for path in (output_path, preview_path):
+                if path:
+                    _remove(path)
+            write_request_file(process_file, json.dumps(dict(request or {}, job_id=job.id)))
+            self._jobs[job.id] = job
+            self._cond.notify_all()
+        return job
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def wait(self, job_id, timeout, until_preview=False):
+        """Block until the job finishes or `timeout` seconds pass; return the job.
+
+        With until_preview, also return as soon as the job's preview is ready.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            job = self._jobs.get(job_id)
+            while job is not None and not job.finished and not (until_preview and job.preview_ready):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return job
+
+    def _finish(self, job, status, error=None):
+        job.status = status
+        job.error = error
+        job.finished_at = time.time()
+        metrics.FRONTEND_JOBS.inc(kind=job.kind, status=status)
+        metrics.FRONTEND_JOB_SECONDS.observe(job.finished_at - job.created_at, kind=job.kind)
+        print(f"[Jobs] {job.kind} job {job.id} {status} after {job.finished_at - job.created_at:.1f}s")
+        if job.preview_path:
+            # The worker removes it too, but not when the job timed out
+            _remove(job.preview_path)
+
+    def _forget(self, job_id):
+        job = self._jobs.pop(job_id)
+        # A re-upload of the same image has the same names, and its job may still use them
+        in_use = {path for other in self._jobs.values() for path in other.scratch}
+        for path in job.scratch:
+            if path not in in_use:
+                _remove(path)
+
+    def _check_preview(self, job, now):
+        """True if the job's preview has just appeared"""
+        if job.preview_path and not job.preview_ready and os.path.exists(job.preview_path):
+            job.preview_ready = True
+            print(f"[Jobs] {job.kind} job {job.id} preview ready after {now - job.created_at:.1f}s")
+            return True
+        return False
+
+    def _check(self, job, now):
+        if not os.path.exists(job.process_file):
+            if os.path.exists(job.output_path):
+                self._finish(job, DONE)
+                return
+            # The worker gave up on the job without writing its output; no point waiting for the timeout
+            print(f"[Jobs] {job.kind} job {job.id} finished without an output")
+        elif now - job.created_at < job.timeout:
+            return
+
+        # Timed out or failed: withdraw the request so the worker doesn't pick it up later
+        if os.path.exists(job.process_file):
+            try:
+                os.remove(job.process_file)
+            except OSError:
+                pass
+        if job.fallback is not None:
+            try:
+                job.fallback()
+                job.used_fallback = True
+                self._finish(job, DONE)
+                return
+            except Exception as e:
+                print(f"[Jobs] Fallback for job {job.id} failed: {e}")
+        self._finish(job, FAILED, f"{job.kind} processing timed out or failed. "
+                                  "The background processor may not be running.")
+
+    def _monitor(self):
+        watcher = DirectoryWatcher(self.directories)
+        print(f"[Jobs] Monitoring job completion ({watcher.mode})")
+        while True:
+            try:
+                now = time.time()
+                with self._cond:
+                    changed = False
+                    for job_id, job in list(self._jobs.items()):
+                        if not job.finished:
+                            changed = self._check_preview(job, now) or changed
+                            self._check(job, now)
+                            changed = changed or job.finished
+                        elif now - job.finished_at > JOB_RETENTION:
+                            self._forget(job_id)
+                    if changed:
+                        self._cond.notify_all()
+            except Exception as e:
+                print(f"[Jobs] Monitor error: {e}")
+            watcher.wait(self.rescan_interval)
+
+def run_job(kind, process_file, output_path, timeout=600, request=None):
+    """Submit one job and block until it finishes, for command-line clients; returns the Job.
+
+    A job still pending afterwards had no answer from the worker in time.
+    """
+    manager = JobManager(sorted({os.path.dirname(process_file), os.path.dirname(output_path)}))
+    job = manager.submit(kind, process_file, output_path, timeout=timeout, request=request)
+    # The monitor notices the timeout at its next scan
+    return manager.wait(job.id, timeout + 2 * manager.rescan_interval)
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Where worker processes publish their metric snapshots for the frontend to merge
+METRICS_DIR = os.environ.get('METRICS_DIR', '/app/outputs/metrics')
+PUBLISH_INTERVAL = float(os.environ.get('METRICS_PUBLISH_INTERVAL', '5'))
+# Snapshots not refreshed for this long belong to workers that are gone
+STALE_AFTER = 600
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+class Metric:
+    """A metric family; one series per combination of label values"""
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            series = [{'labels': dict(zip(self.labelnames, key)), 'value': self._copy(value)}
+                      for key, value in self._series.items()]
+        return {'type': self.kind, 'help': self.help, 'series': series, **self._extra()}
+
+    def _copy(self, value):
+        return value
+
+    def _extra(self):
+        return {}
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._series.get(key)
+            if state is None:
+                state = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][i] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _copy(self, value):
+        return {'counts': list(value['counts']), 'sum': value['sum'], 'count': value['count']}
+
+    def _extra(self):
+        return {'buckets': list(self.buckets)}
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+REGISTRY = Registry()
+
+# Worker
+QUEUE_WAIT = REGISTRY.histogram('restoration_queue_wait_seconds', 'Time from request file to job start', ['kind'])
+JOB_SECONDS = REGISTRY.histogram('restoration_job_seconds', 'End-to-end time from request file to finished output', ['kind'])
+JOBS = REGISTRY.counter('restoration_jobs_total', 'Jobs handled by the worker', ['kind', 'result'])
+MODEL_LOAD = REGISTRY.histogram('restoration_model_load_seconds', 'Model load time', ['model'])
+DECODE = REGISTRY.histogram('restoration_decode_seconds', 'Input image decode time', ['stage'])
+INFERENCE = REGISTRY.histogram('restoration_inference_seconds', 'Model inference time per image', ['stage'])
+TILE_INFERENCE = REGISTRY.histogram('restoration_tile_inference_seconds', 'Real-ESRGAN forward time per tile', ['stage'])
+TILE_BATCH = REGISTRY.histogram('restoration_tile_batch_size', 'Tiles per Real-ESRGAN forward pass', buckets=COUNT_BUCKETS)
+GFPGAN_FACES = REGISTRY.histogram('restoration_gfpgan_faces', 'Faces restored per image', buckets=COUNT_BUCKETS)
+TILES = REGISTRY.counter('restoration_tiles_total', 'Real-ESRGAN tiles of full results by how they were upscaled',
+                         ['method'])
+TILE_SKIP_SAVED = REGISTRY.counter('restoration_tile_skip_saved_seconds_total',
+                                   'Estimated Real-ESRGAN time saved by interpolating flat tiles')
+ENCODE = REGISTRY.histogram('restoration_encode_seconds', 'Output image encode and write time', ['stage'])
+CACHE = REGISTRY.counter('restoration_cache_requests_total', 'Result cache lookups', ['result'])
+
+# Frontend
+FRONTEND_JOBS = REGISTRY.counter('restoration_frontend_jobs_total', 'Jobs submitted through the web app', ['kind', 'status'])
+FRONTEND_JOB_SECONDS = REGISTRY.histogram('restoration_frontend_job_seconds', 'Submit-to-finish time seen by the web app', ['kind'])
+
+def publish(worker_id, directory=METRICS_DIR):
+    """Write this process's snapshot where the frontend can find it"""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"worker-{worker_id}.json")
+    tmp_path = os.path.join(directory, f".worker-{worker_id}.json.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump({'worker': str(worker_id), 'time': time.time(), 'metrics': REGISTRY.snapshot()}, f)
+    os.replace(tmp_path, path)
+
+def start_publisher(worker_id, directory=METRICS_DIR, interval=PUBLISH_INTERVAL):
+    """Publish this process's metrics every `interval` seconds from a daemon thread"""
+    def run():
+        while True:
+            try:
+                publish(worker_id, directory)
+            except Exception as e:
+                print(f"[Metrics] Could not publish: {e}")
+            time.sleep(interval)
+
+    threading.Thread(target=run, name='metrics-publisher', daemon=True).start()
+
+def load_snapshots(directory=METRICS_DIR):
+    """Snapshots published by live workers"""
+    snapshots = []
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return snapshots
+    for name in names:
+        if not (name.startswith('worker-') and name.endswith('.json')):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if time.time() - snapshot.get('time', 0) <= STALE_AFTER:
+            snapshots.append(snapshot)
+    return snapshots
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+def render(snapshots):
+    """Prometheus text exposition of several processes' snapshots, each labelled by worker"""
+    families = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot['metrics'].items():
+            family = families.setdefault(name, {'type': metric['type'], 'help': metric['help'],
+                                                'buckets': metric.get('buckets'), 'series': []})
+            for series in metric['series']:
+                labels = dict(series['labels'], worker=snapshot['worker'])
+                family['series'].append((labels, series['value']))
+
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for labels, value in family['series']:
+            if family['type'] == 'counter':
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            for bound, count in zip(family['buckets'], value['counts']):
+                lines.append(f"{name}_bucket{_format_labels(dict(labels, le=_format_value(bound)))} {count}")
+            lines.append(f"{name}_bucket{_format_labels(dict(labels, le='+Inf'))} {value['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value['sum'])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {value['count']}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,77 @@
+import os
+
+# How results are encoded. A job may ask for a format (and JPEG quality or PNG
+# compression); without one, results keep the upload's format as before.
+# The frontend and the worker both derive output filenames from here.
+FORMATS = {
+    'png': '.png',    # lossless, `compression` 0-9 (OpenCV's default when unset)
+    'webp': '.webp',  # lossless WebP; sides up to WEBP_MAX_SIDE, see fit()
+    'jpeg': '.jpg',   # `quality` 1-100
+    'tiff': '.tif',   # 16-bit per channel, LZW compressed, for archiving
+}
+EXTENSIONS = {'.png': 'png', '.webp': 'webp', '.jpg': 'jpeg', '.jpeg': 'jpeg', '.tif': 'tiff', '.tiff': 'tiff'}
+
+# WebP can't store an image with a longer side
+WEBP_MAX_SIDE = 16383
+
+OUTPUT_FORMAT = os.environ.get('OUTPUT_FORMAT', '')
+JPEG_QUALITY = int(os.environ.get('OUTPUT_JPEG_QUALITY', '95'))
+PNG_COMPRESSION = os.environ.get('OUTPUT_PNG_COMPRESSION', '')
+
+def parse(fmt=None, quality=None, compression=None):
+    """Validated encoding options for a job ({} keeps the upload's format and default settings).
+
+    Values may be strings straight from a form; raises ValueError for bad ones.
+    """
+    fmt = (fmt or OUTPUT_FORMAT or '').lower()
+    fmt = EXTENSIONS.get('.' + fmt, fmt)
+    if not fmt:
+        return {}
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown output format {fmt!r}; use one of: {', '.join(FORMATS)}")
+    options = {'format': fmt}
+    if fmt == 'jpeg' and quality not in (None, ''):
+        options['quality'] = int(quality)
+        if not 1 <= options['quality'] <= 100:
+            raise ValueError("JPEG quality must be between 1 and 100")
+    if fmt == 'png' and compression not in (None, ''):
+        options['compression'] = int(compression)
+        if not 0 <= options['compression'] <= 9:
+            raise ValueError("PNG compression must be between 0 and 9")
+    return options
+
+def fit(options, width, height):
+    """options for a width x height result: lossless PNG instead of WebP when a side is too long for WebP.
+
+    Callers apply it before output_filename(), so the name matches the format.
+    """
+    if (options or {}).get('format') == 'webp' and max(width, height) > WEBP_MAX_SIDE:
+        return {'format': 'png'}
+    return options
+
+def format_of(filename):
+    """'png', 'webp', 'jpeg' or 'tiff' from a filename's extension (None if unknown)"""
+    return EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+
+def source_name(filename):
+    """filename without the extension output_filename() appended, e.g. photo.jpg.webp -> photo.jpg"""
+    stem, ext = os.path.splitext(filename)
+    if ext.lower() in EXTENSIONS and os.path.splitext(stem)[1].lower() in EXTENSIONS:
+        return stem
+    return filename
+
+def output_filename(filename, options):
+    """Name of a result in the requested format: the format's extension is appended
+    (photo.jpg -> photo.jpg.webp) so the upload's name can still be recovered
+    with source_name(); without a format, or in the same format, it is unchanged.
+    """
+    fmt = (options or {}).get('format')
+    if not fmt or format_of(filename) == fmt:
+        return filename
+    name = source_name(filename)
+    if format_of(name) == fmt:
+        return name
+    return name + FORMATS[fmt]
+
+def is_16bit(filename):
+    return format_of(filename) == 'tiff'
@@ -1,89 +1,44 @@
-import sys
 import os
-import torch
-import numpy as np
-import cv2
-from PIL import Image
-from gfpgan import GFPGANer
+import sys
+import argparse
+import output_format
+from jobs import run_job, DONE
+from process_realesrgan_only import OUTPUT_FOLDER, encoding_from_args
 
-def process_image_gfpgan_only(input_filename, output_filename):
-    """Process already enhanced image using only GFPGAN for face enhancement"""
-    # Device selection
-    if torch.backends.mps.is_available():
-        device = torch.device("mps")
-    elif torch.cuda.is_available():
-        device = torch.device("cuda")
-    else:
-        device = torch.device("cpu")
+def process_image_gfpgan_only(input_filename, output_filename, encoding=None, timeout=600):
+    """Restore faces in /app/outputs/frontend/<input_filename> with the resident worker's GFPGAN; True on success.
 
-    print(f"Using device: {device}")
+    Only writes a .process_gfpgan request and waits for the output, so no
+    model is loaded here.
+    """
+    process_file = os.path.join(OUTPUT_FOLDER, f"{input_filename}.process_gfpgan")
+    output_path = os.path.join(OUTPUT_FOLDER, output_filename)
+    job = run_job('gfpgan', process_file, output_path, timeout,
+                  request={'mode': 'process_gfpgan', 'output': encoding or {}, 'output_filename': output_filename})
+    if job.status != DONE:
+        print(f"GFPGAN job for {input_filename} {job.status}: {job.error or 'no answer from the worker'}")
+        return False
+    print(f"GFPGAN processing complete - saved as {output_filename}")
+    return True
 
-    # GFPGAN for face enhancement
-    print("Applying GFPGAN for face enhancement...")
-    
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Restore faces in an upscaled image with the GFPGAN worker')
+    parser.add_argument('input_filename', help=f'image in {OUTPUT_FOLDER}')
+    parser.add_argument('output_filename', help=f'result name in {OUTPUT_FOLDER}')
+    parser.add_argument('--format', help=f"output format: {', '.join(output_format.FORMATS)}")
+    parser.add_argument('--quality', help='JPEG quality 1-100')
+    parser.add_argument('--compression', help='PNG compression 0-9')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for the worker')
+    args = parser.parse_args(argv)
     try:
-        # Initialize GFPGAN
-        face_restorer = GFPGANer(
-            model_path='/app/models/GFPGANv1.4.pth',
-            upscale=1,  # Don't upscale since image is already enhanced by Real-ESRGAN
-            arch='clean',
-            channel_multiplier=2,
-            bg_upsampler=None  # We already enhanced with Real-ESRGAN
-        )
-
-        # Load the Real-ESRGAN enhanced image - FIXED PATH
-        input_path = f'/app/outputs/frontend/{input_filename}'
-        print(f"Loading image from: {input_path}")
-        
-        img = cv2.imread(input_path)
-        if img is None:
-            raise Exception(f"Could not load image from: {input_path}")
-        
-        print(f"Input image shape: {img.shape}")
-        
-        # Enhance faces with GFPGAN
-        cropped_faces, restored_faces, final_output = face_restorer.enhance(
-            img,
-            has_aligned=False,
-            only_center_face=False,
-            paste_back=True
-        )
-        
-        print("GFPGAN processing complete")
-        print(f"Final output shape: {final_output.shape}")
+        encoding = encoding_from_args(args, args.output_filename, os.path.join(OUTPUT_FOLDER, args.input_filename), 1)
+    except ValueError as e:
+        parser.error(str(e))
 
-        # Save final result - FIXED PATH
-        output_path = f'/app/outputs/frontend/{output_filename}'
-        cv2.imwrite(output_path, final_output)
-        print(f"GFPGAN processing complete - saved as {output_path}")
-        
-    except Exception as e:
-        print(f"Error during GFPGAN processing: {e}")
-        import traceback
-        traceback.print_exc()
-        
-        # Fallback: just copy the input file if GFPGAN fails
-        import shutil
-        input_path = f'/app/outputs/frontend/{input_filename}'
-        output_path = f'/app/outputs/frontend/{output_filename}'
-        
-        if os.path.exists(input_path):
-            shutil.copy(input_path, output_path)
-            print(f"Fallback: copied {input_filename} as {output_filename}")
-        else:
-            print(f"Error: Input file not found at {input_path}")
+    print(f"Input file: {args.input_filename}")
+    print(f"Output file: {args.output_filename}")
+    ok = process_image_gfpgan_only(args.input_filename, args.output_filename, encoding, args.timeout)
+    return 0 if ok else 1
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python process_gfpgan_only.py <input_filename> <output_filename>")
-        sys.exit(1)
-    
-    input_file = sys.argv[1]
-    output_file = sys.argv[2]
-    
-    import os
-    print(f"Current working directory: {os.getcwd()}")
-    print(f"Input file: {input_file}")
-    print(f"Output file: {output_file}")
-    
-    process_image_gfpgan_only(input_file, output_file)
\ No newline at end of file
+    sys.exit(main())
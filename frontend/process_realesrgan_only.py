@@ -1,82 +1,62 @@
+import os
 import sys
-import torch
-import numpy as np
-import cv2
+import argparse
 from PIL import Image
-from basicsr.archs.rrdbnet_arch import RRDBNet
-from realesrgan import RealESRGANer
-
-def process_image_realesrgan_only(input_filename, output_filename):
-    """Process image using only Real-ESRGAN for super resolution"""
-    # Device selection
-    if torch.backends.mps.is_available():
-        device = torch.device("mps")
-    elif torch.cuda.is_available():
-        device = torch.device("cuda")
-    else:
-        device = torch.device("cpu")
-
-    print(f"Using device: {device}")
-
-    # Real-ESRGAN for super resolution
-    print("Applying Real-ESRGAN for super resolution...")
-    model_path = '/app/models/RealESRGAN_x4plus.pth'
-    
+import output_format
+from jobs import run_job, DONE
+
+UPLOAD_FOLDER = '/app/inputs'
+OUTPUT_FOLDER = '/app/outputs/frontend'
+
+def process_image_realesrgan_only(input_filename, output_filename, encoding=None, timeout=600):
+    """Upscale /app/inputs/<input_filename> with the resident worker's Real-ESRGAN; True on success.
+
+    Only writes a .process_esrgan request and waits for the output, so no
+    model is loaded here.
+    """
+    process_file = os.path.join(UPLOAD_FOLDER, f"{input_filename}.process_esrgan")
+    output_path = os.path.join(OUTPUT_FOLDER, output_filename)
+    job = run_job('esrgan', process_file, output_path, timeout,
+                  request={'mode': 'process_esrgan_only', 'output': encoding or {}, 'output_filename': output_filename})
+    if job.status != DONE:
+        print(f"Real-ESRGAN job for {input_filename} {job.status}: {job.error or 'no answer from the worker'}")
+        return False
+    print(f"Real-ESRGAN processing complete - saved as {output_filename}")
+    return True
+
+def encoding_from_args(args, output_filename, input_path, scale):
+    """Encoding options for the job; the format defaults to the output name's.
+
+    Raises ValueError when the input scaled by `scale` is too large for the
+    format (WebP), since the output name fixes the format.
+    """
+    encoding = output_format.parse(args.format or output_format.format_of(output_filename), args.quality, args.compression)
     try:
-        state_dict = torch.load(model_path, map_location=device)['params_ema']
-
-        model = RRDBNet(
-            num_in_ch=3,
-            num_out_ch=3,
-            num_feat=64,
-            num_block=23,
-            num_grow_ch=32,
-            scale=4
-        ).to(device)
-        model.load_state_dict(state_dict, strict=True)
-
-        upsampler = RealESRGANer(
-            scale=4,
-            model_path=model_path,
-            model=model,
-            tile=200,
-            pre_pad=0,
-            half=False,
-            device=device
-        )
-
-        # Load and process with Real-ESRGAN
-        img = Image.open(f'/app/inputs/{input_filename}').convert('RGB')
-        img = np.array(img)
-        
-        print(f"Input image shape: {img.shape}")
-        
-        # Run Real-ESRGAN inference
-        esrgan_output, _ = upsampler.enhance(img, outscale=4)
-        print(f"Enhanced image shape: {esrgan_output.shape}")
-        print("Real-ESRGAN processing complete")
-
-        # Convert RGB to BGR for OpenCV saving
-        esrgan_output_bgr = cv2.cvtColor(esrgan_output, cv2.COLOR_RGB2BGR)
-        
-        # Save result
-        cv2.imwrite(f'/app/outputs/frontend/{output_filename}', esrgan_output_bgr)
-        print(f"Real-ESRGAN processing complete - saved as {output_filename}")
-        
-    except Exception as e:
-        print(f"Error during Real-ESRGAN processing: {e}")
-        # Fallback: just copy and resize the original image
-        img = Image.open(f'/app/inputs/{input_filename}').convert('RGB')
-        width, height = img.size
-        img_resized = img.resize((width * 4, height * 4), Image.LANCZOS)
-        img_resized.save(f'/app/outputs/frontend/{output_filename}')
-        print(f"Fallback processing complete - saved as {output_filename}")
+        with Image.open(input_path) as img:
+            width, height = img.size
+    except OSError:
+        # A missing input is reported by the worker
+        return encoding
+    if output_format.fit(encoding, width * scale, height * scale) != encoding:
+        raise ValueError(f"a {width * scale}x{height * scale} result is larger than WebP allows "
+                         f"({output_format.WEBP_MAX_SIDE} px per side); choose a .png output")
+    return encoding
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Upscale an uploaded image 4x with the Real-ESRGAN worker')
+    parser.add_argument('input_filename', help=f'image in {UPLOAD_FOLDER}')
+    parser.add_argument('output_filename', help=f'result name in {OUTPUT_FOLDER}')
+    parser.add_argument('--format', help=f"output format: {', '.join(output_format.FORMATS)}")
+    parser.add_argument('--quality', help='JPEG quality 1-100')
+    parser.add_argument('--compression', help='PNG compression 0-9')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for the worker')
+    args = parser.parse_args(argv)
+    try:
+        encoding = encoding_from_args(args, args.output_filename, os.path.join(UPLOAD_FOLDER, args.input_filename), 4)
+    except ValueError as e:
+        parser.error(str(e))
+    ok = process_image_realesrgan_only(args.input_filename, args.output_filename, encoding, args.timeout)
+    return 0 if ok else 1
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python process_realesrgan_only.py <input_filename> <output_filename>")
-        sys.exit(1)
-    
-    input_file = sys.argv[1]
-    output_file = sys.argv[2]
-    process_image_realesrgan_only(input_file, output_file)
\ No newline at end of file
+    sys.exit(main())
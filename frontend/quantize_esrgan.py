@@ -0,0 +1,171 @@
+# Int8 Real-ESRGAN for CPU {FX static quantization + PSNR/SSIM gate}
+#
+# Calibrates activation ranges on tiles from sample images, converts RRDBNet
+# to int8, compares its output with fp32 on held-out images and saves the
+# traced int8 model only if it passes the quality gate. The worker uses it
+# when ESRGAN_PRECISION=int8:
+#
+#   python /app/frontend/quantize_esrgan.py --images /app/inputs --min-psnr 30 --min-ssim 0.95
+
+import os
+import sys
+import copy
+import glob
+import json
+import time
+import random
+import argparse
+import numpy as np
+import torch
+from PIL import Image
+from tiled_upscale import upscale_image, image_to_tensor
+from tile_batcher import DirectRunner
+from result_cache import model_checksum
+import image_quality
+
+INT8_MODEL_PATH = '/app/models/RealESRGAN_x4plus.int8.pt'
+
+# Calibration: random tiles of the size the worker typically feeds the model
+CALIBRATION_TILE = 128
+CALIBRATION_TILES_PER_IMAGE = 4
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.tif', '.tiff')
+
+def report_path(model_path):
+    return os.path.splitext(model_path)[0] + '.json'
+
+def default_engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            return engine
+    raise RuntimeError("this torch build has no quantized CPU engine")
+
+def load_images(paths):
+    return [np.array(Image.open(path).convert('RGB')) for path in paths]
+
+def calibration_tiles(images, tile=CALIBRATION_TILE, per_image=CALIBRATION_TILES_PER_IMAGE, seed=0):
+    """Random tile x tile crops (1x3xHxW float tensors) from each RGB image"""
+    rng = random.Random(seed)
+    tiles = []
+    for img in images:
+        height, width = img.shape[:2]
+        th, tw = min(tile, height), min(tile, width)
+        for _ in range(per_image):
+            y, x = rng.randint(0, height - th), rng.randint(0, width - tw)
+            tiles.append(image_to_tensor(img[y:y + th, x:x + tw], torch.device('cpu')))
+    return tiles
+
+def quantize(model, tiles, engine=None):
+    """Int8 copy of an fp32 RRDBNet, calibrated on `tiles` and traced to TorchScript"""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    engine = engine or default_engine()
+    torch.backends.quantized.engine = engine
+    example = tiles[0]
+    prepared = prepare_fx(copy.deepcopy(model).cpu().eval(), get_default_qconfig_mapping(engine),
+                          example_inputs=(example,))
+    with torch.no_grad():
+        for tile in tiles:
+            prepared(tile)
+        quantized = convert_fx(prepared)
+        return torch.jit.trace(quantized, example)
+
+def evaluate(fp32_model, int8_model, images, tile=200, tile_pad=10):
+    """Upscale each image with both models; per-image PSNR/SSIM and timings, plus the means"""
+    device = torch.device('cpu')
+    fp32_runner, int8_runner = DirectRunner(fp32_model, device), DirectRunner(int8_model, device)
+    results = []
+    for img in images:
+        start = time.perf_counter()
+        reference = upscale_image(img, fp32_runner, scale=4, tile=tile, tile_pad=tile_pad)
+        fp32_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        candidate = upscale_image(img, int8_runner, scale=4, tile=tile, tile_pad=tile_pad)
+        int8_seconds = time.perf_counter() - start
+        results.append(dict(image_quality.compare(reference, candidate),
+                            fp32_seconds=round(fp32_seconds, 3), int8_seconds=round(int8_seconds, 3)))
+    summary = {
+        'psnr': float(np.mean([r['psnr'] for r in results])),
+        'min_psnr': float(np.min([r['psnr'] for r in results])),
+        'ssim': float(np.mean([r['ssim'] for r in results])),
+        'min_ssim': float(np.min([r['ssim'] for r in results])),
+        'speedup': sum(r['fp32_seconds'] for r in results) / max(sum(r['int8_seconds'] for r in results), 1e-9),
+    }
+    return summary, results
+
+def save_quantized(int8_model, path, report):
+    tmp_path = path + '.tmp'
+    torch.jit.save(int8_model, tmp_path)
+    os.replace(tmp_path, path)
+    with open(report_path(path), 'w') as f:
+        json.dump(report, f, indent=2)
+
+def load_quantized(path, source_model_path):
+    """The saved int8 model if it was built from the current fp32 weights, else None"""
+    try:
+        with open(report_path(path)) as f:
+            report = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if report.get('source_checksum') != model_checksum(source_model_path):
+        print(f"[Int8] {os.path.basename(path)} was built from different weights; re-run quantize_esrgan.py")
+        return None
+    torch.backends.quantized.engine = report['engine']
+    model = torch.jit.load(path, map_location='cpu')
+    model.eval()
+    print(f"[Int8] Loaded {os.path.basename(path)} (PSNR {report['psnr']:.2f} dB, "
+          f"SSIM {report['ssim']:.4f}, {report['speedup']:.2f}x vs fp32)")
+    return model
+
+def main(argv=None):
+    import restoration_worker
+    from basicsr.archs.rrdbnet_arch import RRDBNet
+
+    parser = argparse.ArgumentParser(description='Build and gate an int8 Real-ESRGAN model for CPU inference')
+    parser.add_argument('--images', default='/app/inputs', help='directory of sample images')
+    parser.add_argument('--calibration-count', type=int, default=8, help='images used for calibration')
+    parser.add_argument('--eval-count', type=int, default=4, help='other images used for the quality check')
+    parser.add_argument('--min-psnr', type=float, default=30.0, help='minimum PSNR in dB on every eval image')
+    parser.add_argument('--min-ssim', type=float, default=0.95, help='minimum SSIM on every eval image')
+    parser.add_argument('--model', default=restoration_worker.REALESRGAN_MODEL_PATH)
+    parser.add_argument('--output', default=INT8_MODEL_PATH)
+    parser.add_argument('--engine', help='quantized engine (default: x86, then fbgemm, then qnnpack)')
+    parser.add_argument('--force', action='store_true', help='save even if the quality gate fails')
+    args = parser.parse_args(argv)
+
+    paths = sorted(p for p in glob.glob(os.path.join(args.images, '**', '*'), recursive=True)
+                   if p.lower().endswith(IMAGE_EXTENSIONS) and not os.path.basename(p).startswith('.'))
+    if len(paths) < 2:
+        parser.error(f"need at least two images in {args.images}")
+    random.Random(0).shuffle(paths)
+    eval_paths = paths[:min(args.eval_count, len(paths) // 2)]
+    calibration_paths = paths[len(eval_paths):len(eval_paths) + args.calibration_count]
+
+    torch.set_num_threads(os.cpu_count() or 1)
+    model = RRDBNet(**restoration_worker.RRDBNET_ARGS)
+    model.load_state_dict(torch.load(args.model, map_location='cpu')['params_ema'], strict=True)
+    model.eval()
+
+    print(f"[Int8] Calibrating on {len(calibration_paths)} images...")
+    start = time.time()
+    int8_model = quantize(model, calibration_tiles(load_images(calibration_paths)), args.engine)
+    print(f"[Int8] Quantized in {time.time() - start:.1f}s; comparing with fp32 on {len(eval_paths)} images...")
+
+    summary, results = evaluate(model, int8_model, load_images(eval_paths))
+    report = dict(summary, engine=torch.backends.quantized.engine, source_checksum=model_checksum(args.model),
+                  calibration_images=calibration_paths, eval_images=eval_paths, per_image=results,
+                  min_psnr_required=args.min_psnr, min_ssim_required=args.min_ssim)
+    print(json.dumps({k: v for k, v in report.items() if k != 'per_image'}, indent=2))
+
+    passed = summary['min_psnr'] >= args.min_psnr and summary['min_ssim'] >= args.min_ssim
+    if not passed and not args.force:
+        print(f"[Int8] Quality gate failed (PSNR >= {args.min_psnr}, SSIM >= {args.min_ssim}); not saved")
+        return 1
+    report['passed'] = passed
+    save_quantized(int8_model, args.output, report)
+    print(f"[Int8] Saved {args.output}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,988 @@
+import os
+import gc
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import torch
+import numpy as np
+import cv2
+from PIL import Image
+from basicsr.archs.rrdbnet_arch import RRDBNet
+from gfpgan import GFPGANer
+from gfpgan.archs.gfpganv1_clean_arch import GFPGANv1Clean
+from facexlib.utils.face_restoration_helper import FaceRestoreHelper
+from tiled_upscale import upscale_image, upscale_bands
+from band_writer import open_band_writer
+from tile_batcher import DirectRunner, TileBatcher, StageRunner
+import tile_tuning
+import face_precheck
+import face_restore
+import quantize_esrgan
+import inference_backends
+import shared_weights
+import output_format
+import tile_checkpoint
+import metrics
+from result_cache import ResultCache, cache_key, file_digest, model_checksum, place_file
+
+UPLOAD_FOLDER = '/app/inputs'
+OUTPUT_FOLDER = '/app/outputs/frontend'
+REALESRGAN_MODEL_PATH = '/app/models/RealESRGAN_x4plus.pth'
+GFPGAN_MODEL_PATH = '/app/models/GFPGANv1.4.pth'
+
+# RealESRGAN_x4plus architecture
+RRDBNET_ARGS = dict(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
+
+TILE_CALIBRATION_PATH = '/app/models/tile_calibration.json'
+
+# 'int8' runs Real-ESRGAN with the quantized model built by quantize_esrgan.py
+# (CPU only); falls back to fp32 when it is missing or out of date
+ESRGAN_PRECISION = os.environ.get('ESRGAN_PRECISION', 'fp32')
+
+# 'auto' sizes tiles per job from free memory; a number forces that tile size
+ESRGAN_TILE = os.environ.get('ESRGAN_TILE', 'auto')
+TILE_PAD = 10
+
+# Tiles from concurrent jobs are stacked into one forward pass of up to
+# ESRGAN_BATCH_SIZE tiles; 1 runs every tile on its own
+ESRGAN_BATCH_SIZE = int(os.environ.get('ESRGAN_BATCH_SIZE', '4'))
+ESRGAN_BATCH_WAIT = float(os.environ.get('ESRGAN_BATCH_WAIT_MS', '10')) / 1000.0
+
+# On CPU, up to ESRGAN_TILE_LANES forward passes run at once, each with an
+# equal share of the torch threads, so one large image keeps every core busy
+# instead of one thread pool working through small tiles in turn. The share
+# is set process-wide and so also applies to GFPGAN. 'auto' gives every 4
+# threads a lane; 1 (default) runs one forward pass at a time.
+ESRGAN_TILE_LANES = os.environ.get('ESRGAN_TILE_LANES', '1')
+
+# With ESRGAN_SKIP_FLAT=1, tiles whose grey levels vary by at most
+# ESRGAN_FLAT_STD (standard deviation) and that have no edges or grain (mean
+# absolute Laplacian at most ESRGAN_FLAT_EDGE) are upscaled bicubically instead
+# of by the model: blank borders, mats and clear sky. Off by default
+ESRGAN_SKIP_FLAT = os.environ.get('ESRGAN_SKIP_FLAT', '0') == '1'
+ESRGAN_FLAT_STD = float(os.environ.get('ESRGAN_FLAT_STD', '12'))
+ESRGAN_FLAT_EDGE = float(os.environ.get('ESRGAN_FLAT_EDGE', '1.0'))
+
+# Inputs with at least this many pixels are upscaled band by band straight to
+# disk, so the 16x output never has to fit in memory; 0 disables streaming
+ESRGAN_STREAM_MIN_PIXELS = int(os.environ.get('ESRGAN_STREAM_MIN_PIXELS', str(4_000_000)))
+# Rows of tiles per band in streaming mode
+ESRGAN_BAND_TILES = int(os.environ.get('ESRGAN_BAND_TILES', '1'))
+
+# Before the full run, a copy of the upload shrunk to ESRGAN_PREVIEW_MAX_SIDE is
+# upscaled and saved as <output>.preview.jpg for the UI to show while it waits;
+# uploads under twice that size go straight to the full run
+ESRGAN_PREVIEW = os.environ.get('ESRGAN_PREVIEW', '1') != '0'
+ESRGAN_PREVIEW_MAX_SIDE = int(os.environ.get('ESRGAN_PREVIEW_MAX_SIDE', '192'))
+PREVIEW_JPEG_QUALITY = 85
+
+# Results are encoded on a pool of ENCODE_THREADS writer threads, so a job's
+# thread can start its next inference while the previous output is still being
+# written; once ENCODE_MAX_PENDING outputs are waiting, jobs block until one is done
+ENCODE_BACKGROUND = os.environ.get('ENCODE_BACKGROUND', '1') != '0'
+ENCODE_THREADS = int(os.environ.get('ENCODE_THREADS', '2'))
+ENCODE_MAX_PENDING = int(os.environ.get('ENCODE_MAX_PENDING', '4'))
+
+# Finished outputs keyed by input content, model checksum and settings
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', '/app/outputs/cache')
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', str(10 * 1024 ** 3)))
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES) if os.environ.get('RESULT_CACHE', '1') != '0' else None
+
+# GFPGANer settings; part of the GFPGAN cache key
+GFPGAN_SETTINGS = {'upscale': 1, 'arch': 'clean', 'channel_multiplier': 2, 'weight': 0.5, 'only_center_face': False}
+
+# Models are loaded once per process and reused for every job
+_model_lock = threading.Lock()
+_device = None
+_esrgan_model = None
+_esrgan_precision = None
+_esrgan_model_file = None
+_tile_runner = None
+_tile_lanes = 1
+_bytes_per_pixel = None
+_face_restorer = None
+# Encodes results in the background while jobs carry on
+_writer = ThreadPoolExecutor(max_workers=max(ENCODE_THREADS, 1), thread_name_prefix='writer')
+_write_slots = threading.BoundedSemaphore(max(ENCODE_MAX_PENDING, 1))
+# Output path -> Future of its background write, until the file is in place
+_pending_writes = {}
+_pending_lock = threading.Lock()
+# Output path -> request file of the job writing it (see withdrawn)
+_request_files = {}
+_request_lock = threading.Lock()
+# GFPGANer keeps per-image state in its FaceRestoreHelper, so one job at a time
+_face_lock = threading.Lock()
+
+def get_device():
+    """Pick MPS (Apple Silicon GPU), CUDA, or CPU"""
+    global _device
+    if _device is None:
+        if torch.backends.mps.is_available():
+            _device = torch.device("mps")
+        elif torch.cuda.is_available():
+            _device = torch.device("cuda")
+        else:
+            _device = torch.device("cpu")
+        print(f"Using device: {_device}")
+    return _device
+
+def build_esrgan_model(device):
+    """Eager RRDBNet with the Real-ESRGAN weights (memory-mapped and shared when SHARED_WEIGHTS is on)"""
+    if shared_weights.SHARED_WEIGHTS:
+        try:
+            return shared_weights.build_model(lambda: RRDBNet(**RRDBNET_ARGS), REALESRGAN_MODEL_PATH, device)
+        except Exception as e:
+            print(f"[Worker] Shared weights unavailable for Real-ESRGAN ({e}), loading the .pth")
+    state_dict = torch.load(REALESRGAN_MODEL_PATH, map_location=device)['params_ema']
+    model = RRDBNet(**RRDBNET_ARGS).to(device)
+    model.load_state_dict(state_dict, strict=True)
+    model.eval()
+    return model
+
+def get_esrgan_model():
+    """Return the resident RRDBNet (or its int8/exported graph), loading it on first use"""
+    global _esrgan_model, _esrgan_precision, _esrgan_model_file
+    with _model_lock:
+        if _esrgan_model is None:
+            device = get_device()
+            start = time.time()
+            model = None
+            if ESRGAN_PRECISION == 'int8':
+                if device.type == 'cpu':
+                    model = quantize_esrgan.load_quantized(quantize_esrgan.INT8_MODEL_PATH, REALESRGAN_MODEL_PATH)
+                if model is None:
+                    print(f"[Worker] No usable int8 Real-ESRGAN model for {device}, using fp32")
+                else:
+                    _esrgan_precision, _esrgan_model_file = 'int8', quantize_esrgan.INT8_MODEL_PATH
+
+            if model is None and inference_backends.INFERENCE_BACKEND != 'eager':
+                model = inference_backends.load_graph(inference_backends.INFERENCE_BACKEND, REALESRGAN_MODEL_PATH, device)
+                if model is not None:
+                    _esrgan_precision = 'fp32'
+                    _esrgan_model_file = inference_backends.export_path(
+                        REALESRGAN_MODEL_PATH, inference_backends.INFERENCE_BACKEND)
+
+            if model is None:
+                model = build_esrgan_model(device)
+                _esrgan_precision, _esrgan_model_file = 'fp32', REALESRGAN_MODEL_PATH
+
+            _esrgan_model = model
+            metrics.MODEL_LOAD.observe(time.time() - start, model='realesrgan')
+            print(f"[Worker] Real-ESRGAN model ({os.path.basename(_esrgan_model_file)}) "
+                  f"loaded in {time.time() - start:.2f}s")
+    return _esrgan_model
+
+def get_esrgan_precision():
+    """'fp32' or 'int8': the precision the resident model actually runs at"""
+    get_esrgan_model()
+    return _esrgan_precision
+
+def tile_lanes(device):
+    """How many forward passes to run at once (always 1 off the CPU, where they would just queue)"""
+    if device.type != 'cpu':
+        return 1
+    if ESRGAN_TILE_LANES == 'auto':
+        return max(torch.get_num_threads() // 4, 1)
+    return max(min(int(ESRGAN_TILE_LANES), torch.get_num_threads()), 1)
+
+def get_tile_runner():
+    """Return the shared tile runner (batched across jobs when ESRGAN_BATCH_SIZE > 1,
+    parallel across tiles when there is more than one lane)"""
+    global _tile_runner, _tile_lanes
+    model = get_esrgan_model()
+    with _model_lock:
+        if _tile_runner is None:
+            device = get_device()
+            lanes = tile_lanes(device)
+            if lanes > 1:
+                threads = torch.get_num_threads()
+                torch.set_num_threads(max(threads // lanes, 1))
+                print(f"[Worker] {lanes} tile lanes with {torch.get_num_threads()} torch threads each")
+            if ESRGAN_BATCH_SIZE > 1 or lanes > 1:
+                _tile_runner = TileBatcher(model, device, ESRGAN_BATCH_SIZE, ESRGAN_BATCH_WAIT, lanes)
+                print(f"[Worker] Batching up to {ESRGAN_BATCH_SIZE} tiles per forward pass "
+                      f"(max wait {ESRGAN_BATCH_WAIT * 1000:.0f}ms)")
+            else:
+                _tile_runner = DirectRunner(model, device)
+            _tile_lanes = lanes
+    return _tile_runner
+
+def tile_window():
+    """Tiles an image keeps in flight: enough to fill every lane with full batches twice over"""
+    return max(16, 2 * ESRGAN_BATCH_SIZE * _tile_lanes)
+
+def get_bytes_per_pixel():
+    """Peak memory per input pixel of one Real-ESRGAN forward pass, calibrated once"""
+    global _bytes_per_pixel
+    model = get_esrgan_model()
+    with _model_lock:
+        if _bytes_per_pixel is None:
+            _bytes_per_pixel = tile_tuning.load_calibration(
+                model, get_device(), TILE_CALIBRATION_PATH, _esrgan_model_file)
+    return _bytes_per_pixel
+
+def pick_tile(height, width):
+    """Tile size and padding for an image of this size"""
+    if ESRGAN_TILE != 'auto':
+        return int(ESRGAN_TILE), TILE_PAD
+    # Every lane holds a batch in memory at the same time
+    return tile_tuning.choose_tile(height, width, get_bytes_per_pixel(), scale=4,
+                                   batch=ESRGAN_BATCH_SIZE * _tile_lanes)
+
+def flat_threshold():
+    """(max std, max mean |Laplacian|) for tiled_upscale's flat-tile skipping, or None when it's off"""
+    return (ESRGAN_FLAT_STD, ESRGAN_FLAT_EDGE) if ESRGAN_SKIP_FLAT else None
+
+def report_skipped_tiles(stats, seconds):
+    """Log and count how many tiles were interpolated and roughly how much model time that saved"""
+    skipped, model = stats.get('skipped_tiles', 0), stats.get('model_tiles', 0)
+    if not skipped and not model:
+        return
+    metrics.TILES.inc(skipped, method='interpolated')
+    metrics.TILES.inc(model, method='model')
+    if not skipped:
+        return
+    # Model time scales with pixels, so the skipped pixels would have taken this much longer
+    saved = 0.0
+    if stats.get('model_pixels'):
+        model_seconds = max(seconds - stats.get('interpolate_seconds', 0.0), 0.0)
+        saved = model_seconds * stats['skipped_pixels'] / stats['model_pixels']
+    metrics.TILE_SKIP_SAVED.inc(saved)
+    print(f"[Skip] {skipped}/{skipped + model} tiles flat, interpolated "
+          f"({100.0 * skipped / (skipped + model):.0f}%), ~{saved:.1f}s saved")
+
+def open_checkpoint(input_path, img):
+    """Tile checkpoint for upscaling input_path, or None when the input is too small for one
+    (or it can't be opened). Every output format of a result shares one checkpoint."""
+    if not tile_checkpoint.wanted(img.shape[0] * img.shape[1]):
+        return None
+    try:
+        return tile_checkpoint.open_checkpoint(esrgan_cache_key(input_path))
+    except Exception as e:
+        print(f"[Checkpoint] Running without a checkpoint: {e}")
+        return None
+
+def checkpoint_output(checkpoint, img, tile, tile_pad, dtype):
+    """(output array, finished tile indices) from the checkpoint, or (None, None) without one"""
+    if checkpoint is None:
+        return None, None
+    height, width = img.shape[:2]
+    try:
+        return checkpoint.open_image((height * 4, width * 4, 3), dtype, tile, tile_pad, 'bgr')
+    except Exception as e:
+        print(f"[Checkpoint] Running without a checkpoint: {e}")
+        checkpoint.remove()
+        return None, None
+
+def upscale_with_retry(img, runner, tile, tile_pad, dtype=np.uint8, checkpoint=None, report=True):
+    """Upscale an RGB image to BGR, halving the tile size whenever a forward pass runs out of memory.
+
+    With a checkpoint (see open_checkpoint), tiles are written into its memory
+    map as they finish and tiles an earlier run finished are not run again.
+    Tiles are counted in the tile metrics unless `report` is False.
+    """
+    while True:
+        try:
+            print(f"Tile size: {tile or 'whole image'} (pad {tile_pad})")
+            output, done = checkpoint_output(checkpoint, img, tile, tile_pad, dtype)
+            on_tile = checkpoint.tile_done if output is not None else None
+            stats, start = {}, time.perf_counter()
+            output = upscale_image(img, runner, scale=4, tile=tile, tile_pad=tile_pad, window=tile_window(),
+                                   channel_order='bgr', dtype=dtype, flat=flat_threshold(), stats=stats,
+                                   output=output, done=done, on_tile=on_tile)
+            if on_tile is not None:
+                checkpoint.save()
+            if stats.get('resumed_tiles'):
+                print(f"[Checkpoint] {stats['resumed_tiles']} tile(s) restored from the checkpoint")
+            if report:
+                report_skipped_tiles(stats, time.perf_counter() - start)
+            return output
+        except Exception as e:
+            if not tile_tuning.is_out_of_memory(e):
+                raise
+            smaller = (tile or max(img.shape[:2])) // 2
+            if smaller < tile_tuning.MIN_TILE:
+                raise
+            print(f"[Worker] Out of memory with tile {tile or 'whole image'}, retrying with tile {smaller}")
+            tile, tile_pad = smaller, max(tile_pad, TILE_PAD)
+            gc.collect()
+
+def use_streaming(height, width):
+    return ESRGAN_STREAM_MIN_PIXELS > 0 and height * width >= ESRGAN_STREAM_MIN_PIXELS
+
+def upscale_to_file(img, runner, tile, tile_pad, output_path, encoding=None, checkpoint=None):
+    """Upscale an RGB image band by band into output_path, never holding the whole output.
+
+    Halves the tile size and starts over whenever a forward pass runs out of
+    memory. With a checkpoint, each finished band is also saved to it, and
+    bands an earlier run saved are read back instead of upscaled again.
+    Returns False if the job was withdrawn and the file was not put in place.
+    """
+    height, width = img.shape[:2]
+    if tile <= 0:
+        # Bands are rows of tiles, so streaming always tiles
+        tile = min(max(height, width), tile_tuning.MAX_TILE)
+    while True:
+        dtype = output_dtype(output_path)
+        params = imwrite_params(output_path, encoding)
+        # The streamed PNG takes the same level cv2.imwrite would (the job's, else OUTPUT_PNG_COMPRESSION)
+        png_level = params[1] if params[:1] == [cv2.IMWRITE_PNG_COMPRESSION] else None
+        writer, channel_order = open_band_writer(output_path, width * 4, height * 4, params, dtype, png_level)
+        encode_seconds = 0.0
+        stats, upscale_start = {}, time.perf_counter()
+        try:
+            print(f"Tile size: {tile} (pad {tile_pad}), streaming {ESRGAN_BAND_TILES} tile row(s) per band")
+            done = None
+            if checkpoint is not None:
+                done = checkpoint.open_bands((height * 4, width * 4, 3), dtype, tile, tile_pad, ESRGAN_BAND_TILES,
+                                             channel_order)
+                if done:
+                    print(f"[Checkpoint] {len(done)} band(s) restored from the checkpoint")
+            for row, band in upscale_bands(img, runner, scale=4, tile=tile, tile_pad=tile_pad, window=tile_window(),
+                                           channel_order=channel_order, band_tiles=ESRGAN_BAND_TILES, dtype=dtype,
+                                           flat=flat_threshold(), stats=stats, done=done):
+                start = time.perf_counter()
+                if band is None:
+                    band = checkpoint.load_band(row)
+                elif checkpoint is not None:
+                    checkpoint.save_band(row, band)
+                writer.write(band)
+                encode_seconds += time.perf_counter() - start
+            if withdrawn(output_path):
+                writer.abort()
+                return False
+            start = time.perf_counter()
+            writer.close()
+            encode_seconds += time.perf_counter() - start
+            metrics.ENCODE.observe(encode_seconds, stage='esrgan')
+            report_skipped_tiles(stats, time.perf_counter() - upscale_start - encode_seconds)
+            return True
+        except Exception as e:
+            writer.abort()
+            if not tile_tuning.is_out_of_memory(e):
+                raise
+            smaller = tile // 2
+            if smaller < tile_tuning.MIN_TILE:
+                raise
+            print(f"[Worker] Out of memory with tile {tile}, retrying with tile {smaller}")
+            tile, tile_pad = smaller, max(tile_pad, TILE_PAD)
+            gc.collect()
+
+def build_shared_face_restorer(device=None):
+    """GFPGANer whose generator weights are memory-mapped from the shared weights file.
+
+    Sets up the same attributes as GFPGANer.__init__ for arch='clean', minus
+    its torch.load of the .pth.
+    """
+    restorer = GFPGANer.__new__(GFPGANer)
+    restorer.upscale = GFPGAN_SETTINGS['upscale']
+    restorer.bg_upsampler = None
+    restorer.device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    restorer.gfpgan = shared_weights.build_model(
+        lambda: GFPGANv1Clean(out_size=512, num_style_feat=512, channel_multiplier=GFPGAN_SETTINGS['channel_multiplier'],
+                              decoder_load_path=None, fix_decoder=False, num_mlp=8, input_is_latent=True,
+                              different_w=True, narrow=1, sft_half=True),
+        GFPGAN_MODEL_PATH, restorer.device)
+    restorer.face_helper = FaceRestoreHelper(
+        restorer.upscale, face_size=512, crop_ratio=(1, 1), det_model='retinaface_resnet50', save_ext='png',
+        use_parse=True, device=restorer.device, model_rootpath='gfpgan/weights')
+    return restorer
+
+def build_face_restorer(device=None):
+    """GFPGANer with the eager GFPGAN generator"""
+    if shared_weights.SHARED_WEIGHTS and GFPGAN_SETTINGS['arch'] == 'clean':
+        try:
+            return build_shared_face_restorer(device)
+        except Exception as e:
+            print(f"[Worker] Shared weights unavailable for GFPGAN ({e}), loading the .pth")
+    return GFPGANer(
+        model_path=GFPGAN_MODEL_PATH,
+        upscale=GFPGAN_SETTINGS['upscale'],  # Don't upscale since image is already enhanced by Real-ESRGAN
+        arch=GFPGAN_SETTINGS['arch'],
+        channel_multiplier=GFPGAN_SETTINGS['channel_multiplier'],
+        bg_upsampler=None,  # We already enhanced with Real-ESRGAN
+        device=device
+    )
+
+def get_face_restorer():
+    """Return the resident GFPGANer, loading it on first use"""
+    global _face_restorer
+    with _model_lock:
+        if _face_restorer is None:
+            get_device()
+            start = time.time()
+            _face_restorer = build_face_restorer()
+            if inference_backends.INFERENCE_BACKEND != 'eager':
+                # Face detection and paste-back stay in GFPGANer; only the generator is swapped
+                graph = inference_backends.load_graph(
+                    inference_backends.INFERENCE_BACKEND, GFPGAN_MODEL_PATH, _face_restorer.device)
+                if graph is not None:
+                    _face_restorer.gfpgan = inference_backends.FaceGraph(graph)
+            metrics.MODEL_LOAD.observe(time.time() - start, model='gfpgan')
+            print(f"[Worker] GFPGAN model loaded in {time.time() - start:.2f}s")
+    return _face_restorer
+
+def configure_worker(num_threads, memory_share=1.0):
+    """Limit this process to num_threads torch threads and a share of the memory budget"""
+    torch.set_num_threads(num_threads)
+    tile_tuning.MEMORY_FRACTION *= memory_share
+
+def warm_up():
+    """Load both models (and calibrate tiling) up front so the first job doesn't pay for it"""
+    loaders = [get_tile_runner, get_face_restorer]
+    if ESRGAN_TILE == 'auto':
+        loaders.append(get_bytes_per_pixel)
+    for loader in loaders:
+        try:
+            loader()
+        except Exception as e:
+            print(f"[Worker] Could not preload model: {e}")
+
+def temp_path_for(path):
+    """Hidden sibling of path with the same extension, for write-then-rename"""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".tmp-{uuid.uuid4().hex}-{name}")
+
+def track_request(process_file, paths):
+    """Note that paths are the outputs of the job requested by process_file"""
+    with _request_lock:
+        for path in paths:
+            _request_files[path] = process_file
+
+def untrack_request(process_file):
+    """Forget the job's outputs, and any of their failed writes when_written() didn't collect
+    (the handler raised), so they aren't reported for a later job writing the same path"""
+    with _request_lock:
+        paths = [p for p, f in _request_files.items() if f == process_file]
+        for path in paths:
+            del _request_files[path]
+    with _pending_lock:
+        for path in paths:
+            future = _pending_writes.get(path)
+            if future is not None and future.done() and future.exception() is not None:
+                del _pending_writes[path]
+
+def withdrawn(path):
+    """True if the job writing path was withdrawn: the frontend timed out, removed the
+    request file and put its fallback at path, which the late result must not replace"""
+    with _request_lock:
+        process_file = _request_files.get(path)
+    if process_file is None or os.path.exists(process_file):
+        return False
+    print(f"[Worker] Job for {os.path.basename(path)} was withdrawn, leaving the frontend's fallback in place")
+    return True
+
+def write_image(path, img, stage, params=()):
+    """cv2.imwrite through a temp file, so readers never see a partial image"""
+    tmp_path = temp_path_for(path)
+    with metrics.ENCODE.time(stage=stage):
+        if not cv2.imwrite(tmp_path, img, list(params)):
+            raise Exception(f"Could not write image to: {path}")
+    os.replace(tmp_path, path)
+
+def fit_encoding(input_path, encoding, scale):
+    """The job's encoding adjusted to the size of input_path's result (see output_format.fit)"""
+    try:
+        with Image.open(input_path) as img:
+            width, height = img.size
+    except Exception:
+        return encoding
+    fitted = output_format.fit(encoding, width * scale, height * scale)
+    if fitted != encoding:
+        print(f"[Encode] A {width * scale}x{height * scale} result is too large for WebP, saving it as PNG")
+    return fitted
+
+def imwrite_params(path, encoding=None):
+    """cv2.imwrite flags for path's format and the job's encoding options (see output_format)"""
+    encoding = encoding or {}
+    fmt = output_format.format_of(path)
+    if fmt == 'png':
+        level = encoding.get('compression', output_format.PNG_COMPRESSION)
+        return [cv2.IMWRITE_PNG_COMPRESSION, int(level)] if level not in (None, '') else []
+    if fmt == 'webp':
+        # Quality above 100 selects lossless WebP
+        return [cv2.IMWRITE_WEBP_QUALITY, 101]
+    if fmt == 'jpeg':
+        return [cv2.IMWRITE_JPEG_QUALITY, int(encoding.get('quality', output_format.JPEG_QUALITY))]
+    if fmt == 'tiff':
+        return [cv2.IMWRITE_TIFF_COMPRESSION, 5]  # LZW
+    return []
+
+def output_dtype(path):
+    """np.uint16 for 16-bit formats (TIFF), else np.uint8"""
+    return np.uint16 if output_format.is_16bit(path) else np.uint8
+
+def encode_image(path, img, stage, encoding=None):
+    """write_image in path's format with the job's options, converting to the format's bit depth"""
+    dtype = output_dtype(path)
+    if img.dtype == np.uint8 and dtype == np.uint16:
+        img = img.astype(np.uint16) * 257
+    elif img.dtype == np.uint16 and dtype == np.uint8:
+        img = ((img.astype(np.uint32) + 128) // 257).astype(np.uint8)
+    write_image(path, img, stage, imwrite_params(path, encoding))
+
+def copy_image(src, dest, stage, encoding=None):
+    """Put src at dest as is, or re-encoded if dest is in another format"""
+    if withdrawn(dest):
+        return
+    if output_format.format_of(src) == output_format.format_of(dest):
+        place_file(src, dest)
+        return
+    img = cv2.imread(src, cv2.IMREAD_COLOR | cv2.IMREAD_ANYDEPTH)
+    if img is None:
+        raise Exception(f"Could not load image from: {src}")
+    encode_image(dest, img, stage, encoding)
+
+def save_result(path, img, stage, encoding=None, key=None):
+    """Encode a finished result and store it in the result cache"""
+    if withdrawn(path):
+        # Still cached, so the same upload sent again is served at once
+        if result_cache is not None and key is not None:
+            tmp_path = temp_path_for(path)
+            try:
+                encode_image(tmp_path, img, stage, encoding)
+                store_cached(key, tmp_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return
+    try:
+        encode_image(path, img, stage, encoding)
+    except Exception as e:
+        # Never leave the job without an output; not cached, since it isn't what was asked for
+        print(f"[Encode] Could not write {os.path.basename(path)} with {encoding or 'defaults'} ({e}), "
+              f"retrying with OpenCV's defaults")
+        write_image(path, img, stage)
+        return
+    store_cached(key, path)
+
+def finish_result(path, img, stage, encoding=None, key=None, after=None, checkpoint=None):
+    """save_result() on the writer pool (inline with ENCODE_BACKGROUND=0).
+
+    Returns the Future of the write, or None if it already happened. With
+    `after` (another write's Future), the file is only put in place once that
+    write is done, so readers see outputs appear in the order they were queued.
+    The job's tile checkpoint, if given, is removed once the file is written,
+    or released (kept for the next run of the job) if writing it fails.
+    """
+    def write():
+        if after is not None:
+            wait([after])
+        try:
+            save_result(path, img, stage, encoding, key)
+        except Exception:
+            if checkpoint is not None:
+                checkpoint.release()
+            raise
+        if checkpoint is not None:
+            checkpoint.remove()
+
+    if not ENCODE_BACKGROUND:
+        write()
+        return None
+    _write_slots.acquire()
+    try:
+        future = _writer.submit(write)
+    except Exception:
+        _write_slots.release()
+        raise
+    with _pending_lock:
+        _pending_writes[path] = future
+
+    def done(future):
+        _write_slots.release()
+        if future.exception() is not None:
+            # Kept until when_written() collects it, so a write that fails before the job asks still counts
+            print(f"[Encode] Failed to write {os.path.basename(path)}: {future.exception()}")
+            return
+        with _pending_lock:
+            if _pending_writes.get(path) is future:
+                del _pending_writes[path]
+    future.add_done_callback(done)
+    return future
+
+def wait_for_output(path):
+    """Block until a queued background write of path (if any) has finished"""
+    with _pending_lock:
+        future = _pending_writes.get(path)
+    if future is not None:
+        wait([future])
+
+def when_written(paths, callback):
+    """Call callback(error) once the queued background writes of paths (if any) have finished.
+
+    error is the exception of a failed write, or None; failed writes that
+    finished earlier are reported too. Runs right away (on this thread) when
+    none of the paths has a write pending.
+    """
+    with _pending_lock:
+        writes = [(path, _pending_writes[path]) for path in paths if path in _pending_writes]
+    futures = [future for _, future in writes]
+    if not futures:
+        callback(None)
+        return
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        with _pending_lock:
+            # Failed writes stay registered only until they are reported here
+            for path, future in writes:
+                if _pending_writes.get(path) is future:
+                    del _pending_writes[path]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        try:
+            callback(errors[0] if errors else None)
+        except Exception as e:
+            print(f"[Encode] Completion callback failed: {e}")
+
+    for future in futures:
+        future.add_done_callback(done)
+
+def encoding_key(encoding):
+    # Default encoding adds nothing, so existing cache entries stay valid
+    return {'encoding': encoding} if encoding else {}
+
+def esrgan_cache_key(input_path, encoding=None):
+    # fp32 keys stay as they were; int8 outputs differ slightly, so they get their own
+    precision = {} if ESRGAN_PRECISION == 'fp32' or get_esrgan_precision() == 'fp32' else {'precision': 'int8'}
+    # Likewise for flat-tile skipping, which changes the output where it applies
+    flat = {'flat': list(flat_threshold())} if ESRGAN_SKIP_FLAT else {}
+    # No tile size: with TILE_PAD of context around each tile, results of different tile sizes differ
+    # only by a few levels near seams, while the size 'auto' picks (or an out-of-memory retry falls
+    # back to) varies from run to run and would split the cache and orphan checkpoints keyed by this
+    return cache_key(stage='esrgan', input=file_digest(input_path),
+                     model=model_checksum(REALESRGAN_MODEL_PATH), scale=4,
+                     **precision, **flat, **encoding_key(encoding))
+
+def gfpgan_cache_key(input_path, encoding=None):
+    return cache_key(stage='gfpgan', input=file_digest(input_path), model=model_checksum(GFPGAN_MODEL_PATH),
+                     precheck=face_precheck.FACE_PRECHECK, detect_scale=face_restore.FACE_DETECT_SCALE,
+                     **GFPGAN_SETTINGS, **encoding_key(encoding))
+
+def pipeline_cache_key(esrgan_key):
+    # The fused path never has the intermediate file to hash, so chain off the ESRGAN key
+    # (which already includes the encoding)
+    return cache_key(stage='pipeline', esrgan=esrgan_key, model=model_checksum(GFPGAN_MODEL_PATH),
+                     precheck=face_precheck.FACE_PRECHECK, detect_scale=face_restore.FACE_DETECT_SCALE,
+                     **GFPGAN_SETTINGS)
+
+def fetch_cached(key, output_path):
+    """Serve output_path from the result cache; True on a hit"""
+    if result_cache is None or key is None:
+        return False
+    if withdrawn(output_path):
+        return result_cache.get(key, os.path.splitext(output_path)[1]) is not None
+    if result_cache.fetch(key, os.path.splitext(output_path)[1], output_path):
+        metrics.CACHE.inc(result='hit')
+        print(f"[Cache] Hit {key[:12]} -> {os.path.basename(output_path)}")
+        return True
+    metrics.CACHE.inc(result='miss')
+    return False
+
+def store_cached(key, output_path):
+    if result_cache is None or key is None or withdrawn(output_path):
+        return
+    try:
+        result_cache.put(key, os.path.splitext(output_path)[1], output_path)
+    except OSError as e:
+        print(f"[Cache] Could not store {os.path.basename(output_path)}: {e}")
+
+def precheck_faces(input_path, output_path, img=None):
+    """Look for faces in the low-res input and store the result next to output_path.
+
+    img is the decoded RGB input if the caller already has it. Returns the
+    stored pre-check, or None if it is disabled or failed (GFPGAN then scans
+    the whole image as before).
+    """
+    if not face_precheck.FACE_PRECHECK:
+        return None
+    try:
+        if img is None:
+            img = cv2.imread(input_path, cv2.IMREAD_GRAYSCALE)
+            if img is None:
+                raise Exception(f"Could not load image from: {input_path}")
+        with metrics.INFERENCE.time(stage='face_precheck'):
+            faces = face_precheck.detect_faces(img, channel_order='rgb')
+        print(f"[Faces] Pre-check found {len(faces)} face(s) in {os.path.basename(input_path)}")
+        return face_precheck.write_sidecar(output_path, faces, (img.shape[1], img.shape[0]))
+    except Exception as e:
+        print(f"[Faces] Pre-check failed, GFPGAN will scan the whole image: {e}")
+        return None
+
+def preview_path(output_path):
+    return f"{output_path}.preview.jpg"
+
+def discard_previews(output_paths):
+    """Remove the previews of these outputs, which are only shown while their job runs"""
+    for path in output_paths:
+        try:
+            os.remove(preview_path(path))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"[Preview] Could not remove preview of {os.path.basename(path)}: {e}")
+
+def write_preview(img, output_path, runner):
+    """Upscale a shrunk copy of the RGB input and save it as output_path's preview.
+
+    Returns True if a preview was written. Small uploads get none, since
+    their full result would not take much longer.
+    """
+    height, width = img.shape[:2]
+    if not ESRGAN_PREVIEW or max(height, width) < 2 * ESRGAN_PREVIEW_MAX_SIDE:
+        return False
+    try:
+        factor = ESRGAN_PREVIEW_MAX_SIDE / max(height, width)
+        size = (max(round(width * factor), 1), max(round(height * factor), 1))
+        small = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        # Its tiles are timed as 'preview' and left out of the tile counts, so they don't skew the real jobs'
+        with metrics.INFERENCE.time(stage='preview'):
+            preview = upscale_with_retry(small, StageRunner(runner, 'preview'), *pick_tile(*small.shape[:2]),
+                                         report=False)
+        write_image(preview_path(output_path), preview, 'preview', (cv2.IMWRITE_JPEG_QUALITY, PREVIEW_JPEG_QUALITY))
+        print(f"[Preview] {preview.shape[1]}x{preview.shape[0]} preview saved for {os.path.basename(output_path)}")
+        return True
+    except Exception as e:
+        print(f"[Preview] Could not write preview: {e}")
+        return False
+
+def process_realesrgan(input_filename, output_filename, encoding=None):
+    """Upscale /app/inputs/<input_filename> 4x into /app/outputs/frontend/<output_filename>.
+
+    The output is encoded in output_filename's format with the job's
+    `encoding` options, in the background unless it was streamed to disk.
+    Returns 'ok', 'cached' or 'fallback'.
+    """
+    print("Applying Real-ESRGAN for super resolution...")
+    input_path = os.path.join(UPLOAD_FOLDER, input_filename)
+    output_path = os.path.join(OUTPUT_FOLDER, output_filename)
+
+    key = checkpoint = None
+    try:
+        key = esrgan_cache_key(input_path, encoding)
+        if fetch_cached(key, output_path):
+            precheck_faces(input_path, output_path)
+            return 'cached'
+
+        runner = get_tile_runner()
+
+        # Load and process with Real-ESRGAN
+        with metrics.DECODE.time(stage='esrgan'):
+            img = Image.open(input_path).convert('RGB')
+            img = np.array(img)
+
+        print(f"Input image shape: {img.shape}")
+        write_preview(img, output_path, runner)
+        precheck_faces(input_path, output_path, img)
+
+        # Run Real-ESRGAN inference, sized to the memory we have (BGR out for OpenCV saving)
+        tile, tile_pad = pick_tile(*img.shape[:2])
+        checkpoint = open_checkpoint(input_path, img)
+        streaming = use_streaming(*img.shape[:2])
+        if checkpoint is not None:
+            # A resumed run has to cut the image into the same tiles as before
+            tile, tile_pad = checkpoint.resume_tiling('bands' if streaming else 'tiles', tile, tile_pad)
+        if streaming:
+            # Very large scans: write each band as soon as it is upscaled
+            with metrics.INFERENCE.time(stage='esrgan'):
+                written = upscale_to_file(img, runner, tile, tile_pad, output_path, encoding, checkpoint)
+            store_cached(key, output_path)
+            if checkpoint is not None and written:
+                checkpoint.remove()
+            elif checkpoint is not None:
+                # A withdrawn job's streamed result isn't cached; its checkpoint lets a re-upload finish at once
+                checkpoint.release()
+            print(f"Real-ESRGAN processing complete - saved as {output_filename}")
+        else:
+            with metrics.INFERENCE.time(stage='esrgan'):
+                esrgan_output_bgr = upscale_with_retry(img, runner, tile, tile_pad, output_dtype(output_path),
+                                                       checkpoint)
+            print(f"Enhanced image shape: {esrgan_output_bgr.shape}")
+
+            # Save result (and cache it) while this thread moves on; the checkpoint goes once it's written
+            finish_result(output_path, esrgan_output_bgr, 'esrgan', encoding, key, checkpoint=checkpoint)
+            print(f"Real-ESRGAN processing complete - saving as {output_filename}")
+        return 'ok'
+
+    except Exception as e:
+        print(f"Error during Real-ESRGAN processing: {e}")
+        if checkpoint is not None:
+            # Kept for the next run of this job
+            checkpoint.release()
+        # Fallback: just copy and resize the original image (never cached)
+        if withdrawn(output_path):
+            return 'fallback'
+        img = Image.open(input_path).convert('RGB')
+        width, height = img.size
+        img_resized = img.resize((width * 4, height * 4), Image.LANCZOS)
+        tmp_path = temp_path_for(output_path)
+        img_resized.save(tmp_path)
+        os.replace(tmp_path, output_path)
+        print(f"Fallback processing complete - saved as {output_filename}")
+        return 'fallback'
+
+def restore_faces(img, regions=None, low_res=None):
+    """Run GFPGAN on a BGR image and return the BGR result.
+
+    With `regions` (x0, y0, x1, y1) from the face pre-check, only those parts
+    of the image are searched and restored; an empty list returns img as is.
+    Faces are detected on a downscaled copy, or on `low_res` (the same picture
+    at lower resolution) for the whole-image case.
+    """
+    if regions == []:
+        print("[Faces] No faces found by the pre-check, skipping GFPGAN")
+        metrics.GFPGAN_FACES.observe(0)
+        return img
+    face_restorer = get_face_restorer()
+
+    def enhance(part, part_low_res=None):
+        cropped_faces, restored_faces, output = face_restore.enhance(
+            face_restorer,
+            part,
+            weight=GFPGAN_SETTINGS['weight'],
+            only_center_face=GFPGAN_SETTINGS['only_center_face'],
+            low_res=part_low_res
+        )
+        return len(restored_faces), output
+
+    with _face_lock, metrics.INFERENCE.time(stage='gfpgan'):
+        if regions is None:
+            faces, final_output = enhance(img, low_res)
+        else:
+            print(f"[Faces] Restoring {len(regions)} region(s) found by the pre-check")
+            faces, final_output = 0, img.copy()
+            for x0, y0, x1, y1 in regions:
+                found, output = enhance(np.ascontiguousarray(img[y0:y1, x0:x1]))
+                final_output[y0:y1, x0:x1] = output
+                faces += found
+    metrics.GFPGAN_FACES.observe(faces)
+    return final_output
+
+def process_gfpgan(input_filename, output_filename, encoding=None):
+    """Restore faces in /app/outputs/frontend/<input_filename> into <output_filename>.
+
+    Returns 'ok', 'cached', 'skipped' (the pre-check found no faces) or 'fallback'.
+    """
+    print("Applying GFPGAN for face enhancement...")
+    input_path = os.path.join(OUTPUT_FOLDER, input_filename)
+    output_path = os.path.join(OUTPUT_FOLDER, output_filename)
+    wait_for_output(input_path)
+
+    try:
+        key = gfpgan_cache_key(input_path, encoding)
+        if fetch_cached(key, output_path):
+            return 'cached'
+
+        precheck = face_precheck.read_sidecar(input_path) if face_precheck.FACE_PRECHECK else None
+        if precheck is not None and not precheck['faces']:
+            # Nothing to restore; the result is the input unchanged
+            copy_image(input_path, output_path, 'gfpgan', encoding)
+            print(f"No faces found by the pre-check - copied {input_filename} as {output_filename}")
+            return 'skipped'
+
+        print(f"Loading image from: {input_path}")
+        with metrics.DECODE.time(stage='gfpgan'):
+            img = cv2.imread(input_path)
+        if img is None:
+            raise Exception(f"Could not load image from: {input_path}")
+
+        print(f"Input image shape: {img.shape}")
+
+        # Enhance faces with GFPGAN, only where the pre-check found them
+        regions = face_precheck.face_regions(precheck, img.shape[1], img.shape[0]) if precheck else None
+        final_output = restore_faces(img, regions)
+
+        print("GFPGAN processing complete")
+        print(f"Final output shape: {final_output.shape}")
+
+        finish_result(output_path, final_output, 'gfpgan', encoding, key)
+        print(f"GFPGAN processing complete - saving as {output_path}")
+        return 'ok'
+
+    except Exception as e:
+        print(f"Error during GFPGAN processing: {e}")
+        import traceback
+        traceback.print_exc()
+
+        # Fallback: just copy the input file if GFPGAN fails (never cached)
+        if os.path.exists(input_path):
+            copy_image(input_path, output_path, 'gfpgan', encoding)
+            print(f"Fallback: copied {input_filename} as {output_filename}")
+        else:
+            print(f"Error: Input file not found at {input_path}")
+        return 'fallback'
+
+def process_pipeline(input_filename, esrgan_filename, final_filename, write_intermediate=True, encoding=None):
+    """Real-ESRGAN then GFPGAN in one pass, handing the upscaled array straight to GFPGAN.
+
+    Both results are encoded in the background: the Real-ESRGAN one (when
+    `write_intermediate` is set) while GFPGAN runs, the final one after it.
+    Falls back to the two separate stages if anything goes wrong. Returns
+    'ok', 'cached' or 'fallback'.
+    """
+    print("Applying Real-ESRGAN + GFPGAN pipeline...")
+    input_path = os.path.join(UPLOAD_FOLDER, input_filename)
+    esrgan_path = os.path.join(OUTPUT_FOLDER, esrgan_filename)
+    final_path = os.path.join(OUTPUT_FOLDER, final_filename)
+
+    intermediate = checkpoint = None
+    try:
+        esrgan_key = esrgan_cache_key(input_path, encoding)
+        final_key = pipeline_cache_key(esrgan_key)
+        if fetch_cached(final_key, final_path) and (not write_intermediate or fetch_cached(esrgan_key, esrgan_path)):
+            return 'cached'
+
+        runner = get_tile_runner()
+        with metrics.DECODE.time(stage='pipeline'):
+            img = np.array(Image.open(input_path).convert('RGB'))
+        print(f"Input image shape: {img.shape}")
+        write_preview(img, esrgan_path, runner)
+        precheck = precheck_faces(input_path, esrgan_path, img)
+
+        # Real-ESRGAN straight to BGR, which is what GFPGAN expects
+        tile, tile_pad = pick_tile(*img.shape[:2])
+        checkpoint = open_checkpoint(input_path, img)
+        if checkpoint is not None:
+            tile, tile_pad = checkpoint.resume_tiling('tiles', tile, tile_pad)
+        with metrics.INFERENCE.time(stage='esrgan'):
+            esrgan_output_bgr = upscale_with_retry(img, runner, tile, tile_pad, checkpoint=checkpoint)
+        print(f"Enhanced image shape: {esrgan_output_bgr.shape}")
+
+        if write_intermediate:
+            intermediate = finish_result(esrgan_path, esrgan_output_bgr, 'esrgan', encoding, esrgan_key)
+
+        height, width = esrgan_output_bgr.shape[:2]
+        regions = face_precheck.face_regions(precheck, width, height) if precheck else None
+        # Detect faces on the upload itself rather than the 16x larger upscale
+        final_output = restore_faces(esrgan_output_bgr, regions, low_res=np.ascontiguousarray(img[:, :, ::-1]))
+        print(f"Final output shape: {final_output.shape}")
+
+        # The final image appears only after the intermediate one, which the results page shows too
+        finish_result(final_path, final_output, 'gfpgan', encoding, final_key, after=intermediate,
+                      checkpoint=checkpoint)
+        print(f"Pipeline complete - saving as {final_filename}")
+        return 'ok'
+
+    except Exception as e:
+        print(f"Error during pipeline processing: {e}")
+        import traceback
+        traceback.print_exc()
+        if intermediate is not None:
+            try:
+                intermediate.result()
+            except Exception:
+                pass
+        if checkpoint is not None:
+            # Released so the Real-ESRGAN stage below can pick it up
+            checkpoint.release()
+
+        # Fallback: run the two stages separately (GFPGAN waits for the Real-ESRGAN write)
+        process_realesrgan(input_filename, esrgan_filename, encoding)
+        process_gfpgan(esrgan_filename, final_filename, encoding)
+        return 'fallback'
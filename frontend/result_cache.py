@@ -0,0 +1,117 @@
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import threading
+
+CHUNK_SIZE = 1024 * 1024
+
+_checksums = {}
+_checksums_lock = threading.Lock()
+
+def file_digest(path):
+    """SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def model_checksum(path):
+    """Digest of a model file, recomputed only when its size or mtime changes"""
+    stat = os.stat(path)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    with _checksums_lock:
+        cached = _checksums.get(path)
+        if cached and cached[0] == signature:
+            return cached[1]
+    checksum = file_digest(path)
+    with _checksums_lock:
+        _checksums[path] = (signature, checksum)
+    return checksum
+
+def cache_key(**parts):
+    """Stable key for a result: hash of everything that determines its pixels"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+def place_file(src, dest):
+    """Put a copy of src at dest atomically, hard-linking when both are on one filesystem.
+
+    dest is replaced, never written through, so a hard link can't corrupt src.
+    """
+    directory, name = os.path.split(dest)
+    tmp_path = os.path.join(directory, f".tmp-{uuid.uuid4().hex}-{name}")
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dest)
+
+class ResultCache:
+    """Finished outputs on disk, addressed by cache_key() and evicted least-recently-used.
+
+    Entries live at <root>/<key[:2]>/<key><ext>. A hit refreshes the entry's
+    mtime, which is what eviction orders by, so the total size stays under
+    max_bytes while recently requested results survive.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, key, ext):
+        return os.path.join(self.root, key[:2], f"{key}{ext}")
+
+    def get(self, key, ext):
+        """Path of the cached result, or None"""
+        path = self._path(key, ext)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def fetch(self, key, ext, dest):
+        """Place a cached result at dest; return False on a miss"""
+        path = self.get(key, ext)
+        if path is None:
+            return False
+        try:
+            place_file(path, dest)
+        except FileNotFoundError:
+            # Evicted between get() and here
+            return False
+        return True
+
+    def put(self, key, ext, src):
+        """Store a finished result and evict old entries if the cache is over budget"""
+        path = self._path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        place_file(src, path)
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for directory, _, files in os.walk(self.root):
+                for name in files:
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                    total += stat.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                    print(f"[Cache] Evicted {os.path.basename(path)}")
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,130 @@
+import os
+import json
+import struct
+import threading
+import numpy as np
+import torch
+
+# Model weights are converted once from .pth into a flat file of raw tensors
+# and memory-mapped copy-on-write, so every worker process on a host serves
+# its forward passes from the same page-cache copy instead of a private one
+SHARED_WEIGHTS = os.environ.get('SHARED_WEIGHTS', '1') != '0'
+SHARED_WEIGHTS_DIR = os.environ.get('SHARED_WEIGHTS_DIR', '/app/models/shared')
+
+FORMAT_VERSION = 1
+# Tensor data offsets are multiples of this, so every tensor starts page-cache and SIMD aligned
+ALIGNMENT = 64
+MAGIC = b'PRWEIGHT'
+
+_convert_lock = threading.Lock()
+
+def weights_path(model_path, weights_dir=SHARED_WEIGHTS_DIR):
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(weights_dir, stem + '.weights')
+
+def _source_signature(model_path):
+    stat = os.stat(model_path)
+    return {'path': os.path.abspath(model_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+def read_header(path):
+    """Header of a .weights file (source signature and {name: dtype, shape, offset}) and where its data starts"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a weights file")
+        (length,) = struct.unpack('<Q', f.read(8))
+        return json.loads(f.read(length)), _align(len(MAGIC) + 8 + length)
+
+def convert(model_path, path, key=None):
+    """Write the state dict in model_path (params_ema, else params) as a .weights file.
+
+    Layout: magic, header length, JSON header, then each tensor's raw
+    little-endian bytes at an ALIGNMENT-aligned offset from the data start.
+    """
+    state = torch.load(model_path, map_location='cpu')
+    key = key or ('params_ema' if 'params_ema' in state else 'params')
+    state_dict = state[key] if key in state else state
+
+    arrays, tensors, offset = [], {}, 0
+    for name, tensor in state_dict.items():
+        array = np.ascontiguousarray(tensor.detach().cpu().numpy())
+        offset = _align(offset)
+        tensors[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        arrays.append((offset, array))
+        offset += array.nbytes
+    header = json.dumps({'version': FORMAT_VERSION, 'source': _source_signature(model_path), 'key': key,
+                         'tensors': tensors}).encode()
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for tensor_offset, array in arrays:
+            f.seek(data_start + tensor_offset)
+            f.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+def is_current(path, model_path):
+    try:
+        header, _ = read_header(path)
+    except (OSError, ValueError):
+        return False
+    return header.get('version') == FORMAT_VERSION and header.get('source') == _source_signature(model_path)
+
+def load_state_dict(model_path, weights_dir=SHARED_WEIGHTS_DIR):
+    """Memory-mapped state dict of model_path, converting it on first use.
+
+    Tensors are copy-on-write views of the file: pages are shared between
+    every process that maps it until one of them writes to a tensor.
+    """
+    path = weights_path(model_path, weights_dir)
+    with _convert_lock:
+        if not is_current(path, model_path):
+            print(f"[Weights] Converting {os.path.basename(model_path)} to {path}")
+            convert(model_path, path)
+    header, data_start = read_header(path)
+    mapped = np.memmap(path, dtype=np.uint8, mode='c')
+    state_dict = {}
+    for name, info in header['tensors'].items():
+        dtype = np.dtype(info['dtype'])
+        count = int(np.prod(info['shape'], dtype=np.int64))
+        start = data_start + info['offset']
+        array = mapped[start:start + count * dtype.itemsize].view(dtype).reshape(info['shape'])
+        state_dict[name] = torch.from_numpy(array)
+    return state_dict
+
+def assign_state_dict(model, state_dict):
+    """Make the model's parameters and buffers the tensors in state_dict, without copying.
+
+    Like load_state_dict(strict=True), but the tensors are used as they are
+    (load_state_dict copies into the existing ones, which would give every
+    process its own copy again).
+    """
+    expected = dict(model.state_dict(keep_vars=True))
+    missing = set(expected) - set(state_dict)
+    unexpected = set(state_dict) - set(expected)
+    if missing or unexpected:
+        raise RuntimeError(f"State dict mismatch: missing {sorted(missing)[:5]}, unexpected {sorted(unexpected)[:5]}")
+    for name, tensor in state_dict.items():
+        if tuple(expected[name].shape) != tuple(tensor.shape):
+            raise RuntimeError(f"Shape mismatch for {name}: {tuple(expected[name].shape)} vs {tuple(tensor.shape)}")
+        module_name, _, leaf = name.rpartition('.')
+        module = model.get_submodule(module_name)
+        if leaf in module._parameters:
+            module._parameters[leaf] = torch.nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[leaf] = tensor
+    return model
+
+def build_model(factory, model_path, device):
+    """factory()'s module with model_path's weights memory-mapped in, on `device`.
+
+    On CPU the mapped tensors are used directly; other devices get a copy as
+    usual. (Building on the meta device to skip the throwaway initial weights
+    turned out slower than allocating them, so the module is built normally.)
+    """
+    model = assign_state_dict(factory(), load_state_dict(model_path))
+    return model.to(device).eval()
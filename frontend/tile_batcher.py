@@ -0,0 +1,119 @@
+import time
+import threading
+from concurrent.futures import Future
+import torch
+import metrics
+import tile_tuning
+
+class DirectRunner:
+    """Runs each tile as its own forward pass in the calling thread"""
+
+    def __init__(self, model, device):
+        self.model = model
+        self.device = device
+
+    def submit(self, tile, stage='esrgan'):
+        future = Future()
+        try:
+            start = time.perf_counter()
+            with torch.no_grad():
+                future.set_result(self.model(tile))
+            metrics.TILE_INFERENCE.observe(time.perf_counter() - start, stage=stage)
+            metrics.TILE_BATCH.observe(1)
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+class TileBatcher:
+    """Groups tiles from any number of jobs into batched forward passes.
+
+    Tiles are queued by shape (only equal shapes can be stacked, and padding
+    them to a common shape would change the output near image borders). A
+    group is run as soon as it holds `max_batch` tiles, or once its oldest
+    tile has waited `max_wait` seconds.
+
+    `lanes` threads take groups off the queue, so that many forward passes
+    (tiles of one image or of several) run at the same time. Each tile's
+    output goes to its own Future, so callers stitch the same result however
+    the tiles were spread over the lanes. Tiles whose Future was cancelled
+    (their job failed) are dropped unrun, and a batch that runs out of
+    memory is retried a tile at a time, so only tiles that don't fit on
+    their own fail.
+    """
+
+    def __init__(self, model, device, max_batch=4, max_wait=0.01, lanes=1):
+        self.model = model
+        self.device = device
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.lanes = max(lanes, 1)
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._threads = [threading.Thread(target=self._run, name=f'tile-batcher-{i}', daemon=True)
+                         for i in range(self.lanes)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, tile, stage='esrgan'):
+        future = Future()
+        with self._cond:
+            self._pending.setdefault(tuple(tile.shape), []).append((tile, future, time.monotonic(), stage))
+            self._cond.notify()
+        return future
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                ready, wake_at = None, None
+                # Oldest group first, so a trickle of new tiles can't starve older jobs
+                for shape, items in sorted(self._pending.items(), key=lambda kv: kv[1][0][2]):
+                    if len(items) >= self.max_batch or now - items[0][2] >= self.max_wait:
+                        ready = shape
+                        break
+                    deadline = items[0][2] + self.max_wait
+                    wake_at = deadline if wake_at is None else min(wake_at, deadline)
+                if ready is not None:
+                    items = self._pending.pop(ready)
+                    if len(items) > self.max_batch:
+                        self._pending[ready] = items[self.max_batch:]
+                    return items[:self.max_batch]
+                self._cond.wait(None if wake_at is None else max(wake_at - now, 0))
+
+    def _run(self):
+        while True:
+            batch = [item for item in self._next_batch() if item[1].set_running_or_notify_cancel()]
+            if batch:
+                self._forward(batch)
+
+    def _forward(self, batch):
+        try:
+            start = time.perf_counter()
+            with torch.no_grad():
+                output = self.model(torch.cat([tile for tile, _, _, _ in batch]))
+        except Exception as e:
+            if len(batch) > 1 and tile_tuning.is_out_of_memory(e):
+                # The tiles may belong to other jobs, which shouldn't all have to retry with smaller tiles
+                print(f"[Batcher] Out of memory with {len(batch)} tiles, running them one at a time")
+                for item in batch:
+                    self._forward([item])
+                return
+            for _, future, _, _ in batch:
+                future.set_exception(e)
+            return
+        per_tile = (time.perf_counter() - start) / len(batch)
+        for _, _, _, stage in batch:
+            metrics.TILE_INFERENCE.observe(per_tile, stage=stage)
+        metrics.TILE_BATCH.observe(len(batch))
+        for i, (_, future, _, _) in enumerate(batch):
+            future.set_result(output[i:i + 1])
+
+class StageRunner:
+    """Hands tiles to another runner, timing them under a different stage (e.g. 'preview')"""
+
+    def __init__(self, runner, stage):
+        self.runner = runner
+        self.stage = stage
+
+    def submit(self, tile):
+        return self.runner.submit(tile, stage=self.stage)
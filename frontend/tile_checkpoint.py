@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import fcntl
+import numpy as np
+
+# Finished Real-ESRGAN tiles of large jobs are kept on disk with a manifest,
+# so a job that is run again after a crash, restart or timeout picks up from
+# the last saved tile instead of starting over. Checkpoints are keyed by the
+# result cache key and removed once the result has been written.
+ESRGAN_CHECKPOINTS = os.environ.get('ESRGAN_CHECKPOINTS', '1') != '0'
+CHECKPOINT_DIR = os.environ.get('CHECKPOINT_DIR', '/app/outputs/checkpoints')
+# Smaller inputs finish quickly enough that starting over costs little
+CHECKPOINT_MIN_PIXELS = int(os.environ.get('CHECKPOINT_MIN_PIXELS', str(1_000_000)))
+# Seconds between manifest updates while tiles complete
+CHECKPOINT_INTERVAL = float(os.environ.get('CHECKPOINT_INTERVAL', '10'))
+# Checkpoints of jobs nobody came back for are removed after this many seconds
+CHECKPOINT_MAX_AGE = float(os.environ.get('CHECKPOINT_MAX_AGE', str(24 * 3600)))
+
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+
+class TileCheckpoint:
+    """Saved progress of one upscale: the output so far and which parts of it are finished.
+
+    Whole-image runs copy tiles into a memory-mapped output.npy and list the
+    finished tile indices in the manifest; the map is flushed before the
+    manifest is written, so the manifest never names a tile whose pixels
+    aren't on disk. Streamed runs save each finished band as its own file.
+    """
+
+    def __init__(self, key, lock, directory=CHECKPOINT_DIR):
+        self.key = key
+        self._lock = lock
+        self.directory = os.path.join(directory, key)
+        self.manifest = self._read_manifest()
+        self.done = set(self.manifest['done']) if self.manifest else set()
+        self._output = None
+        self._saved_at = time.monotonic()
+        self._unsaved = False
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read_manifest(self):
+        try:
+            with open(self._path(MANIFEST)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('version') != FORMAT_VERSION or manifest.get('key') != self.key:
+            return None
+        return manifest
+
+    def _write_manifest(self):
+        self.manifest['done'] = sorted(self.done)
+        self.manifest['updated'] = time.time()
+        tmp_path = self._path(f".{MANIFEST}.{uuid.uuid4().hex}")
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self._path(MANIFEST))
+
+    def resume_tiling(self, mode, tile, tile_pad):
+        """The tile size and padding of a saved `mode` ('tiles' or 'bands') run, so its tile grid
+        is used again; (tile, tile_pad) if there is none"""
+        if self.manifest and self.done and self.manifest.get('mode') == mode:
+            return self.manifest['tile'], self.manifest['tile_pad']
+        return tile, tile_pad
+
+    def _start(self, settings):
+        """Keep the saved progress if it was made with these settings, else start afresh"""
+        if self.manifest and all(self.manifest.get(k) == v for k, v in settings.items()):
+            if self.done:
+                print(f"[Checkpoint] Resuming {self.key[:12]}")
+            return
+        self._delete()
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest = dict(settings, version=FORMAT_VERSION, key=self.key, created=time.time())
+        self.done = set()
+        self._write_manifest()
+
+    def open_image(self, shape, dtype, tile, tile_pad, channel_order):
+        """(memory-mapped output array, indices of its finished tiles) for a whole-image run"""
+        settings = {'mode': 'tiles', 'shape': list(shape), 'dtype': np.dtype(dtype).str, 'tile': tile,
+                    'tile_pad': tile_pad, 'channel_order': channel_order}
+        self._start(settings)
+        path = self._path('output.npy')
+        if self.done and os.path.exists(path):
+            self._output = np.load(path, mmap_mode='r+')
+        else:
+            self.done = set()
+            self._output = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))
+            # Reserve the space now: running out of it later, while writing through the map, kills the process
+            with open(path, 'r+b') as f:
+                os.posix_fallocate(f.fileno(), 0, os.path.getsize(path))
+        return self._output, set(self.done)
+
+    def tile_done(self, index):
+        """Record a finished tile; the manifest is brought up to date every CHECKPOINT_INTERVAL seconds"""
+        self.done.add(index)
+        self._unsaved = True
+        if time.monotonic() - self._saved_at >= CHECKPOINT_INTERVAL:
+            self.save()
+
+    def save(self):
+        """Flush finished tiles to disk and list them in the manifest"""
+        if not self._unsaved or self.manifest is None:
+            return
+        try:
+            if self._output is not None:
+                self._output.flush()
+            self._write_manifest()
+        except OSError as e:
+            print(f"[Checkpoint] Could not save progress of {self.key[:12]}: {e}")
+        self._unsaved = False
+        self._saved_at = time.monotonic()
+
+    def open_bands(self, shape, dtype, tile, tile_pad, band_tiles, channel_order):
+        """Output rows of the bands a streamed run already finished"""
+        settings = {'mode': 'bands', 'shape': list(shape), 'dtype': np.dtype(dtype).str, 'tile': tile,
+                    'tile_pad': tile_pad, 'band_tiles': band_tiles, 'channel_order': channel_order}
+        self._start(settings)
+        self.done = {row for row in self.done if os.path.exists(self._band_path(row))}
+        return set(self.done)
+
+    def _band_path(self, row):
+        return self._path(f"band-{row}.npy")
+
+    def save_band(self, row, band):
+        tmp_path = self._path(f".band-{row}.{uuid.uuid4().hex}.npy")
+        try:
+            np.save(tmp_path, band)
+            os.replace(tmp_path, self._band_path(row))
+            self.done.add(row)
+            self._write_manifest()
+        except OSError as e:
+            print(f"[Checkpoint] Could not save band {row} of {self.key[:12]}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def load_band(self, row):
+        return np.load(self._band_path(row))
+
+    def _delete(self):
+        self._output = None
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def release(self):
+        """Close the checkpoint but keep it on disk, for a later run of the job to resume"""
+        self.save()
+        self._output = None
+        self._lock.close()
+
+    def remove(self):
+        """Delete the checkpoint once the job's result has been written"""
+        self._delete()
+        self._lock.close()
+
+def _try_lock(path):
+    """An open file holding an exclusive lock on path, or None if another job holds it"""
+    lock = open(path, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+def sweep(directory=CHECKPOINT_DIR, max_age=CHECKPOINT_MAX_AGE):
+    """Remove checkpoints that haven't been touched for max_age seconds"""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    now = time.time()
+    for name in names:
+        path = os.path.join(directory, name)
+        if name.endswith('.lock'):
+            # Lock files outlive their checkpoints; dropped once old and not held
+            if not os.path.exists(path[:-len('.lock')]) and now - os.path.getmtime(path) >= max_age:
+                lock = _try_lock(path)
+                if lock is not None:
+                    with lock:
+                        os.remove(path)
+            continue
+        try:
+            if now - os.path.getmtime(os.path.join(path, MANIFEST)) < max_age:
+                continue
+        except OSError:
+            pass
+        lock = _try_lock(path + '.lock')
+        if lock is None:
+            continue
+        with lock:
+            print(f"[Checkpoint] Removing stale checkpoint {name[:12]}")
+            shutil.rmtree(path, ignore_errors=True)
+
+def wanted(pixels):
+    """Whether an input with this many pixels gets a checkpoint"""
+    return ESRGAN_CHECKPOINTS and pixels >= CHECKPOINT_MIN_PIXELS
+
+def open_checkpoint(key):
+    """The TileCheckpoint for this cache key, or None if another job (in any worker process) has it open.
+
+    A second job for the same input then runs without one rather than
+    writing into the same files; the lock goes away with a crashed process.
+    """
+    sweep()
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    lock = _try_lock(os.path.join(CHECKPOINT_DIR, key + '.lock'))
+    if lock is None:
+        return None
+    try:
+        return TileCheckpoint(key, lock)
+    except Exception:
+        lock.close()
+        raise
@@ -0,0 +1,134 @@
+import os
+import re
+import json
+import math
+import time
+import torch
+
+# Peak bytes per padded input pixel of a 4x RRDBNet forward pass, used when
+# calibration can't measure it (measured ~15 KB/px for RealESRGAN_x4plus)
+DEFAULT_BYTES_PER_PIXEL = 16 * 1024
+
+# Fraction of available memory a single forward pass may use
+MEMORY_FRACTION = float(os.environ.get('ESRGAN_MEMORY_FRACTION', '0.5'))
+
+MIN_TILE = int(os.environ.get('ESRGAN_MIN_TILE', '64'))
+MAX_TILE = int(os.environ.get('ESRGAN_MAX_TILE', '1024'))
+TILE_MULTIPLE = 16
+
+CALIBRATION_SIZES = (64, 96)
+
+def _read_int(path):
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+        return None if value == 'max' else int(value)
+    except (OSError, ValueError):
+        return None
+
+def available_memory():
+    """Bytes this process can still allocate: free RAM, capped by the container's cgroup limit"""
+    available = None
+    try:
+        with open('/proc/meminfo') as f:
+            match = re.search(r'MemAvailable:\s+(\d+) kB', f.read())
+        if match:
+            available = int(match.group(1)) * 1024
+    except OSError:
+        pass
+
+    # cgroup v2, then v1
+    for limit_path, usage_path in (('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+                                    '/sys/fs/cgroup/memory/memory.usage_in_bytes')):
+        limit, usage = _read_int(limit_path), _read_int(usage_path)
+        if limit is not None and usage is not None and limit < (1 << 60):
+            headroom = max(limit - usage, 0)
+            available = headroom if available is None else min(available, headroom)
+            break
+
+    return available if available is not None else 4 * 1024 ** 3
+
+def _proc_status(field):
+    with open('/proc/self/status') as f:
+        match = re.search(rf'{field}:\s+(\d+) kB', f.read())
+    return int(match.group(1)) * 1024
+
+def measure_bytes_per_pixel(model, device):
+    """Run the model on small tiles and measure peak RSS growth per input pixel.
+
+    Resets the kernel's peak-RSS counter through /proc/self/clear_refs, so this
+    only works on Linux CPU; elsewhere DEFAULT_BYTES_PER_PIXEL is returned.
+    """
+    if device.type != 'cpu':
+        return DEFAULT_BYTES_PER_PIXEL
+    try:
+        measured = 0
+        for size in CALIBRATION_SIZES:
+            x = torch.rand(1, 3, size, size, device=device)
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            baseline = _proc_status('VmRSS')
+            with torch.no_grad():
+                model(x)
+            measured = (_proc_status('VmHWM') - baseline) / (size * size)
+        # The first size warms the allocator; only the last reading counts.
+        # Freed memory kept by the allocator hides some growth, so add headroom.
+        return max(int(measured * 1.25), DEFAULT_BYTES_PER_PIXEL // 2)
+    except (OSError, AttributeError):
+        return DEFAULT_BYTES_PER_PIXEL
+
+def load_calibration(model, device, cache_path, model_path):
+    """Bytes per pixel for this model, calibrated once and cached on disk"""
+    key = f"{model_path}:{os.path.getsize(model_path) if os.path.exists(model_path) else 0}:" \
+          f"{device}:{torch.get_num_threads()}"
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached.get('key') == key:
+            return cached['bytes_per_pixel']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    start = time.time()
+    bytes_per_pixel = measure_bytes_per_pixel(model, device)
+    print(f"[Tiles] Calibrated {bytes_per_pixel / 1024:.1f} KB per input pixel in {time.time() - start:.1f}s")
+    try:
+        with open(cache_path, 'w') as f:
+            json.dump({'key': key, 'bytes_per_pixel': bytes_per_pixel}, f)
+    except OSError:
+        pass
+    return bytes_per_pixel
+
+def choose_tile(height, width, bytes_per_pixel, scale=4, batch=1, memory=None):
+    """Pick (tile, tile_pad) for an image from the memory it may use.
+
+    Returns tile=0 (no tiling) when the whole image fits in one pass. Otherwise
+    the largest tile whose padded area, times the batch size, fits the budget,
+    evened out so the edge tiles aren't slivers.
+    """
+    if memory is None:
+        memory = available_memory()
+    # The job's own buffers: float input tensor plus the uint8 output image
+    job_bytes = height * width * 3 * (4 + scale * scale)
+    budget = max(memory * MEMORY_FRACTION - job_bytes, 0) / max(batch, 1)
+
+    if height * width * bytes_per_pixel <= budget and max(height, width) <= MAX_TILE:
+        return 0, 0
+
+    side = int(math.sqrt(budget / bytes_per_pixel))
+    tile_pad = min(max(side // 16, 10), 32)
+    tile = min(side - 2 * tile_pad, MAX_TILE, max(height, width))
+    tile = max(tile // TILE_MULTIPLE * TILE_MULTIPLE, MIN_TILE)
+
+    # Same number of tiles per axis, but split evenly
+    tile = max(math.ceil(dim / math.ceil(dim / tile)) for dim in (height, width))
+    return tile, tile_pad
+
+def is_out_of_memory(error):
+    """True for the allocation failures torch raises on CPU and GPU"""
+    if isinstance(error, MemoryError):
+        return True
+    message = str(error).lower()
+    return isinstance(error, RuntimeError) and (
+        'out of memory' in message or "can't allocate" in message or 'not enough memory' in message)
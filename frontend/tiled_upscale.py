@@ -0,0 +1,237 @@
+import math
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# Core region (y0:y1, x0:x1) of the input a tile is responsible for, and the
+# padded region (py0:py1, px0:px1) actually fed to the model
+Tile = namedtuple('Tile', 'y0 y1 x0 x1 py0 py1 px0 px1')
+
+def tile_grid(height, width, tile, tile_pad):
+    """Split an image into tiles the same way RealESRGANer.tile_process does"""
+    if tile <= 0:
+        tile = max(height, width)
+    tiles = []
+    for y in range(math.ceil(height / tile)):
+        for x in range(math.ceil(width / tile)):
+            y0, x0 = y * tile, x * tile
+            y1, x1 = min(y0 + tile, height), min(x0 + tile, width)
+            tiles.append(Tile(
+                y0, y1, x0, x1,
+                max(y0 - tile_pad, 0), min(y1 + tile_pad, height),
+                max(x0 - tile_pad, 0), min(x1 + tile_pad, width)
+            ))
+    return tiles
+
+def image_to_tensor(img, device):
+    """HxWx3 uint8 RGB array -> 1x3xHxW float tensor in [0, 1]"""
+    return torch.from_numpy(np.ascontiguousarray(img.transpose(2, 0, 1))).float().div_(255.0).unsqueeze(0).to(device)
+
+def flatness(patch):
+    """(standard deviation, mean absolute Laplacian) of a 1x3xHxW [0, 1] tile in 0-255 grey levels.
+
+    The first is low for uniform areas; the second is low wherever there is
+    no edge, texture or grain, including smooth gradients like sky.
+    """
+    grey = patch[0].float().mean(0) * 255.0
+    if grey.shape[0] < 3 or grey.shape[1] < 3:
+        return float(grey.std()) if grey.numel() > 1 else 0.0, 0.0
+    laplacian = (4 * grey[1:-1, 1:-1] - grey[:-2, 1:-1] - grey[2:, 1:-1] - grey[1:-1, :-2] - grey[1:-1, 2:])
+    return float(grey.std()), float(laplacian.abs().mean())
+
+def is_flat(patch, flat):
+    """Whether a tile is plain enough to interpolate; flat is (max std, max mean |Laplacian|)"""
+    std, edges = flatness(patch)
+    return std <= flat[0] and edges <= flat[1]
+
+def interpolate(patch, scale):
+    """Bicubic upscale of a tile, standing in for the model output on flat tiles"""
+    future = Future()
+    future.set_result(F.interpolate(patch, scale_factor=scale, mode='bicubic', align_corners=False))
+    return future
+
+def _neighbours(tiles):
+    """{index: {direction: index of the adjacent tile}} for tiles on one grid"""
+    by_start = {(t.y0, t.x0): i for i, t in enumerate(tiles)}
+    by_bottom = {(t.y1, t.x0): i for i, t in enumerate(tiles)}
+    by_right = {(t.y0, t.x1): i for i, t in enumerate(tiles)}
+    neighbours = {}
+    for i, t in enumerate(tiles):
+        found = {'up': by_bottom.get((t.y0, t.x0)), 'down': by_start.get((t.y1, t.x0)),
+                 'left': by_right.get((t.y0, t.x0)), 'right': by_start.get((t.y0, t.x1))}
+        neighbours[i] = {direction: j for direction, j in found.items() if j is not None}
+    return neighbours
+
+def _run_tiles(img_t, tiles, runner, output, scale, window, channels, input_row=0, output_row=0,
+               flat=None, stats=None, done=None, on_tile=None):
+    """Run tiles through the runner and copy their cores into output.
+
+    img_t starts at input row `input_row` and output at (upscaled) input row
+    `output_row`, so the same code serves whole images and bands.
+
+    With `flat` (see is_flat), plain tiles are interpolated instead of run
+    through the model. Where one borders a model tile, the model's output
+    for the padding that reaches into it is cross-faded over the interpolated
+    pixels, so there is no visible step at the boundary. `stats` (a dict)
+    collects tile and pixel counts for both kinds and the interpolation time.
+
+    Tiles whose index is in `done` are already in output (from a checkpoint)
+    and are not run again, and on_tile(index) is called once a model tile has
+    been copied out. Flat tiles, and model tiles next to them (whose strips
+    the cross-fade needs), are always redone.
+    """
+    peak = np.iinfo(output.dtype).max
+
+    def to_array(out):
+        out = out.float().clamp_(0, 1).mul_(float(peak)).round_()
+        return (out.byte() if peak == 255 else out.int()).permute(1, 2, 0).cpu().numpy()
+
+    skipped = set()
+    if flat is not None:
+        for i, t in enumerate(tiles):
+            if is_flat(img_t[:, :, t.py0 - input_row:t.py1 - input_row, t.px0:t.px1], flat):
+                skipped.add(i)
+        neighbours = _neighbours(tiles) if skipped else {}
+    resumed = set()
+    if done:
+        resumed = {i for i in done if i < len(tiles) and i not in skipped
+                   and not any(j in skipped for j in (neighbours[i].values() if skipped else ()))}
+    # (y0, y1, x0, x1 in input pixels, axis, model side) -> model output strip, blended in once all tiles are written
+    strips = []
+
+    def write(i, t, future):
+        out = future.result()
+        oy, ox = (t.y0 - t.py0) * scale, (t.x0 - t.px0) * scale
+        core = out[0, channels, oy:oy + (t.y1 - t.y0) * scale, ox:ox + (t.x1 - t.x0) * scale]
+        y0, y1 = t.y0 - output_row, t.y1 - output_row
+        output[y0 * scale:y1 * scale, t.x0 * scale:t.x1 * scale] = to_array(core)
+        if on_tile is not None and i not in skipped:
+            on_tile(i)
+        if i in skipped or not skipped:
+            return
+        for direction, j in neighbours[i].items():
+            if j not in skipped:
+                continue
+            if direction == 'right':
+                region, axis, toward = (t.y0, t.y1, t.x1, t.px1), 1, 'start'
+            elif direction == 'left':
+                region, axis, toward = (t.y0, t.y1, t.px0, t.x0), 1, 'end'
+            elif direction == 'down':
+                region, axis, toward = (t.y1, t.py1, t.x0, t.x1), 0, 'start'
+            else:
+                region, axis, toward = (t.py0, t.y0, t.x0, t.x1), 0, 'end'
+            ry0, ry1, rx0, rx1 = region
+            if ry1 <= ry0 or rx1 <= rx0:
+                continue
+            strip = out[0, channels, (ry0 - t.py0) * scale:(ry1 - t.py0) * scale,
+                        (rx0 - t.px0) * scale:(rx1 - t.px0) * scale]
+            strips.append((region, axis, toward, to_array(strip)))
+
+    in_flight = deque()
+    try:
+        for i, t in enumerate(tiles):
+            if i in resumed:
+                continue
+            patch = img_t[:, :, t.py0 - input_row:t.py1 - input_row, t.px0:t.px1].contiguous()
+            if i in skipped:
+                start = time.perf_counter()
+                future = interpolate(patch, scale)
+                if stats is not None:
+                    stats['interpolate_seconds'] = stats.get('interpolate_seconds', 0.0) + time.perf_counter() - start
+            else:
+                future = runner.submit(patch)
+            in_flight.append((i, t, future))
+            if len(in_flight) >= window:
+                write(*in_flight.popleft())
+        while in_flight:
+            write(*in_flight.popleft())
+    except BaseException:
+        # Tiles still queued in a batching runner would otherwise run for nothing,
+        # alongside a retry's new ones
+        for _, _, future in in_flight:
+            future.cancel()
+        raise
+
+    # Cross-fade: full model output at the shared edge, fading to the interpolation
+    for (ry0, ry1, rx0, rx1), axis, toward, strip in strips:
+        y0, y1 = (ry0 - output_row) * scale, (ry1 - output_row) * scale
+        x0, x1 = rx0 * scale, rx1 * scale
+        length = strip.shape[axis]
+        weight = 1.0 - (np.arange(length, dtype=np.float32) + 0.5) / length
+        if toward == 'end':
+            weight = weight[::-1]
+        weight = weight[:, None, None] if axis == 0 else weight[None, :, None]
+        current = output[y0:y1, x0:x1].astype(np.float32)
+        blended = weight * strip.astype(np.float32) + (1 - weight) * current
+        output[y0:y1, x0:x1] = np.clip(np.round(blended), 0, peak).astype(output.dtype)
+
+    if stats is not None:
+        if resumed:
+            stats['resumed_tiles'] = stats.get('resumed_tiles', 0) + len(resumed)
+        for i, t in enumerate(tiles):
+            if i in resumed:
+                continue
+            kind = 'skipped' if i in skipped else 'model'
+            stats[f'{kind}_tiles'] = stats.get(f'{kind}_tiles', 0) + 1
+            stats[f'{kind}_pixels'] = stats.get(f'{kind}_pixels', 0) + (t.y1 - t.y0) * (t.x1 - t.x0)
+
+def upscale_image(img, runner, scale=4, tile=200, tile_pad=10, window=16, channel_order='rgb', dtype=np.uint8,
+                  flat=None, stats=None, output=None, done=None, on_tile=None):
+    """Upscale an HxWx3 uint8 RGB image tile by tile.
+
+    Each padded tile is handed to runner.submit(), which returns a Future for
+    the model output; up to `window` tiles are kept in flight so a batching
+    runner can group them. Returns the (H*scale)x(W*scale)x3 uint8 result in
+    `channel_order` ('bgr' swaps channels while copying tiles out, so OpenCV
+    consumers need no separate conversion). dtype=np.uint16 keeps the model's
+    output at 16 bits per channel instead of rounding it to 8. `flat` and
+    `stats` turn on flat-tile skipping (see _run_tiles).
+
+    `output` is an array to write into instead of a new one (e.g. a
+    checkpoint's memory map), with `done` the indices of tiles it already
+    holds; on_tile(index) reports each tile as it's finished.
+    """
+    height, width = img.shape[:2]
+    img_t = image_to_tensor(img, runner.device)
+    if output is None:
+        output = np.empty((height * scale, width * scale, 3), dtype=dtype)
+    channels = [2, 1, 0] if channel_order == 'bgr' else [0, 1, 2]
+    _run_tiles(img_t, tile_grid(height, width, tile, tile_pad), runner, output, scale, window, channels,
+               flat=flat, stats=stats, done=done, on_tile=on_tile)
+    return output
+
+def upscale_bands(img, runner, scale=4, tile=200, tile_pad=10, window=16, channel_order='rgb', band_tiles=1,
+                  dtype=np.uint8, flat=None, stats=None, done=None):
+    """Upscale like upscale_image, but yield the output one horizontal band at a time.
+
+    Each band covers `band_tiles` rows of tiles; only that band's padded input
+    rows are converted to a tensor and only its upscaled rows are allocated, so
+    peak memory follows the band size rather than the image size. Yields
+    (first output row, band array); the bands are bit-identical to the
+    matching rows of upscale_image's result (with `flat`, only flat tiles
+    next to model tiles of another band differ, as that edge isn't cross-faded).
+    Bands whose first output row is in `done` are yielded as (row, None)
+    without being run, for the caller to fill in from a checkpoint.
+    """
+    height, width = img.shape[:2]
+    if tile <= 0:
+        tile = max(height, width)
+    channels = [2, 1, 0] if channel_order == 'bgr' else [0, 1, 2]
+    tiles = tile_grid(height, width, tile, tile_pad)
+    band_height = tile * max(band_tiles, 1)
+    for y0 in range(0, height, band_height):
+        y1 = min(y0 + band_height, height)
+        if done and y0 * scale in done:
+            yield y0 * scale, None
+            continue
+        band = [t for t in tiles if y0 <= t.y0 < y1]
+        py0, py1 = max(y0 - tile_pad, 0), min(y1 + tile_pad, height)
+        band_t = image_to_tensor(img[py0:py1], runner.device)
+        output = np.empty(((y1 - y0) * scale, width * scale, 3), dtype=dtype)
+        _run_tiles(band_t, band, runner, output, scale, window, channels, input_row=py0, output_row=y0,
+                   flat=flat, stats=stats)
+        del band_t
+        yield y0 * scale, output
@@ -1,78 +1,172 @@
-# LaMa Inpainting for Scratch Removal {Approach 1} {not working}
+# LaMa Inpainting for Scratch Removal {Approach 1}, with OpenCV Telea/NS {Approach 2} as the fallback
+#
+# By default only the damaged parts of the photo are inpainted: the mask is
+# covered with a grid of tiles, and every tile that holds scratch pixels is
+# inpainted together with a margin of context around it, in batches of
+# equal-sized crops. Cost follows the damaged area, not the image size.
+#
+#   python lama.py                                   # old_w_scratch/a.png + outputs/mask/mask.png
+#   python lama.py photo.png mask.png out.png --method telea
+#   python lama.py photo.png mask.png out.png --full # whole image in one pass, as before
 
+import sys
+import argparse
 import cv2
 import torch
 from torchvision import transforms
 from PIL import Image
 import numpy as np
-import os
 
-import sys
 sys.path.append('/app/model_repo/lama')
 
-# Import LaMa (assuming you cloned lama repo and installed)
-from saicinpainting.evaluation.data import pad_tensor_to_modulo
-from saicinpainting.training.trainers import load_checkpoint
-
 # Paths
-image_path = '/app/inputs/old_w_scratch/a.png'
-mask_path = '/app/outputs/mask/mask.png'
-checkpoint_path = '/app/models/big-lama.pt'
-output_path = '/app/outputs/lama_out.png'
-
-# Load model
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-train_config = {'strict': False}
-model = load_checkpoint(checkpoint_path, strict=False, map_location=device)
-model.eval().to(device)
-
-# Load image + mask
-image = Image.open(image_path).convert('RGB')
-mask = Image.open(mask_path).convert('L')  # grayscale
-
-transform = transforms.ToTensor()
-img_tensor = transform(image).unsqueeze(0).to(device)
-mask_tensor = transform(mask).unsqueeze(0).to(device)
-
-# Pad for compatibility
-img_tensor = pad_tensor_to_modulo(img_tensor, 8)
-mask_tensor = pad_tensor_to_modulo(mask_tensor, 8)
-
-# Inpaint
-with torch.no_grad():
-    inpainted = model({'image': img_tensor, 'mask': mask_tensor})['inpainted']
-
-result = (inpainted[0].permute(1,2,0).cpu().numpy() * 255).astype(np.uint8)
-Image.fromarray(result).save(output_path)
-
-print(f"Saved scratch-removed image to {output_path}") 
-
+IMAGE_PATH = '/app/inputs/old_w_scratch/a.png'
+MASK_PATH = '/app/outputs/mask/mask.png'
+CHECKPOINT_PATH = '/app/models/big-lama.pt'
+OUTPUT_PATH = '/app/outputs/lama_out.png'
+
+METHODS = ('lama', 'telea', 'ns')
+
+# Region-of-interest inpainting: side of the grid tiles, context kept around
+# each tile (crops are ROI_TILE + 2 * ROI_PAD square, a multiple of 8 for LaMa)
+# and crops per LaMa forward pass
+ROI_TILE = 256
+ROI_PAD = 64
+ROI_BATCH = 4
+# Once the crops add up to this share of the image, one whole-image pass is cheaper
+ROI_MAX_COVERAGE = 0.8
+
+OPENCV_RADIUS = 3
+
+def get_device():
+    return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+def load_model(checkpoint_path=CHECKPOINT_PATH, device=None):
+    """Big-LaMa in eval mode (needs the lama repo on sys.path)"""
+    from saicinpainting.training.trainers import load_checkpoint
+    device = device or get_device()
+    model = load_checkpoint(checkpoint_path, strict=False, map_location=device)
+    model.eval().to(device)
+    return model
+
+def lama_inpaint(model, images, masks):
+    """Inpaint same-sized HxWx3 uint8 RGB images with LaMa in one batch; masks are HxW, nonzero = hole"""
+    from saicinpainting.evaluation.data import pad_tensor_to_modulo
+    device = next(model.parameters()).device
+    transform = transforms.ToTensor()
+    img_tensor = torch.stack([transform(img) for img in images]).to(device)
+    mask_tensor = torch.stack([transform((mask > 0).astype(np.float32)) for mask in masks]).to(device)
+
+    # Pad for compatibility
+    height, width = img_tensor.shape[2:]
+    img_tensor = pad_tensor_to_modulo(img_tensor, 8)
+    mask_tensor = pad_tensor_to_modulo(mask_tensor, 8)
+
+    # Inpaint
+    with torch.no_grad():
+        inpainted = model({'image': img_tensor, 'mask': mask_tensor})['inpainted']
+
+    inpainted = inpainted[:, :, :height, :width]
+    return [(out.permute(1, 2, 0).cpu().numpy() * 255).astype(np.uint8) for out in inpainted]
+
+def opencv_inpaint(images, masks, method='telea', radius=OPENCV_RADIUS):
+    """cv2.inpaint (Telea or Navier-Stokes) for each image; same interface as lama_inpaint"""
+    flags = cv2.INPAINT_TELEA if method == 'telea' else cv2.INPAINT_NS
+    return [cv2.inpaint(img, (mask > 0).astype(np.uint8) * 255, radius, flags) for img, mask in zip(images, masks)]
+
+def roi_tiles(mask, tile=ROI_TILE, pad=ROI_PAD):
+    """Crops covering every damaged grid tile of the mask.
+
+    Returns [(crop, core)] boxes as (y0, y1, x0, x1): `core` is a grid tile
+    holding mask pixels and `crop` that tile plus `pad` pixels of context,
+    shifted inside the image so every crop has the same size whenever the
+    image is at least tile + 2 * pad on that side.
+    """
+    height, width = mask.shape[:2]
+    rows, cols = -(-height // tile), -(-width // tile)
+    padded = np.zeros((rows * tile, cols * tile), dtype=bool)
+    padded[:height, :width] = mask > 0
+    damaged = padded.reshape(rows, tile, cols, tile).any(axis=(1, 3))
+
+    size_y, size_x = min(tile + 2 * pad, height), min(tile + 2 * pad, width)
+    tiles = []
+    for row, col in zip(*np.nonzero(damaged)):
+        y0, x0 = int(row) * tile, int(col) * tile
+        y1, x1 = min(y0 + tile, height), min(x0 + tile, width)
+        cy0 = min(max(y0 - pad, 0), height - size_y)
+        cx0 = min(max(x0 - pad, 0), width - size_x)
+        tiles.append(((cy0, cy0 + size_y, cx0, cx0 + size_x), (y0, y1, x0, x1)))
+    return tiles
+
+def inpaint_roi(img, mask, inpaint, tile=ROI_TILE, pad=ROI_PAD, batch_size=ROI_BATCH):
+    """Inpaint only the damaged tiles of img with inpaint(images, masks) and blend them back.
+
+    Each tile's core takes the inpainted pixels where the mask is set and
+    keeps the original everywhere else, so undamaged pixels are untouched.
+    Falls back to one whole-image pass when the crops would cover most of it.
+    """
+    tiles = roi_tiles(mask, tile, pad)
+    height, width = mask.shape[:2]
+    total_tiles = -(-height // tile) * -(-width // tile)
+    if not tiles:
+        print("No damaged regions in the mask")
+        return img.copy()
+    (y0, y1, x0, x1), _ = tiles[0]
+    if len(tiles) * (y1 - y0) * (x1 - x0) > ROI_MAX_COVERAGE * height * width:
+        print(f"{len(tiles)} of {total_tiles} tiles damaged - inpainting the whole image")
+        return inpaint([img], [mask])[0]
+    print(f"Inpainting {len(tiles)} of {total_tiles} tiles")
+
+    result = img.copy()
+    hole = mask > 0
+    for start in range(0, len(tiles), batch_size):
+        batch = tiles[start:start + batch_size]
+        crops = [img[y0:y1, x0:x1] for (y0, y1, x0, x1), _ in batch]
+        crop_masks = [mask[y0:y1, x0:x1] for (y0, y1, x0, x1), _ in batch]
+        for ((cy0, _, cx0, _), (y0, y1, x0, x1)), out in zip(batch, inpaint(crops, crop_masks)):
+            core = out[y0 - cy0:y1 - cy0, x0 - cx0:x1 - cx0]
+            core_hole = hole[y0:y1, x0:x1]
+            result[y0:y1, x0:x1][core_hole] = core[core_hole]
+    return result
+
+def inpaint_image(img, mask, method='lama', model=None, roi=True, **roi_args):
+    """Remove the masked scratches from an HxWx3 uint8 RGB image"""
+    if method == 'lama':
+        model = model or load_model()
+        inpaint = lambda images, masks: lama_inpaint(model, images, masks)
+    else:
+        inpaint = lambda images, masks: opencv_inpaint(images, masks, method)
+    if roi:
+        return inpaint_roi(img, mask, inpaint, **roi_args)
+    return inpaint([img], [mask])[0]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inpaint scratches marked in a mask')
+    parser.add_argument('image', nargs='?', default=IMAGE_PATH)
+    parser.add_argument('mask', nargs='?', default=MASK_PATH)
+    parser.add_argument('output', nargs='?', default=OUTPUT_PATH)
+    parser.add_argument('--method', choices=METHODS, default='lama')
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH)
+    parser.add_argument('--full', action='store_true', help='inpaint the whole image in one pass')
+    parser.add_argument('--tile', type=int, default=ROI_TILE)
+    parser.add_argument('--pad', type=int, default=ROI_PAD)
+    parser.add_argument('--batch-size', type=int, default=ROI_BATCH)
+    args = parser.parse_args(argv)
+
+    # Load image + mask
+    image = np.array(Image.open(args.image).convert('RGB'))
+    mask = np.array(Image.open(args.mask).convert('L'))  # grayscale
+
+    model = load_model(args.checkpoint) if args.method == 'lama' else None
+    result = inpaint_image(image, mask, args.method, model=model, roi=not args.full,
+                           tile=args.tile, pad=args.pad, batch_size=args.batch_size)
+    Image.fromarray(result).save(args.output)
+    print(f"Saved scratch-removed image to {args.output}")
+
+if __name__ == '__main__':
+    main()
 
 
-# Simple OpenCV Inpainting for comparison {Approach 2} {too blurry after inpainting}
-'''
-import cv2
-
-# Paths
-image_path = "/Users/rahulsharma/ML_project/historical_photo_restoration/inputs/old_w_scratch/b.png"
-mask_path = "/Users/rahulsharma/ML_project/historical_photo_restoration/outputs/mask/mask2.png"
-output_path = "/Users/rahulsharma/ML_project/historical_photo_restoration/outputs/lama-fixes/restored.png"
-
-# Load image and mask
-img = cv2.imread(image_path, cv2.IMREAD_COLOR)
-mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
-
-# Inpainting (try both methods)
-restored_telea = cv2.inpaint(img, mask, inpaintRadius=3, flags=cv2.INPAINT_TELEA)
-restored_ns = cv2.inpaint(img, mask, inpaintRadius=3, flags=cv2.INPAINT_NS)
-
-# Save outputs
-cv2.imwrite(output_path.replace("restored.png", "restored_telea.png"), restored_telea)
-cv2.imwrite(output_path.replace("restored.png", "restored_ns.png"), restored_ns)
-
-print("Restored images saved as restored_telea.png and restored_ns.png")
-
-'''
 #  Stable Diffusion Inpainting for comparison {Approach 3} {currently used}
 
 '''
@@ -108,4 +202,4 @@ result = pipe(
 result.save("/Users/rahulsharma/ML_project/historical_photo_restoration/outputs/lama-fixes/restored.png")
 print("[INFO] Restored image saved!")
 
-'''
\ No newline at end of file
+'''
@@ -1,28 +1,150 @@
+# Scratch mask generation {Canny edges + dilation + bright-spot threshold}
+#
+# White = scratch, black = background. Importable (scratch_mask, generate_mask,
+# generate_masks) or run as a script:
+#
+#   python mask.py                                  # old_w_scratch/a.png -> outputs/mask/mask.png
+#   python mask.py scan.png scan_mask.png --levels auto
+#   python mask.py --batch /app/inputs/old_w_scratch /app/outputs/mask --workers 4
+
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import cv2
 import numpy as np
 
-# Load damaged photo
-img = cv2.imread('/app/inputs/old_w_scratch/a.png', cv2.IMREAD_COLOR)
-gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+DEFAULT_INPUT = '/app/inputs/old_w_scratch/a.png'
+DEFAULT_OUTPUT = '/app/outputs/mask/mask.png'
+
+CANNY_LOW = 50
+CANNY_HIGH = 150
+KERNEL_SIZE = 3
+DILATE_ITERATIONS = 1
+BRIGHT_THRESHOLD = 240  # very bright = possible scratch
+
+# With levels='auto', edges are found on the first pyramid level at or below this size
+MULTISCALE_MAX_PIXELS = 4_000_000
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.webp')
+
+def pyramid_levels(height, width, max_pixels=MULTISCALE_MAX_PIXELS):
+    """Number of pyrDown steps until the image has at most max_pixels"""
+    levels = 0
+    while height * width > max_pixels and min(height, width) > 1:
+        height, width = (height + 1) // 2, (width + 1) // 2
+        levels += 1
+    return levels
+
+def scratch_mask(img, canny_low=CANNY_LOW, canny_high=CANNY_HIGH, kernel_size=KERNEL_SIZE,
+                 dilate_iterations=DILATE_ITERATIONS, bright_threshold=BRIGHT_THRESHOLD, levels=0):
+    """Scratch mask (uint8, 255 = scratch) for a BGR or grayscale image.
+
+    levels > 0 runs edge detection and dilation on a Gaussian pyramid level
+    that many halvings down and scales the mask back up, which makes edges
+    roughly 4**levels times cheaper; 'auto' picks the level from
+    MULTISCALE_MAX_PIXELS. The bright-spot threshold is always applied at
+    full resolution. levels=0 is the original single-scale mask.
+    """
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    height, width = gray.shape
+    if levels == 'auto':
+        levels = pyramid_levels(height, width)
+
+    # Step 1: Edge detection
+    small = gray
+    for _ in range(levels):
+        small = cv2.pyrDown(small)
+    edges = cv2.Canny(small, threshold1=canny_low, threshold2=canny_high)
+
+    # Step 2: Morphological operations to make edges thicker
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+    mask = cv2.dilate(edges, kernel, iterations=dilate_iterations)
+    if levels:
+        mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+
+    # Step 3: Thresholding for very bright spots
+    _, thresh = cv2.threshold(gray, bright_threshold, 255, cv2.THRESH_BINARY)
+    return cv2.bitwise_or(mask, thresh)
+
+def generate_mask(input_path, output_path, **params):
+    """Read an image, compute its scratch mask and save it; returns output_path"""
+    img = cv2.imread(input_path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f"Could not load image from: {input_path}")
+    mask = scratch_mask(img, **params)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    if not cv2.imwrite(output_path, mask):
+        raise ValueError(f"Could not write mask to: {output_path}")
+    return output_path
+
+def _generate_mask_job(job):
+    input_path, output_path, params = job
+    # One OpenCV thread per worker process; the pool provides the parallelism
+    cv2.setNumThreads(1)
+    try:
+        return input_path, generate_mask(input_path, output_path, **params), None
+    except Exception as e:
+        return input_path, None, str(e)
+
+def generate_masks(input_dir, output_dir, workers=None, **params):
+    """Mask every image in input_dir into output_dir/<name>_mask.png across a process pool.
 
-# Step 1: Edge detection
-edges = cv2.Canny(gray, threshold1=50, threshold2=150)
+    Returns {input path: mask path, or None if it failed}.
+    """
+    jobs = []
+    for name in sorted(os.listdir(input_dir)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            stem = os.path.splitext(name)[0]
+            jobs.append((os.path.join(input_dir, name), os.path.join(output_dir, f"{stem}_mask.png"), params))
+    os.makedirs(output_dir, exist_ok=True)
 
-# Step 2: Morphological operations to make edges thicker
-kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
-mask = cv2.dilate(edges, kernel, iterations=1)
+    results = {}
+    if not jobs:
+        return results
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for input_path, output_path, error in pool.map(_generate_mask_job, jobs):
+            if error:
+                print(f"[Mask] Failed {input_path}: {error}")
+            else:
+                print(f"[Mask] {os.path.basename(input_path)} -> {output_path}")
+            results[input_path] = output_path
+    return results
 
-# Step 3: Optional - thresholding for very bright spots
-_, thresh = cv2.threshold(gray, 240, 255, cv2.THRESH_BINARY)  # very bright = possible scratch
-mask = cv2.bitwise_or(mask, thresh)
+def parse_levels(value):
+    return value if value == 'auto' else int(value)
 
-# Invert (if needed: white = scratch, black = background)
-#mask = cv2.bitwise_not(mask)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate scratch masks for damaged photos')
+    parser.add_argument('input', nargs='?', default=DEFAULT_INPUT, help='image to mask')
+    parser.add_argument('output', nargs='?', default=DEFAULT_OUTPUT, help='where to save the mask')
+    parser.add_argument('--batch', nargs=2, metavar=('INPUT_DIR', 'OUTPUT_DIR'),
+                        help='mask every image in INPUT_DIR into OUTPUT_DIR')
+    parser.add_argument('--workers', type=int, help='processes for --batch (default: one per CPU)')
+    parser.add_argument('--levels', type=parse_levels, default=0,
+                        help="pyramid levels for edge detection: 0 (full resolution), a number, or 'auto'")
+    parser.add_argument('--canny-low', type=int, default=CANNY_LOW)
+    parser.add_argument('--canny-high', type=int, default=CANNY_HIGH)
+    parser.add_argument('--kernel-size', type=int, default=KERNEL_SIZE)
+    parser.add_argument('--dilate-iterations', type=int, default=DILATE_ITERATIONS)
+    parser.add_argument('--bright-threshold', type=int, default=BRIGHT_THRESHOLD)
+    args = parser.parse_args(argv)
 
-# Save mask
-cv2.imwrite('/app/outputs/mask/mask.png', mask)
+    params = dict(canny_low=args.canny_low, canny_high=args.canny_high, kernel_size=args.kernel_size,
+                  dilate_iterations=args.dilate_iterations, bright_threshold=args.bright_threshold,
+                  levels=args.levels)
+    if args.batch:
+        results = generate_masks(args.batch[0], args.batch[1], workers=args.workers, **params)
+        failed = sum(1 for path in results.values() if path is None)
+        print(f"Masks saved for {len(results) - failed} of {len(results)} images")
+        return 1 if failed else 0
 
-print("Mask saved as mask.png")
+    generate_mask(args.input, args.output, **params)
+    print(f"Mask saved as {args.output}")
+    return 0
 
+if __name__ == '__main__':
+    sys.exit(main())
 
-# SAM should be used.
\ No newline at end of file
+# SAM should be used.